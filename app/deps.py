@@ -9,6 +9,10 @@ def _get_s3_client() -> S3:
 def _get_triplestore_client() -> TripleStore:
     return triplestore
 
+async def _get_graph_version() -> tuple:
+    """Version of the default named graph, see `TripleStore.graph_versions`"""
+    return await triplestore.graph_versions.aversion(triplestore.default_named_graph_uri)
+
 def _get_localfiles_client() -> Local:
     return localfiles
 
@@ -51,9 +51,12 @@ async def startup_event():
 
 
 
-# @app.on_event("shutdown")
-# async def shutdown_event():
-#     await kafkaio.stop()
+@app.on_event("shutdown")
+async def shutdown_event():
+    from app.deps import _get_triplestore_client  # sessions are built with the routers using them
+
+    await _get_triplestore_client().aclose()  # pooled connections of the async SPARQL client
+    # await kafkaio.stop()
 
 
 @app.get("/")
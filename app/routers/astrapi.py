@@ -10,10 +10,10 @@ from fastapi import (
     Form,
 )
 from fastapi import Query, Body, status, HTTPException
-from fastapi.responses import JSONResponse
-from fast_clients.fast_triplestore import TripleStore
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fast_clients.fast_triplestore import TripleStore, RefreshedIndex, CONSTRUCT_FORMATS
 from fast_clients.fast_files import S3
-from app.deps import _get_s3_client, _get_triplestore_client
+from app.deps import _get_s3_client, _get_triplestore_client, _get_graph_version
 from pydantic import BaseModel, ValidationError, model_validator
 from fastapi.encoders import jsonable_encoder
 from io import BytesIO
@@ -25,11 +25,12 @@ from pathlib import Path
 
 from functools import wraps
 
-from typing import List, Tuple, Annotated, Optional
+from typing import List, Tuple, Annotated, Optional, AsyncIterator
 
 import os
 import asyncio
 import json
+import zlib
 import numpy as np
 import pandas as pd
 import logging
@@ -117,6 +118,54 @@ def check_starlette_payload(func):
     return wrapper
 
 
+async def encode_rows(rows: AsyncIterator[dict], stream: str, chunk_size: int = 1 << 16):
+    """Encode rows as they arrive, as NDJSON lines or as one JSON array, in chunks of ~`chunk_size` bytes"""
+    buffer, size = [], 0
+    first = True
+    if stream == "json":
+        buffer.append("[")
+    async for row in rows:
+        line = json.dumps(row, ensure_ascii=False)
+        if stream == "ndjson":
+            line += "\n"
+        elif not first:
+            line = "," + line
+        first = False
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if stream == "json":
+        buffer.append("]")
+    yield "".join(buffer)
+
+
+def streaming_rows_response(rows: AsyncIterator[dict], stream: str) -> StreamingResponse:
+    return StreamingResponse(
+        encode_rows(rows, stream),
+        media_type="application/x-ndjson" if stream == "ndjson" else "application/json",
+    )
+
+
+def not_modified(req: Request, etag: str) -> bool:
+    """True if the client's copy, validated by `If-None-Match`, is still current"""
+    if_none_match = req.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    return if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes], level: int = 6):
+    """Gzip a byte stream on the fly, without holding more than one chunk"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
 #     __
 #    / /
 #   / /
@@ -137,6 +186,60 @@ async def get_config(
     return JSONResponse(content=triplestore.config)  # {"Content": json_response}
 
 
+@router.get("/debug/singleflight")
+async def get_singleflight_stats(
+    req: Request, triplestore: TripleStore = Depends(_get_triplestore_client)
+):
+    """Per-template count of selects sent to the triplestore (`executed`) and of identical
+    concurrent selects that waited for them instead (`coalesced`)"""
+    return JSONResponse(content=triplestore.single_flight.stats())
+
+
+@router.get("/debug/replicas")
+async def get_replicas_stats(
+    req: Request,
+    check: Annotated[bool, Query()] = False,
+    triplestore: TripleStore = Depends(_get_triplestore_client),
+):
+    """Outstanding/served requests and failures per query endpoint, `check=true` probes them first"""
+    if check is True:
+        return JSONResponse(content=await asyncio.to_thread(triplestore.check_replicas))
+    return JSONResponse(content=triplestore.replicas.stats())
+
+
+@router.get("/debug/queries")
+async def get_queries_profile(
+    req: Request,
+    slow: Annotated[bool, Query()] = True,
+    triplestore: TripleStore = Depends(_get_triplestore_client),
+):
+    """Per-template calls, errors, rows, bytes and latency percentiles, then the latest slow
+    queries with their text (`query_profile_slow_seconds` in the TripleStore config)"""
+    content = {"templates": triplestore.profiler.stats()}
+    if slow is True:
+        content["slow_queries"] = list(triplestore.profiler.slow_queries)
+    return JSONResponse(content=content)
+
+
+@router.get("/debug/graph_versions")
+async def get_graph_versions(
+    req: Request, triplestore: TripleStore = Depends(_get_triplestore_client)
+):
+    """Versions of the named graphs last read from their markers"""
+    return JSONResponse(content=triplestore.graph_versions.stats())
+
+
+@router.get("/metrics")
+async def get_metrics(
+    req: Request, triplestore: TripleStore = Depends(_get_triplestore_client)
+):
+    """SPARQL query metrics in Prometheus text format"""
+    return PlainTextResponse(
+        content=triplestore.profiler.to_prometheus(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
 from app.deps import (
     _get_s3_client,
     _get_triplestore_client,
@@ -163,7 +266,7 @@ async def get_static_all_builtworks(
                         ?e22 rdfs:label ?e22lab .
                         ?e22 acrm:P53_has_former_or_current_location/rdfs:label ?e53lab .
                     } LIMIT 20"""
-    result = triplestore.select_static(query=qstring, format="dict")
+    result = await triplestore.aselect_static(qstring, format="dict")
     return JSONResponse(content=result)  # {"Content": json_response}
 
 
@@ -213,6 +316,24 @@ def submit1(
 
 
 
+# /search
+#########
+@router.get("/search")
+async def search_labels(
+    req: Request,
+    q: Annotated[str, Query(min_length=1, max_length=200)],
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    type: Annotated[list[str] | None, Query()] = None,
+    fuzzy: Annotated[bool, Query()] = True,
+    triplestore: TripleStore = Depends(_get_triplestore_client),
+):
+    """Builtworks, geometries, annotations... whose labels match `q`, ranked, the last word
+    matched as a prefix for autocomplete. `type` (repeatable) keeps entities of these classes only.
+    """
+    index = await loaded_index(triplestore.label_search)
+    return JSONResponse(content=index.search(q, limit=limit, types=type, fuzzy=fuzzy))
+
+
 #     ___
 #    / / |____ __ __
 #   / /| '_ \ V  V /
@@ -221,20 +342,41 @@ def submit1(
 async def get_all_builtworks(
     req: Request,
     recursive: Annotated[bool | None, Query()] = None,
-    triplestore: TripleStore = Depends(_get_triplestore_client)
+    stream: Annotated[str | None, Query(pattern="^(ndjson|json)$")] = None,
+    triplestore: TripleStore = Depends(_get_triplestore_client),
+    graph_version: tuple = Depends(_get_graph_version),
 ):
     try:
+        if recursive is not True:  # labels are read from the thesaurus graph too
+            graph_version += await triplestore.graph_versions.aversion("http://astragale.cnrs.fr/graphs/th/th21_icomos")
+        etag = triplestore.graph_versions.token(
+            graph_version, "recursive" if recursive is True else "flat", stream or "dict"
+        )
+        if not_modified(req, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        headers = {"ETag": etag}
+
+        if stream is not None:
+            response = streaming_rows_response(
+                triplestore.aiter_select_templated(
+                    query_filename="s4bc0-all_builtworks.sparql" if recursive is True else "s4bc1-all_builtworks_subuiltworks.sparql",
+                    override_named_graph_uri=None if recursive is True else [triplestore.default_named_graph_uri, "http://astragale.cnrs.fr/graphs/th/th21_icomos"],
+                ),
+                stream,
+            )
+            response.headers.update(headers)
+            return response
         if recursive is True:
-            result = triplestore.select_templated(
+            result = await triplestore.aselect_templated(
                 query_filename="s4bc0-all_builtworks.sparql", format="dict"
             )
-            return JSONResponse(content=result)
+            return JSONResponse(content=result, headers=headers)
         else:
-            result = triplestore.select_templated(
+            result = await triplestore.aselect_templated(
                 query_filename="s4bc1-all_builtworks_subuiltworks.sparql", format="dict",
-                named_graph_uri=[triplestore.default_named_graph_uri, "http://astragale.cnrs.fr/graphs/th/th21_icomos"]
+                override_named_graph_uri=[triplestore.default_named_graph_uri, "http://astragale.cnrs.fr/graphs/th/th21_icomos"]
             )
-            return JSONResponse(content=result)
+            return JSONResponse(content=result, headers=headers)
 
     except Exception as e:
         logger_i.error(e)
@@ -278,18 +420,40 @@ async def get_bw_id_geoms(
     req: Request,
     builtwork_id,
     creator: Annotated[str | None, Query(max_length=50)] = None,
+    download_link: Annotated[bool | None, Query()] = None,
+    stream: Annotated[str | None, Query(pattern="^(ndjson|json)$")] = None,
     triplestore: TripleStore = Depends(_get_triplestore_client),
+    s3: S3 = Depends(_get_s3_client),
 ):
     logger_i.debug(
         f"existingbw: {triplestore.default_named_graph_uri+'/'+builtwork_id}"
     )
-    result = triplestore.select_templated(
+    if stream is not None:
+        async def rows_with_links():
+            async for row in triplestore.aiter_select_templated(
+                query_filename="s3a10-all_geometries.sparql",
+                bw_uri=triplestore.config["default_triples_root_uri"] + builtwork_id,
+            ):
+                if download_link is True and row.get("geom_path"):
+                    row["presigned_url"] = s3.create_presigned_url(s3_url=row["geom_path"])
+                yield row
+
+        return streaming_rows_response(rows_with_links(), stream)
+
+    result = await triplestore.aselect_templated(
         query_filename="s3a10-all_geometries.sparql",
         format="dict",
         bw_uri=triplestore.config["default_triples_root_uri"] + builtwork_id,
         # enforce_parameters={"sub_sp6a": creator},
     )
     logger_i.info(f"result={result}")
+
+    if download_link is True:
+        presigned_urls = s3.create_presigned_urls(
+            s3_urls=[row["geom_path"] for row in result if row.get("geom_path")]
+        )
+        for row in result:
+            row["presigned_url"] = presigned_urls.get(row.get("geom_path"))
     return JSONResponse(content=result)
 
 
@@ -398,7 +562,7 @@ async def get_details_geometry(
         f"existingbw={triplestore.default_named_graph_uri+'/'+builtwork_id} ; existinggeom={triplestore.default_named_graph_uri+'/'+geometry_id}"
     )
 
-    result = triplestore.select_templated(
+    result = await triplestore.aselect_templated(
         query_filename="sd696-details_geometry.sparql",
         format="dict",
         geom_uri=triplestore.config["default_triples_root_uri"] + geometry_id,
@@ -416,6 +580,36 @@ async def get_details_geometry(
     return JSONResponse(content=result)
 
 
+# /geometries
+#############
+@router.get("/geometries")
+async def get_details_geometries(
+    req: Request,
+    geometry_ids: Annotated[list[str], Query()],
+    download_link: Annotated[bool | None, Query()] = None,
+    triplestore: TripleStore = Depends(_get_triplestore_client),
+    s3: S3 = Depends(_get_s3_client),
+):
+    """Details of many geometries in a single round trip to the triplestore, keyed by geometry id"""
+    results = await triplestore.aselect_many(
+        query_filename="sd696-details_geometry.sparql",
+        rows=[
+            {"geom_uri": triplestore.config["default_triples_root_uri"] + geometry_id}
+            for geometry_id in geometry_ids
+        ],
+        format="dict",
+    )
+
+    if download_link is True:
+        presigned_urls = s3.create_presigned_urls(
+            s3_urls=[row["geom_path"] for result in results for row in result if row.get("geom_path")]
+        )
+        for result in results:
+            for row in result:
+                row["presigned_url"] = presigned_urls.get(row.get("geom_path"))
+    return JSONResponse(content=dict(zip(geometry_ids, results)))
+
+
 #     __  _           _      _   _             
 #    / /_(_)_ __ _  _| |__ _| |_(_)___ _ _  ___
 #   / (_-< | '  \ || | / _` |  _| / _ \ ' \(_-<
@@ -432,7 +626,7 @@ async def get_all_bw_simulations(
     logger_i.debug(
         f"existingbw: {triplestore.default_named_graph_uri+'/'+ builtwork_id}"
     )
-    result = triplestore.select_templated(
+    result = await triplestore.aselect_templated(
         query_filename="s9f2b-all_simulations_bw.sparql",
         format="dict",
         bw_uri=triplestore.config["default_triples_root_uri"] + builtwork_id,
@@ -613,7 +807,7 @@ async def get_geom_id_annofeats(
     )
 
     if only_observations is True:
-        result = triplestore.select_templated(
+        result = await triplestore.aselect_templated(
             query_filename="s16eb-allH_observations_geom.sparql",
             override_named_graph_uri=[triplestore.default_named_graph_uri, "http://astragale.cnrs.fr/graphs/th/th21_icomos"],
             format="dict",
@@ -648,7 +842,7 @@ async def get_bw_id_annofeats(
     )
 
     if only_observations is True:
-        result = triplestore.select_templated(
+        result = await triplestore.aselect_templated(
             query_filename="s16ea-allH_observations_bw.sparql",
             override_named_graph_uri=[triplestore.default_named_graph_uri, "http://astragale.cnrs.fr/graphs/th/th21_icomos"],
             format="dict",
@@ -657,7 +851,7 @@ async def get_bw_id_annofeats(
         )
         return JSONResponse(content=result)
     else:
-        result = triplestore.select_templated(
+        result = await triplestore.aselect_templated(
             query_filename="s16ea-allH_observations_bw.sparql",
             override_named_graph_uri=[triplestore.default_named_graph_uri, "http://astragale.cnrs.fr/graphs/th/th21_icomos"],
             format="dict",
@@ -679,7 +873,7 @@ async def post_annotations_points_proximity(
     distance_treshold: Annotated[float | None, Query()] = None,
     s3: S3 = Depends(_get_s3_client),
 ):
-    result = triplestore.select_templated(
+    result = await triplestore.aselect_templated(
         query_filename="s16eb-allH_annotations_geom.sparql",
         format="dict",
         bw_uri=triplestore.config["default_triples_root_uri"] + builtwork_id,
@@ -691,12 +885,30 @@ async def post_annotations_points_proximity(
     geom_paths = pd.DataFrame(result)["geom_path"].to_list()  # baaaah
     logger_i.info(geom_paths)
 
-    # Get and merge annotation's point clouds
-    np_pts = np.ndarray(shape=(0, 3))
-    for s3_url in geom_paths:
-        np_pts = np.vstack(
-            (np_pts, s3.smart_read_ply(s3_url=s3_url)["points"].iloc[:, :3])
-        )
+    # Get and merge annotation's point clouds, skipping the ones whose bounding box is out of reach
+    geometries_stats = await asyncio.gather(
+        *(asyncio.to_thread(s3.get_geometry_stats, s3_url=s3_url) for s3_url in geom_paths)
+    )
+    kept_paths = []
+    for s3_url, geometry_stats in zip(geom_paths, geometries_stats):
+        if geometry_stats is not None and not geometry_stats.intersects(
+            in_pmdata.points, margin=distance_treshold or 0.0
+        ):
+            logger_i.debug(f"Pruned cloud={s3_url}, bbox out of reach")
+            continue
+        kept_paths.append(s3_url)
+    if not kept_paths:
+        logger_i.info(f"No cloud within reach among {len(geom_paths)} clouds")
+        return JSONResponse(content=json.dumps([False] * len(in_pmdata.points), sort_keys=True))  # same mask shape as a match
+
+    np_pts = np.vstack(
+        [
+            ply["points"].iloc[:, :3]
+            for ply in await asyncio.gather(
+                *(asyncio.to_thread(s3.smart_read_ply, s3_url=s3_url) for s3_url in kept_paths)
+            )
+        ]
+    )
 
     logger_i.info(f"Loaded table points={np.shape(np_pts)}")
     logger_i.info(f"Params: distance_treshold={distance_treshold}")
@@ -827,9 +1039,15 @@ async def post_annotationLayer_to_geometry(
 @router.get("/annotationLayers")
 async def get_annolayers(
     req: Request,
+    stream: Annotated[str | None, Query(pattern="^(ndjson|json)$")] = None,
     triplestore: TripleStore = Depends(_get_triplestore_client),
 ):
-    result = triplestore.select_templated(
+    if stream is not None:
+        return streaming_rows_response(
+            triplestore.aiter_select_templated(query_filename="s6e18-all_annotation_layers.sparql"),
+            stream,
+        )
+    result = await triplestore.aselect_templated(
         query_filename="s6e18-all_annotation_layers.sparql",
         format="dict",
         # enforce_parameters={"annotype": creator},
@@ -839,21 +1057,24 @@ async def get_annolayers(
 
 # /annotationLayers/{annotationLayer_id}
 ########################################
-@router.get("/annotationLayers/{annotationLayer_id}")
-async def get_details_and_status_annotationLayer(
-    req: Request,
-    annotationLayer_id,
-    download_link: Annotated[str | None, Query(max_length=5)] = None,
-    triplestore: TripleStore = Depends(_get_triplestore_client),
-    s3: S3 = Depends(_get_s3_client),
-):
-    logger_i.debug(
-        f"existing annotationLayer_id={triplestore.default_named_graph_uri+'/'+annotationLayer_id}"
+async def s3_archive_and_folder_exist(s3: S3, annotationLayer_path: str) -> Tuple[bool, bool]:
+    """Existence of the archive of an annotation layer and of its extracted folder, both checked at once"""
+    bucket, key = s3.parse_url_s3_as_bucket_and_filename(annotationLayer_path)
+    annotationLayer_folder_path = f"s3://{bucket}/{key.split('.')[0]}"
+    file_exists, folder_exists = await asyncio.gather(
+        asyncio.to_thread(s3.check_s3_file_existence, s3_url=annotationLayer_path),
+        asyncio.to_thread(s3.check_s3_prefix_existence, s3_url=annotationLayer_folder_path),
     )
+    return file_exists, folder_exists
+
 
-    result = triplestore.select_templated(
+async def fetch_annotationLayer_status(
+    triplestore: TripleStore, s3: S3, annotationLayer_id: str
+) -> list[dict]:
+    result = await triplestore.aselect_templated(
         query_filename="s41e9-details_annotationLayer.sparql",
         format="dict",
+        cached=False,  # the status decides what a handler writes next
         annotationLayer_uri=triplestore.config["default_triples_root_uri"]
         + annotationLayer_id,
     )
@@ -861,14 +1082,6 @@ async def get_details_and_status_annotationLayer(
     annotationLayer_path = result[0]["annotationLayer_path"]
     logger_i.info(f"annotationLayer_path={annotationLayer_path}")
 
-    # ## Presigned URI
-    # geom_presigned_url=s3.create_presigned_url(s3_url=annotationLayer_path)
-    #                                         #    custom_netloc=urlparse(s3.config["s3_public_endpoint_url"]).netloc)
-
-    # logger_i.info(f"presigned={geom_presigned_url}, {s3.config['s3_public_endpoint_url']}")
-
-    # result.append({"presigned_url": geom_presigned_url})
-
     ## Status
     ### test if annotations loaded in graph
     annotations_exists = False if (result[0]["feat_uri"] == None) else True
@@ -876,7 +1089,7 @@ async def get_details_and_status_annotationLayer(
     (
         annotationLayer_file_exists,
         annotationLayer_folder_exists,
-    ) = s3.check_s3_file_and_folder_coexistence(s3_url=annotationLayer_path)
+    ) = await s3_archive_and_folder_exist(s3, annotationLayer_path)
 
     logger_i.info(
         f"annotations_exists={annotations_exists}, annotationLayer_file_exists={annotationLayer_file_exists}, annotationLayer_folder_exists={annotationLayer_folder_exists}"
@@ -900,18 +1113,61 @@ async def get_details_and_status_annotationLayer(
             annotationLayer_file_exists is True
             and annotationLayer_folder_exists is True
         ):
-            result |= {"annotationLayer_status": "Extracted"}  # Archive and files
+            result.append({"annotationLayer_status": "Extracted"})  # Archive and files
         elif (
             annotationLayer_file_exists is True
             and annotationLayer_folder_exists is False
         ):
-            result |= {"annotationLayer_status": "Archived"}  # Only the archive
+            result.append({"annotationLayer_status": "Archived"})  # Only the archive
         else:
-            result |= {
+            result.append(
+                {
                     "annotationLayer_status": "Error, Archive incomplete, files or folders are deleted"
                 }
-            
+            )
+    return result
+
+
+async def annotationLayer_details_and_status(
+    req: Request, triplestore: TripleStore, s3: S3, annotationLayer_id: str
+) -> list[dict]:
+    """Details of an annotation layer followed by its status, memoized on `req.state` for the request only:
+    the checks of one handler share a round of graph and s3 lookups, another request always looks again
+    """
+    memo = getattr(req.state, "annotationLayer_status", None)
+    if memo is None:
+        memo = req.state.annotationLayer_status = {}
+    if annotationLayer_id not in memo:  # errors are not memoized
+        memo[annotationLayer_id] = await fetch_annotationLayer_status(triplestore, s3, annotationLayer_id)
+    return [dict(row) for row in memo[annotationLayer_id]]
 
+
+def forget_annotationLayer_status(req: Request, annotationLayer_id: str):
+    """Drop the status memoized by the request, to call once it changed the archive or the annotations of the layer"""
+    getattr(req.state, "annotationLayer_status", {}).pop(annotationLayer_id, None)
+
+
+@router.get("/annotationLayers/{annotationLayer_id}")
+async def get_details_and_status_annotationLayer(
+    req: Request,
+    annotationLayer_id,
+    download_link: Annotated[str | None, Query(max_length=5)] = None,
+    triplestore: TripleStore = Depends(_get_triplestore_client),
+    s3: S3 = Depends(_get_s3_client),
+):
+    logger_i.debug(
+        f"existing annotationLayer_id={triplestore.default_named_graph_uri+'/'+annotationLayer_id}"
+    )
+
+    # ## Presigned URI
+    # geom_presigned_url=s3.create_presigned_url(s3_url=annotationLayer_path)
+    #                                         #    custom_netloc=urlparse(s3.config["s3_public_endpoint_url"]).netloc)
+
+    # logger_i.info(f"presigned={geom_presigned_url}, {s3.config['s3_public_endpoint_url']}")
+
+    # result.append({"presigned_url": geom_presigned_url})
+
+    result = await annotationLayer_details_and_status(req, triplestore, s3, annotationLayer_id)
     return result  # return JSONResponse(content=result) le cast en JSONResponse se fait par starlette, pas besoin de le faire à l'avance
 
 
@@ -924,11 +1180,8 @@ async def process_annotationLayers_extract_archives_in_s3(
     s3: S3 = Depends(_get_s3_client),
 ):
     # Get status, should be "Archived" to extract
-    resp_status = await get_details_and_status_annotationLayer(
-        req=req,
-        annotationLayer_id=annotationLayer_id,
-        triplestore=_get_triplestore_client(),
-        s3=_get_s3_client(),
+    resp_status = await annotationLayer_details_and_status(
+        req, _get_triplestore_client(), s3, annotationLayer_id
     )
 
     annotationLayer_path = resp_status[0]["annotationLayer_path"]
@@ -946,12 +1199,15 @@ async def process_annotationLayers_extract_archives_in_s3(
 
     # Status='Archived' => Extracting s3 file on s3 folder
     logger_i.info(f"Extracting archive at annotationLayer_path={annotationLayer_path}")
-    s3.extract_archive(s3_url=annotationLayer_path)
+    report = await asyncio.to_thread(s3.extract_archive, s3_url=annotationLayer_path)
+    if report.failed:
+        logger_i.error(f"Extraction of {annotationLayer_path} failed for {report.failed} files, errors={report.errors[:10]}")
+    forget_annotationLayer_status(req, annotationLayer_id)
 
     (
         annotationLayer_file_exists,
         annotationLayer_folder_exists,
-    ) = s3.check_s3_file_and_folder_coexistence(s3_url=annotationLayer_path)
+    ) = await s3_archive_and_folder_exist(s3, annotationLayer_path)
     if annotationLayer_file_exists and annotationLayer_folder_exists:
         logger_i.info("ok")
         return JSONResponse(
@@ -969,6 +1225,50 @@ async def process_annotationLayers_extract_archives_in_s3(
         )
 
 
+# /annotationLayers/{annotationLayer_id}/bundle
+###############################################
+@router.get("/annotationLayers/{annotationLayer_id}/bundle")
+async def get_annotationLayer_bundle(
+    req: Request,
+    annotationLayer_id,
+    archive_format: Annotated[str, Query(pattern="^(tar|zip)$")] = "tar",
+    read_ahead: Annotated[int, Query(ge=1, le=64)] = 8,
+    triplestore: TripleStore = Depends(_get_triplestore_client),
+    s3: S3 = Depends(_get_s3_client),
+):
+    """Download the extracted folder of an annotation layer as a single archive, built on the fly"""
+    result = await triplestore.aselect_templated(
+        query_filename="s41e9-details_annotationLayer.sparql",
+        format="dict",
+        annotationLayer_uri=triplestore.config["default_triples_root_uri"]
+        + annotationLayer_id,
+    )
+
+    annotationLayer_archive_path = result[0]["annotationLayer_path"]
+    bucket, key = s3.parse_url_s3_as_bucket_and_filename(annotationLayer_archive_path)
+    annotationLayer_folder_path = f"s3://{bucket}/{key.split('.')[0]}"
+    logger_i.info(f"Bundling annotationLayer_folder_path={annotationLayer_folder_path}")
+
+    if s3.check_s3_prefix_existence(s3_url=annotationLayer_folder_path) is False:
+        return JSONResponse(
+            content={
+                "msg": f"Annotation Layer id={annotationLayer_id} is not extracted, no folder found at path {annotationLayer_folder_path}"
+            },
+            status_code=404,
+        )
+
+    bundle_filename = f"{Path(key.split('.')[0]).name}.{archive_format}"
+    return StreamingResponse(
+        s3.stream_archive_of_folder(
+            s3_url=annotationLayer_folder_path,
+            archive_format=archive_format,
+            read_ahead=read_ahead,
+        ),
+        media_type="application/x-tar" if archive_format == "tar" else "application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{bundle_filename}"'},
+    )
+
+
 # /annotationLayers/{annotationLayer_id}/LoadGeometryAnnotations
 ################################################################
 @router.get("/annotationLayers/{annotationLayer_id}/LoadGeometryAnnotations")
@@ -984,11 +1284,8 @@ async def process_annotationLayers_load_annotations_from_s3(
     ] = "curated_table_layer.xlsx",
     s3: S3 = Depends(_get_s3_client),
 ):
-    resp_status = await get_details_and_status_annotationLayer(
-        req=req,
-        annotationLayer_id=annotationLayer_id,
-        triplestore=_get_triplestore_client(),
-        s3=_get_s3_client(),
+    resp_status = await annotationLayer_details_and_status(
+        req, triplestore, s3, annotationLayer_id
     )
     annotationLayer_status = resp_status[1]["annotationLayer_status"]
     logger_i.info(f"type={type(resp_status)}, val={resp_status}")
@@ -1006,7 +1303,7 @@ async def process_annotationLayers_load_annotations_from_s3(
         logger_i.info("")
         return JSONResponse(
             content={
-                "msg": f"Annotation Layer id={annotationLayer_id} has status={annotationLayer_status}, won't load a still archived or already loaded annotationLayer archive at path {annotationLayer_path}"
+                "msg": f"Annotation Layer id={annotationLayer_id} has status={annotationLayer_status}, won't load a still archived or already loaded annotationLayer archive at path {annotationLayer_archive_path}"
             },
             status_code=422,
         )
@@ -1087,6 +1384,22 @@ async def process_annotationLayers_load_annotations_from_s3(
         records = df.apply(lambda row: record_maker_geom_annotation(row=row), axis=1)
         logger_i.info(records)
 
+        update_template = triplestore.config.get("annotation_layer_update_template")
+        if update_template is not None:
+            # Written to the graph directly, the records are joined in a few batched update requests
+            records = [record for record in records if record is not None]
+            results = await asyncio.gather(
+                *(
+                    triplestore.update_batcher.aadd(update_template, **record)  # values rendered as escaped terms
+                    for record in records
+                )
+            )
+            # the batcher pinned in the gathered tasks, the handler's own context did not see it
+            triplestore.replicas.pin(triplestore.default_named_graph_uri)
+            logger_i.info(f"Loaded {len(records)} annotations to annotationLayer_uri={annotationLayer_uri}")
+            forget_annotationLayer_status(req, annotationLayer_id)
+            return results
+
         results = []
         for record in records:
             logger_i.info(record)
@@ -1101,6 +1414,7 @@ async def process_annotationLayers_load_annotations_from_s3(
             logger_i.info(resp)
             results.append(resp)
 
+        forget_annotationLayer_status(req, annotationLayer_id)
         return results
 
     # logger_i.info({"JSON Payload ": record, "file.filename": file.filename, "filename pathlib": Path(file.filename).name, "Path Params": builtwork_id, "Query Params": annotation_type})
@@ -1140,19 +1454,87 @@ async def process_annotationLayers_load_annotations_from_s3(
 #   / / '_ \/ _` | '_|  _(_-<
 #  /_/| .__/\__,_|_|  \__/__/
 #     |_|
+async def loaded_index(index: RefreshedIndex) -> RefreshedIndex:
+    """In-process index of the triplestore, loaded on first use then refreshed in the background"""
+    if not index.is_ready:
+        await asyncio.to_thread(index.refresh)
+    else:
+        index.maybe_refresh()
+    return index
+
+
+@router.get("/builtworks/{builtwork_id}/tree")
+async def get_bw_id_tree(
+    req: Request,
+    builtwork_id,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int, Query(ge=1, le=10000)] = 1000,
+    max_depth: Annotated[int | None, Query(ge=1)] = None,
+    triplestore: TripleStore = Depends(_get_triplestore_client),
+):
+    """Builtwork {builtwork_id}, its ancestors and one page of its subtree (depth-first order)"""
+    hierarchy = await loaded_index(triplestore.builtwork_hierarchy)
+    builtwork_uri = triplestore.config["default_triples_root_uri"] + builtwork_id
+    if builtwork_uri not in hierarchy:
+        raise HTTPException(status_code=404, detail=f"Builtwork {builtwork_id} not found")
+    return JSONResponse(
+        content=hierarchy.node(builtwork_uri)
+        | {
+            "ancestors": hierarchy.ancestors(builtwork_uri),
+            "subtree": hierarchy.subtree(builtwork_uri, offset=offset, limit=limit, max_depth=max_depth),
+            "offset": offset,
+            "limit": limit,
+        }
+    )
+
+
+@router.get("/builtworks/{builtwork_id}/export")
+async def get_bw_id_export(
+    req: Request,
+    builtwork_id,
+    format: Annotated[str, Query(pattern="^(nt|nq|ttl)$")] = "nt",
+    gzip: bool = False,
+    depth: Annotated[int, Query(ge=0, le=4)] = 3,
+    triplestore: TripleStore = Depends(_get_triplestore_client),
+):
+    """Builtwork {builtwork_id} with its parts and the resources linked to them (geometries, annotations...),
+    streamed from the store as N-Triples, N-Quads or Turtle, optionally gzipped"""
+    builtwork_uri = triplestore.config["default_triples_root_uri"] + builtwork_id
+    chunks = triplestore.aiter_construct(triplestore.export_query(builtwork_uri, depth=depth), format=format)
+    try:
+        first = await anext(chunks)  # store errors are still reportable before the response starts
+    except Exception as e:
+        await chunks.aclose()
+        logger_i.error(f"Export of {builtwork_uri} failed: {e}")
+        raise HTTPException(status_code=502, detail=f"Export of builtwork {builtwork_id} failed: {e}")
+
+    async def body():
+        yield first
+        async for chunk in chunks:
+            yield chunk
+
+    filename = f"{builtwork_id}.{format}" + (".gz" if gzip else "")
+    return StreamingResponse(
+        gzip_chunks(body()) if gzip else body(),
+        media_type="application/gzip" if gzip else CONSTRUCT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @router.get("/builtworks/{builtwork_id}/parts")
 async def get_bw_id_maj(
     req: Request,
     builtwork_id,
     triplestore: TripleStore = Depends(_get_triplestore_client),
 ):
+    """Parts of the builtwork {builtwork_id}, paged trees are served by `/builtworks/{builtwork_id}/tree`"""
     logger_i.debug(
         f"existingbw: {triplestore.default_named_graph_uri+'/'+builtwork_id}"
     )
-    result = triplestore.rdfstore_sparql_select_templated(
+    result = await triplestore.aselect_templated(
         query_filename="92d1-allUr_subuiltworks.sparql",
         format="dict",
-        builtwork_uri=triplestore.config["default_root_uri"] + builtwork_id,
+        builtwork_uri=triplestore.config["default_triples_root_uri"] + builtwork_id,
     )
     return JSONResponse(content=result)  # {"Content": json_response}
 
@@ -1165,7 +1547,7 @@ async def get_bw_id_part_id(
     triplestore: TripleStore = Depends(_get_triplestore_client),
 ):
     """Synoptic description of the part {part_id}
-       Reminder: a part of a builtwork is still a builtwork, so this simply call get_synoptic_bw due to graph-based hierarchy implementation
+       Reminder: a part of a builtwork is still a builtwork, {part_id} may be at any depth below {builtwork_id}
 
     Args:
         req (Request): _description_
@@ -1175,7 +1557,15 @@ async def get_bw_id_part_id(
     Returns:
         _type_: _description_
     """
-    return await get_synoptic_bw(req=req, builtwork_id=part_id)
+    hierarchy = await loaded_index(triplestore.builtwork_hierarchy)
+    root = triplestore.config["default_triples_root_uri"]
+    if not hierarchy.is_descendant(root + part_id, root + builtwork_id):
+        raise HTTPException(
+            status_code=404, detail=f"Part {part_id} not found in builtwork {builtwork_id}"
+        )
+    return JSONResponse(
+        content=hierarchy.node(root + part_id) | {"ancestors": hierarchy.ancestors(root + part_id)}
+    )
 
 
 @router.get("/builtworks/{builtwork_id}/parts/{part_id}/geometries")
@@ -1183,10 +1573,12 @@ async def get_bw_id_part_id_geom(
     req: Request,
     builtwork_id,
     part_id,
+    download_link: Annotated[bool | None, Query()] = None,
     triplestore: TripleStore = Depends(_get_triplestore_client),
+    s3: S3 = Depends(_get_s3_client),
 ):
-    """Synoptic description of the part {part_id}
-       Reminder: a part of a builtwork is still a builtwork, so this simply call get_synoptic_bw due to graph-based hierarchy implementation
+    """Geometries of the part {part_id}
+       Reminder: a part of a builtwork is still a builtwork, so this simply call get_bw_id_geoms due to graph-based hierarchy implementation
 
     Args:
         req (Request): _description_
@@ -1196,4 +1588,17 @@ async def get_bw_id_part_id_geom(
     Returns:
         _type_: _description_
     """
-    return await get_bw_id_geoms(req=req, builtwork_id=part_id)
+    hierarchy = await loaded_index(triplestore.builtwork_hierarchy)
+    root = triplestore.config["default_triples_root_uri"]
+    if not hierarchy.is_descendant(root + part_id, root + builtwork_id):
+        raise HTTPException(
+            status_code=404, detail=f"Part {part_id} not found in builtwork {builtwork_id}"
+        )
+    return await get_bw_id_geoms(
+        req=req,
+        builtwork_id=part_id,
+        download_link=download_link,
+        stream=None,
+        triplestore=triplestore,
+        s3=s3,
+    )
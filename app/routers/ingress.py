@@ -89,6 +89,22 @@ def inlk_to_kafka_key(my_key_inlk: str) -> Tuple[str, str]:
     kkey = f"{duuid}://{my_key_inlk}"
     return kkey, duuid
 
+def inlk_destination(my_key_inlk: str) -> Optional[str]:
+    """DESTINATION part of a "SCHEMA/DESTINATION" inlake key, None for a bare "SCHEMA" key"""
+    return my_key_inlk.split("/", 1)[1] if "/" in my_key_inlk else None
+
+def inlk_subject_uris(content: str | dict) -> Optional[list]:
+    """Builtworks a record is about (`*builtwork_uri` fields), None when unknown (e.g. a builtwork not minted yet)"""
+    if isinstance(content, str):
+        try:
+            content = json.loads(content)
+        except (json.JSONDecodeError, TypeError):
+            return None
+    if not isinstance(content, dict):
+        return None
+    uris = [v for k, v in content.items() if k.endswith("builtwork_uri") and isinstance(v, str)]
+    return uris or None
+
 def parse_filesys_dirpath(s: str) -> Tuple[str, str]:
     o = urlparse(s, allow_fragments=False)
     return o.scheme, o.netloc, o.path
@@ -137,6 +153,8 @@ async def produce_record_json_unsecured(    record: Record,
     # msg = await kafkaio.consume()
     msg = await kafkaio.consume_key(key_to_wait_for=f"{duuid}://end")
     logger_i.debug(f"awaited streamgraphiti-job msg={msg}")
+    await _get_triplestore_client().aon_ingestion_completed(namedgraph_override or inlk_destination(record.key_inlk),
+                                                            subject_uris=inlk_subject_uris(record.content))
     response.status_code=status.HTTP_201_CREATED
 
     # return {"msg": f"INGRESS json-record with key={kkey} ; to Kafka topic={k_topic}", "duuid": {duuid}} # On garde cette magnifique archive
@@ -210,10 +228,16 @@ async def produce_record_json_n_binary_unsecured( response: Response,
 
 
     # # KAFKA
-    await kafkaio.produce_message_str(topic=k_topic, key=kkey, value=record.content)
+    # Geometry statistics travel as a header, the record's content stays compliant with its schema
+    headers = None
+    if r is not None and r.geometry_stats is not None:
+        headers = [("biglake-geometry-stats", r.geometry_stats.model_dump_json().encode('utf-8'))]
+    await kafkaio.produce_message_str(topic=k_topic, key=kkey, value=record.content, headers=headers)
     
     msg = await kafkaio.consume_key(key_to_wait_for=f"{duuid}://end")
     logger_i.debug(f"awaited streamgraphiti-job msg={msg}")
+    await _get_triplestore_client().aon_ingestion_completed(inlk_destination(record.key_inlk),
+                                                            subject_uris=inlk_subject_uris(content_asdict))
     response.status_code=status.HTTP_201_CREATED
 
     return {"msg": f"Data upload success (key={kkey}, duuid={duuid})",
@@ -6,11 +6,21 @@ from logging import getLogger
 from pathlib import Path
 import logging
 import asyncio
-from typing import Union, Tuple, Optional, Any
+import threading
+import time
+from typing import Union, Tuple, Optional, Any, Callable
 from urllib.parse import urlparse
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+import itertools
+import io
+import shutil
 
 import tarfile
+import zipfile
+import gzip
+import tempfile
+from contextlib import contextmanager
 
 import numpy as np
 import pandas as pd
@@ -25,7 +35,7 @@ from app.loggers import logger_f          # Import
 
 
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
 try:
     from functools import cache
@@ -34,6 +44,8 @@ except ImportError:
 
     cache = lru_cache(maxsize=None)
 
+import zstandard
+
 
 #   ___        _   ___ _ _
 #  | __|_ _ __| |_| __(_) |___ ___
@@ -41,6 +53,54 @@ except ImportError:
 #  |_|\__,_/__/\__|_| |_|_\___/__/
 
 
+class GeometryStats(BaseModel):
+    """
+    Represents the statistics of a point cloud, computed while it is uploaded
+
+    Attributes:
+        count (int): Number of points (vertices for .ply)
+        bbox_min (tuple[float, float, float] | None): Lower corner of the axis-aligned bounding box
+        bbox_max (tuple[float, float, float] | None): Upper corner of the axis-aligned bounding box
+        centroid (tuple[float, float, float] | None): Mean of the points
+        dtype (str): Storage type of the coordinates, "ascii" for text formats
+        properties (list[str]): Point properties (columns for text formats)
+    """
+
+    count: int = 0
+    bbox_min: tuple[float, float, float] | None = None
+    bbox_max: tuple[float, float, float] | None = None
+    centroid: tuple[float, float, float] | None = None
+    dtype: str = ""
+    properties: list[str] = []
+
+    def to_s3_metadata(self) -> dict[str, str]:
+        """Flatten as s3 user metadata (string values only, headers size is limited to 2KB)"""
+        metadata = {"biglake-point-count": str(self.count), "biglake-dtype": self.dtype}
+        if self.bbox_min is not None:
+            metadata["biglake-bbox"] = ",".join(repr(v) for v in (*self.bbox_min, *self.bbox_max))
+            metadata["biglake-centroid"] = ",".join(repr(v) for v in self.centroid)
+        return metadata
+
+    @classmethod
+    def from_s3_metadata(cls, metadata: dict[str, str]) -> "GeometryStats | None":
+        if "biglake-point-count" not in metadata:
+            return None
+        stats = cls(count=int(metadata["biglake-point-count"]), dtype=metadata.get("biglake-dtype", ""))
+        if "biglake-bbox" in metadata:
+            bbox = [float(v) for v in metadata["biglake-bbox"].split(",")]
+            stats.bbox_min, stats.bbox_max = tuple(bbox[:3]), tuple(bbox[3:])
+            stats.centroid = tuple(float(v) for v in metadata["biglake-centroid"].split(","))
+        return stats
+
+    def intersects(self, points, margin: float = 0.0) -> bool:
+        """True if any of the points lies in the bounding box grown by `margin`, True when the box is unknown"""
+        if self.bbox_min is None:
+            return True
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        inside = (points >= np.asarray(self.bbox_min) - margin) & (points <= np.asarray(self.bbox_max) + margin)
+        return bool(inside.all(axis=1).any())
+
+
 class FileData(BaseModel):
     """
     Represents the result of an upload operation
@@ -49,8 +109,10 @@ class FileData(BaseModel):
         file (Bytes): File saved to memory
         path (Path | str): Path to file in local storage
         url (HttpUrl | str): A URL for accessing the object.
-        size (int): Size of the file in bytes.
+        size (int): Size of the file in bytes, as uploaded (before compression at rest).
         filename (str): Name of the file.
+        content_encoding (str): Codec the file is stored with at rest, empty if stored as is.
+        geometry_stats (GeometryStats | None): Point count, bounding box and centroid of an uploaded point cloud.
         status (bool): True if the upload is successful else False.
         error (str): Error message for failed upload.
         message: Response Message
@@ -62,11 +124,44 @@ class FileData(BaseModel):
     size: int = 0
     filename: str = ""
     content_type: str = ""
+    content_encoding: str = ""
+    geometry_stats: GeometryStats | None = None
     status: bool = True
     error: str = ""
     message: str = ""
 
 
+class BulkReport(BaseModel):
+    """
+    Represents the result of a bulk operation over all the objects of a s3 prefix
+
+    Attributes:
+        operation (str): "copy", "sync", "move", "delete", "download" or "extract"
+        source (str): s3 url of the source prefix
+        destination (str): s3 url or local path of the destination, empty for deletions
+        listed (int): Number of source objects listed so far
+        transferred (int): Number of objects copied, downloaded or deleted
+        skipped (int): Number of objects already up to date at destination
+        failed (int): Number of objects given up after all retries
+        bytes (int): Number of bytes copied or downloaded
+        duration (float): Elapsed time in seconds
+        errors (list[str]): Error messages of the failed objects
+        status (bool): True if no object failed
+    """
+
+    operation: str = ""
+    source: str = ""
+    destination: str = ""
+    listed: int = 0
+    transferred: int = 0
+    skipped: int = 0
+    failed: int = 0
+    bytes: int = 0
+    duration: float = 0.0
+    errors: list[str] = []
+    status: bool = True
+
+
 class CloudUpload(ABC):
     """Source: https://github.com/Ichinga-Samuel/fastfiles
 
@@ -125,10 +220,23 @@ class S3(CloudUpload):
         """
         Keyword Args:
             config (dict): A dictionary of config settings
+                - ['presigned_refresh_margin']: seconds before expiry at which a cached presigned url is regenerated, defaults to 300,
+                    capped to half of the requested expiration
+                - ['presigned_cache_maxsize']: number of presigned urls kept in cache, defaults to 4096
+                - ['compress_text_geometries']: compress ascii geometries (.pts, .xyz, ascii .ply) at rest, defaults to False
+                - ['compression_codec']: 'gzip' or 'zstd', defaults to 'gzip'. 'zstd' only applies to the keys under
+                    `compression_internal_prefixes`, objects that may be downloaded with a presigned url are stored with
+                    'gzip', the only content encoding every http client decodes
+                - ['compression_internal_prefixes']: key prefixes of objects only read through this class, never presigned
+                - ['compression_level']: codec level, defaults to 6 for gzip and 3 for zstd
         """
         self.config = config or {}
         # Add config check here, test against a pydantic model
 
+        # Presigned urls, {(bucket, key, method, expiration): (url, expires_at)}
+        self._presigned_cache = {}
+        self._presigned_lock = threading.Lock()
+
     @property
     @cache
     def client(self):
@@ -212,6 +320,21 @@ class S3(CloudUpload):
         return True
 
 
+    def check_s3_prefix_existence(self, s3_url: str) -> bool:
+        """Check if at least one object is stored under the prefix `s3_url`, nested folders included
+
+        Args:
+            s3_url (str): url of a s3 folder formatted as `<my_s3>://<bucket_name>/<key>`
+
+        Returns:
+            bool: True if the prefix holds at least one object
+        """
+        bucket, key = self.parse_url_s3_as_bucket_and_filename(s3_url)
+        if key and not key.endswith("/"):
+            key = key + "/"
+        resp = self.client.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+        return resp.get("KeyCount", 0) > 0
+
     def check_s3_file_and_folder_coexistence(self, s3_url: str) -> bool:
         """From the s3 adress of an object, check if a folder with the same name exists a the same path
             WARNING: only works at bucket level. TODO: clean and expand to nested folders
@@ -273,17 +396,45 @@ class S3(CloudUpload):
 
         return out_l_folders, out_l_files
 
+    def iter_s3_objects_at_prefix(self, s3_url: str):
+        """Iterate lazily over all the objects stored under a s3 prefix, nested folders included.
+        Pages of `list_objects_v2` are only requested when the previous one is consumed.
+
+        Args:
+            s3_url (str): url of a s3 folder formatted as `<my_s3>://<bucket_name>/<key>`
+
+        Yields:
+            dict: object description from `list_objects_v2` ('Key', 'Size', 'ETag', 'LastModified')
+        """
+        bucket, key = self.parse_url_s3_as_bucket_and_filename(s3_url)
+        if key and not key.endswith("/"):
+            key = key + "/"
+        my_paginator = self.client.get_paginator("list_objects_v2")
+        for page in my_paginator.paginate(Bucket=bucket, Prefix=key):
+            for obj in page.get("Contents", []):
+                yield obj
+
 
     # ---------------------------------------------------------
     # ARCHIVE
     # ---------------------------------------------------------
-    def extract_archive(self, s3_url: str):
+    def extract_archive(
+        self,
+        s3_url: str,
+        workers: int = 8,
+        max_retries: int = 3,
+        rate_limit: float | None = None,
+    ) -> BulkReport:
         """Extract an archived stored as an s3 object at the path `s3_url`
          Note: only tarballs are implemented
+        The archive is read as a stream, its members are uploaded by the workers of the bulk engine.
 
         Args:
             s3url (str): path to the tar file as an s3 formatted url "s3://{bucket}/{key}"
-            client (Any): s3 client from the boto3 api
+            workers (int, optional): number of concurrent uploads. Defaults to 8.
+
+        Returns:
+            BulkReport: counts, bytes and errors of the extraction
         """
         # def parse_s3_url(s3url: str) -> Tuple[str, str]:
         #     o = urlparse(s3url, allow_fragments=False)
@@ -300,15 +451,414 @@ class S3(CloudUpload):
 
         bucket, key = self.parse_url_s3_as_bucket_and_filename(s3_url)
         logging.debug(f"START TASK UT with url={s3_url}, bucket={bucket}")
+
+        def upload_task(name: str, content: bytes):
+            def task():
+                self.client.put_object(Bucket=bucket, Key=name, Body=content)
+                return 1, len(content)
+
+            return task
+
+        def iter_members(tar):
+            for member in tar:
+                if member.isfile():
+                    logging.debug(f"Extracting file={member.name}")
+                    with tar.extractfile(member) as ftarin:
+                        content = ftarin.read()
+                    yield {"Key": member.name, "Size": member.size}, upload_task(member.name, content)
+
         with smart_open.open(s3_url, 'rb', transport_params=dict(client=self.client), compression='disable') as fin:
-            with tarfile.open(fileobj=fin) as tar:
-                for member in tar.getmembers():
-                    if member.isfile():
-                        with smart_open.open(f's3://{bucket}/{member.name}', 'wb',transport_params=dict(client=self.client)) as fout:
-                            logging.debug(f"Extracting file={member.name}")
-                            with tar.extractfile(member) as ftarin:
-                                fout.write(ftarin.read())
+            with tarfile.open(fileobj=fin, mode="r|*") as tar:
+                report = self._bulk_run(
+                    BulkReport(operation="extract", source=s3_url, destination=f"s3://{bucket}/"),
+                    iter_members(tar), workers=workers, max_retries=max_retries, rate_limit=rate_limit,
+                )
         logging.debug(f"END TASK UT")
+        return report
+
+    def stream_archive_of_folder(
+        self, s3_url: str, archive_format: str = "tar", read_ahead: int = 8
+    ):
+        """Build an archive of every object under the folder `s3_url` on the fly, nothing is staged to disk.
+        Member objects are fetched concurrently, at most `read_ahead` of them ahead of the archive writer,
+        and the archive bytes are yielded as soon as each member is written.
+
+        Args:
+            s3_url (str): url of a s3 folder formatted as `<my_s3>://<bucket_name>/<key>`
+            archive_format (str, optional): "tar" or "zip". Defaults to "tar".
+            read_ahead (int, optional): number of member objects prefetched concurrently. Defaults to 8.
+
+        Yields:
+            bytes: chunks of the archive
+        """
+        bucket, prefix = self.parse_url_s3_as_bucket_and_filename(s3_url)
+        prefix = prefix if prefix.endswith("/") else prefix + "/"
+
+        def fetch(obj: dict) -> bytes:
+            resp = self.client.get_object(Bucket=bucket, Key=obj["Key"])
+            codec = resp.get("Metadata", {}).get("biglake-codec")
+            return self.decompress_reader(resp["Body"], codec).read()
+
+        out = _ArchiveChunks()
+        match archive_format:
+            case "tar":
+                archive = tarfile.open(fileobj=out, mode="w|")
+            case "zip":
+                archive = zipfile.ZipFile(out, mode="w", compression=zipfile.ZIP_STORED)
+            case _:
+                raise ValueError(f"Unsupported archive_format={archive_format}, use 'tar' or 'zip'")
+
+        with ThreadPoolExecutor(max_workers=max(1, read_ahead)) as executor:
+            pending = deque()
+            objects = self.iter_s3_objects_at_prefix(s3_url)
+            for obj in itertools.islice(objects, read_ahead):
+                pending.append((obj, executor.submit(fetch, obj)))
+
+            with archive:
+                while pending:
+                    obj, future = pending.popleft()
+                    for next_obj in itertools.islice(objects, 1):
+                        pending.append((next_obj, executor.submit(fetch, next_obj)))
+
+                    member_name = obj["Key"][len(prefix):]
+                    content = future.result()
+                    if member_name == "" or member_name.endswith("/"):
+                        continue  # folder placeholder objects
+                    logger_f.debug(f"(stream_archive_of_folder) Adding member={member_name}")
+                    if archive_format == "tar":
+                        member = tarfile.TarInfo(name=member_name)
+                        member.size = len(content)
+                        member.mtime = obj["LastModified"].timestamp()
+                        archive.addfile(member, io.BytesIO(content))
+                    else:
+                        member = zipfile.ZipInfo(
+                            filename=member_name,
+                            date_time=obj["LastModified"].timetuple()[:6],
+                        )
+                        archive.writestr(member, content)
+                    yield out.pop()
+        yield out.pop()
+
+    # ---------------------------------------------------------
+    # BULK
+    # ---------------------------------------------------------
+    def bulk_copy_prefix(
+        self,
+        src_s3_url: str,
+        dst_s3_url: str,
+        workers: int = 16,
+        max_retries: int = 3,
+        rate_limit: float | None = None,
+        on_progress: Callable[[BulkReport], Any] | None = None,
+    ) -> BulkReport:
+        """Server-side copy of every object under `src_s3_url` to `dst_s3_url`, keeping the relative keys.
+        Listing pages are fed to the workers as they arrive, no object content goes through the API.
+
+        Args:
+            src_s3_url (str): url of the source prefix formatted as `<my_s3>://<bucket_name>/<key>`
+            dst_s3_url (str): url of the destination prefix formatted as `<my_s3>://<bucket_name>/<key>`
+            workers (int, optional): number of concurrent copies. Defaults to 16.
+            max_retries (int, optional): retries of a throttled or failed object before giving up. Defaults to 3.
+            rate_limit (float | None, optional): maximum of s3 requests per second, None for no limit. Defaults to None.
+            on_progress (Callable[[BulkReport], Any] | None, optional): called with the running report. Defaults to None.
+
+        Returns:
+            BulkReport: counts, bytes and errors of the operation
+        """
+        src_bucket, src_prefix = self._bulk_prefix(src_s3_url)
+        dst_bucket, dst_prefix = self._bulk_prefix(dst_s3_url)
+        tasks = (
+            (obj, self._bulk_copy_task(obj, src_bucket, dst_bucket, dst_prefix + obj["Key"][len(src_prefix):]))
+            for obj in self.iter_s3_objects_at_prefix(src_s3_url)
+        )
+        return self._bulk_run(
+            BulkReport(operation="copy", source=src_s3_url, destination=dst_s3_url),
+            tasks, workers=workers, max_retries=max_retries, rate_limit=rate_limit, on_progress=on_progress,
+        )
+
+    def bulk_sync_prefix(
+        self,
+        src_s3_url: str,
+        dst_s3_url: str,
+        delete: bool = False,
+        workers: int = 16,
+        max_retries: int = 3,
+        rate_limit: float | None = None,
+        on_progress: Callable[[BulkReport], Any] | None = None,
+    ) -> BulkReport:
+        """Like `bulk_copy_prefix`, but objects already at destination with the same size and ETag are skipped.
+        With `delete=True`, destination objects missing from the source are removed afterwards.
+
+        Args:
+            src_s3_url (str): url of the source prefix formatted as `<my_s3>://<bucket_name>/<key>`
+            dst_s3_url (str): url of the destination prefix formatted as `<my_s3>://<bucket_name>/<key>`
+            delete (bool, optional): remove extraneous destination objects. Defaults to False.
+
+        Returns:
+            BulkReport: counts, bytes and errors of the operation
+        """
+        src_bucket, src_prefix = self._bulk_prefix(src_s3_url)
+        dst_bucket, dst_prefix = self._bulk_prefix(dst_s3_url)
+        existing = {
+            obj["Key"][len(dst_prefix):]: obj for obj in self.iter_s3_objects_at_prefix(dst_s3_url)
+        }
+
+        def is_up_to_date(obj: dict) -> bool:
+            dst_obj = existing.pop(obj["Key"][len(src_prefix):], None)
+            if dst_obj is None or dst_obj["Size"] != obj["Size"]:
+                return False
+            if "-" in obj["ETag"] or "-" in dst_obj["ETag"]:
+                return True  # multipart ETags are not content hashes, trust the size
+            return dst_obj["ETag"] == obj["ETag"]
+
+        tasks = (
+            (obj, None if is_up_to_date(obj) else self._bulk_copy_task(obj, src_bucket, dst_bucket, dst_prefix + obj["Key"][len(src_prefix):]))
+            for obj in self.iter_s3_objects_at_prefix(src_s3_url)
+        )
+        report = self._bulk_run(
+            BulkReport(operation="sync", source=src_s3_url, destination=dst_s3_url),
+            tasks, workers=workers, max_retries=max_retries, rate_limit=rate_limit, on_progress=on_progress,
+        )
+
+        if delete and existing:
+            extraneous = self._bulk_delete_tasks(dst_bucket, iter(existing.values()))
+            deletion = self._bulk_run(
+                BulkReport(operation="delete", source=dst_s3_url),
+                extraneous, workers=workers, max_retries=max_retries, rate_limit=rate_limit,
+            )
+            report.failed += deletion.failed
+            report.errors += deletion.errors
+            report.status = report.failed == 0
+        return report
+
+    def bulk_move_prefix(
+        self,
+        src_s3_url: str,
+        dst_s3_url: str,
+        workers: int = 16,
+        max_retries: int = 3,
+        rate_limit: float | None = None,
+        on_progress: Callable[[BulkReport], Any] | None = None,
+    ) -> BulkReport:
+        """Copy every object under `src_s3_url` to `dst_s3_url`, then delete the source objects.
+        Sources are only deleted if the whole copy succeeded.
+
+        Returns:
+            BulkReport: report of the copy, with deletion errors appended
+        """
+        report = self.bulk_copy_prefix(
+            src_s3_url, dst_s3_url, workers=workers, max_retries=max_retries, rate_limit=rate_limit, on_progress=on_progress
+        )
+        report.operation = "move"
+        if report.status is False:
+            logger_f.error(f"(bulk_move_prefix) copy failed for {report.failed} objects, keeping sources at {src_s3_url}")
+            return report
+
+        deletion = self.bulk_delete_prefix(src_s3_url, workers=workers, max_retries=max_retries, rate_limit=rate_limit)
+        report.failed += deletion.failed
+        report.errors += deletion.errors
+        report.status = report.failed == 0
+        return report
+
+    def bulk_delete_prefix(
+        self,
+        s3_url: str,
+        workers: int = 4,
+        max_retries: int = 3,
+        rate_limit: float | None = None,
+        on_progress: Callable[[BulkReport], Any] | None = None,
+    ) -> BulkReport:
+        """Delete every object under `s3_url`, by batches of 1000 keys (one `delete_objects` request each)
+
+        Args:
+            s3_url (str): url of the prefix formatted as `<my_s3>://<bucket_name>/<key>`
+
+        Returns:
+            BulkReport: counts and errors of the operation
+        """
+        bucket, _ = self._bulk_prefix(s3_url)
+        return self._bulk_run(
+            BulkReport(operation="delete", source=s3_url),
+            self._bulk_delete_tasks(bucket, self.iter_s3_objects_at_prefix(s3_url)),
+            workers=workers, max_retries=max_retries, rate_limit=rate_limit, on_progress=on_progress,
+        )
+
+    def bulk_download_prefix(
+        self,
+        s3_url: str,
+        local_dir: str | Path,
+        workers: int = 16,
+        max_retries: int = 3,
+        rate_limit: float | None = None,
+        on_progress: Callable[[BulkReport], Any] | None = None,
+    ) -> BulkReport:
+        """Download every object under `s3_url` into `local_dir`, keeping the relative keys as paths.
+        Files already present with the same size are skipped, keys resolving outside of `local_dir`
+        (`..` segments, absolute keys) are rejected and counted as failed. Objects compressed at rest
+        are written decoded, they are skipped if the local file matches their logical size (`logical_size`),
+        and the reported bytes are the decoded bytes written.
+
+        Args:
+            s3_url (str): url of the prefix formatted as `<my_s3>://<bucket_name>/<key>`
+            local_dir (str | Path): destination directory, created if needed
+
+        Returns:
+            BulkReport: counts, bytes and errors of the operation
+        """
+        bucket, prefix = self._bulk_prefix(s3_url)
+        local_dir = Path(local_dir).resolve()
+
+        def download_task(obj: dict, path: Path):
+            def task():
+                if path.is_file():  # compressed at rest, the listed size is not the size of the decoded file
+                    head = self.client.head_object(Bucket=bucket, Key=obj["Key"])
+                    if self.logical_size(head) == path.stat().st_size:
+                        return None
+                path.parent.mkdir(parents=True, exist_ok=True)
+                resp = self.client.get_object(Bucket=bucket, Key=obj["Key"])
+                codec = resp.get("Metadata", {}).get("biglake-codec") or resp.get("ContentEncoding")
+                with open(path, "wb") as fout:
+                    shutil.copyfileobj(self.decompress_reader(resp["Body"], codec), fout, 1024 * 1024)
+                    return 1, fout.tell()
+
+            return task
+
+        def rejected_task(obj: dict):
+            def task():
+                raise ValueError(f"key resolves outside of {local_dir}")
+
+            return task
+
+        def is_up_to_date(path: Path, obj: dict) -> bool:
+            return path.is_file() and path.stat().st_size == obj["Size"]
+
+        tasks = (
+            (obj, rejected_task(obj) if not path.is_relative_to(local_dir)
+             else None if is_up_to_date(path, obj) else download_task(obj, path))
+            for obj in self.iter_s3_objects_at_prefix(s3_url)
+            if not obj["Key"].endswith("/")
+            for path in [(local_dir / obj["Key"][len(prefix):]).resolve()]
+        )
+        return self._bulk_run(
+            BulkReport(operation="download", source=s3_url, destination=str(local_dir)),
+            tasks, workers=workers, max_retries=max_retries, rate_limit=rate_limit, on_progress=on_progress,
+        )
+
+    def _bulk_prefix(self, s3_url: str) -> Tuple[str, str]:
+        bucket, key = self.parse_url_s3_as_bucket_and_filename(s3_url)
+        if key and not key.endswith("/"):
+            key = key + "/"
+        return bucket, key
+
+    def _bulk_copy_task(self, obj: dict, src_bucket: str, dst_bucket: str, dst_key: str):
+        def task():
+            copy_source = {"Bucket": src_bucket, "Key": obj["Key"]}
+            if obj["Size"] < 5 * 1024**3:
+                self.client.copy_object(CopySource=copy_source, Bucket=dst_bucket, Key=dst_key)
+            else:  # single request copies are limited to 5GiB, fall back on the multipart managed copy
+                self.client.copy(copy_source, dst_bucket, dst_key)
+            return 1, obj["Size"]
+
+        return task
+
+    def _bulk_delete_tasks(self, bucket: str, objects):
+        """Group listed objects by 1000, the maximum of keys of a `delete_objects` request"""
+        while batch := list(itertools.islice(objects, 1000)):
+
+            def task(batch=batch):
+                resp = self.client.delete_objects(
+                    Bucket=bucket,
+                    Delete={"Objects": [{"Key": obj["Key"]} for obj in batch], "Quiet": True},
+                )
+                if resp.get("Errors"):
+                    raise RuntimeError(
+                        f"{len(resp['Errors'])} keys not deleted, first error={resp['Errors'][0]}"
+                    )
+                return len(batch), 0
+
+            yield batch, task
+
+    def _bulk_run(
+        self,
+        report: BulkReport,
+        tasks,
+        workers: int,
+        max_retries: int,
+        rate_limit: float | None,
+        on_progress: Callable[[BulkReport], Any] | None = None,
+        progress_every: int = 500,
+    ) -> BulkReport:
+        """Run the `(object(s), task)` pairs yielded by a lazy listing on a pool of workers.
+        At most `2 * workers` tasks are in flight, so the listing is consumed at the pace of the transfers.
+        A `None` task, or a task returning `None`, means the object is already up to date.
+        """
+        limiter = _RateLimiter(rate_limit)
+        start = time.monotonic()
+        last_progress = 0
+
+        def run_with_retry(task):
+            for attempt in range(max_retries + 1):
+                limiter.acquire()
+                try:
+                    return task()
+                except Exception as e:
+                    if attempt == max_retries or not _is_retryable(e):
+                        raise
+                    logger_f.warning(f"({report.operation}) retry {attempt + 1}/{max_retries} after error={e}")
+                    time.sleep(min(0.2 * 2**attempt, 5.0))
+
+        def account(future, objs):
+            n = len(objs) if isinstance(objs, list) else 1
+            try:
+                result = future.result()
+                if result is None:
+                    report.skipped += n
+                    return
+                done, nbytes = result
+                report.transferred += done
+                report.bytes += nbytes
+            except Exception as e:
+                report.failed += n
+                report.errors.append(f"{objs[0]['Key'] if isinstance(objs, list) else objs['Key']}: {e}")
+                logger_f.error(f"({report.operation}) failed on {n} object(s) from {report.source}, error={e}")
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            in_flight = {}
+            for objs, task in tasks:
+                report.listed += len(objs) if isinstance(objs, list) else 1
+                if task is None:
+                    report.skipped += 1
+                    continue
+                in_flight[executor.submit(run_with_retry, task)] = objs
+
+                if len(in_flight) >= 2 * workers:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        account(future, in_flight.pop(future))
+
+                if report.listed - last_progress >= progress_every:
+                    last_progress = report.listed
+                    report.duration = time.monotonic() - start
+                    logger_f.info(
+                        f"({report.operation}) {report.source} listed={report.listed} transferred={report.transferred} "
+                        f"skipped={report.skipped} failed={report.failed} bytes={report.bytes}"
+                    )
+                    if on_progress is not None:
+                        on_progress(report)
+
+            for future in as_completed(in_flight):
+                account(future, in_flight[future])
+
+        report.duration = time.monotonic() - start
+        report.status = report.failed == 0
+        logger_f.info(
+            f"({report.operation}) done {report.source} -> {report.destination} listed={report.listed} "
+            f"transferred={report.transferred} skipped={report.skipped} failed={report.failed} "
+            f"bytes={report.bytes} in {report.duration:.1f}s"
+        )
+        if on_progress is not None:
+            on_progress(report)
+        return report
 
     # ---------------------------------------------------------
     # UPLOAD
@@ -335,52 +885,253 @@ class S3(CloudUpload):
                 detail=f"File destination shall be written in a 'uri_ressource' field in json-params ; exception={e}",
             )
 
+        extra_args = self.config.get("extra_args", {})
+        body = file.file
         try:
-            extra_args = self.config.get("extra_args", {})
+            file.file.seek(0, io.SEEK_END)
+            file_size = file.file.tell()
+            file.file.seek(0)
+            codec = self.compression_codec_for(fileobj=file.file, key=key_s3)
+            scanner = GeometryStatsScanner.for_key(key_s3)
+            if codec is not None:
+                body = await asyncio.to_thread(self.compress_fileobj, file.file, codec, scanner=scanner)
+                extra_args = extra_args | {
+                    "ContentEncoding": codec,
+                    "Metadata": extra_args.get("Metadata", {})
+                    | {"biglake-codec": codec, "biglake-size": str(file_size)},  # logical size, read back by `logical_size`
+                }
+            elif scanner is not None:
+                await asyncio.to_thread(self.scan_fileobj, file.file, scanner)
+
+            geometry_stats = scanner.result() if scanner is not None else None
+            if geometry_stats is not None:
+                extra_args = extra_args | {
+                    "Metadata": extra_args.get("Metadata", {}) | geometry_stats.to_s3_metadata()
+                }
             await asyncio.to_thread(
                 self.client.upload_fileobj,
-                file.file,
+                body,
                 Bucket=bucket_s3,
                 Key=key_s3,
                 ExtraArgs=extra_args,
             )
             s3_file_head = self.client.head_object(Bucket=bucket_s3, Key=key_s3)
-            uploaded_file_size = s3_file_head["ContentLength"]
+            uploaded_file_size = file_size if codec is not None else s3_file_head["ContentLength"]
             s3_displayed_delivery_url = f"s3://{bucket_s3}{key_s3}"
             return FileData(
                 url=s3_displayed_delivery_url,
                 message=f"{key_s3} uploaded successfully",
                 filename=key_s3,
                 content_type=str(file.content_type),
+                content_encoding=codec or "",
+                geometry_stats=geometry_stats,
                 size=uploaded_file_size,
             )
         except AttributeError as aerr:
-            logger_f.warning(aerr)
-            print(aerr)
+            logger_f.warning(f"(upload) {aerr}, retrying the upload of {key_s3} with ExtraArgs={extra_args}")
+            body.seek(0)
             self.client.upload_fileobj(
-                file.file, bucket_s3, key_s3, ExtraArgs=extra_args
+                body, bucket_s3, key_s3, ExtraArgs=extra_args
             )
         except Exception as err:
             logger_f.error(err)
-            print(err)
             return FileData(
                 status=False, error=str(err), message="File upload was unsuccessful"
             )
+        finally:
+            if body is not file.file:
+                body.close()
 
     async def multi_upload(self, *, files: list[UploadFile]):
         tasks = [asyncio.create_task(self.upload(file=file)) for file in files]
         return await asyncio.gather(*tasks)
 
+    # ---------------------------------------------------------
+    # COMPRESSION
+    # ---------------------------------------------------------
+    def compression_codec_for(self, fileobj, key: str) -> str | None:
+        """Codec to store an uploaded file with, None when stored as is.
+        Only text geometries are compressed (.pts, .xyz and ascii .ply), binaries barely shrink.
+
+        Args:
+            fileobj (file-like): seekable uploaded file, left at position 0
+            key (str): s3 key of the upload
+
+        Returns:
+            str | None: 'gzip', 'zstd' or None
+        """
+        if not self.config.get("compress_text_geometries", False):
+            return None
+
+        match Path(key).suffix.lower():
+            case ".pts" | ".xyz":
+                pass
+            case ".ply":
+                head = fileobj.read(512)
+                fileobj.seek(0)
+                if b"format ascii" not in head:
+                    return None
+            case _:
+                return None
+
+        codec = self.config.get("compression_codec", "gzip")
+        if codec == "zstd" and not self.is_internal_key(key):
+            codec = "gzip"  # may be presigned, browsers and http clients would get zstd bytes
+        return codec
+
+    def is_internal_key(self, key: str) -> bool:
+        """True for keys under `compression_internal_prefixes`, objects that are never presigned"""
+        return any(key.startswith(prefix) for prefix in self.config.get("compression_internal_prefixes", []))
+
+    def compress_fileobj(
+        self, fileobj, codec: str, chunk_size: int = 1024 * 1024, scanner: "GeometryStatsScanner | None" = None
+    ):
+        """Compress a file by chunks into a spooled temporary file (in memory up to 64MiB)
+
+        Args:
+            fileobj (file-like): file to compress, read from its current position
+            codec (str): 'gzip' or 'zstd'
+            chunk_size (int, optional): read size. Defaults to 1MiB.
+            scanner (GeometryStatsScanner | None, optional): also fed with every chunk read. Defaults to None.
+
+        Returns:
+            SpooledTemporaryFile: compressed content, at position 0
+        """
+        compressed = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+        match codec:
+            case "gzip":
+                writer = gzip.GzipFile(
+                    fileobj=compressed, mode="wb", mtime=0,
+                    compresslevel=self.config.get("compression_level", 6),
+                )
+            case "zstd":
+                writer = zstandard.ZstdCompressor(
+                    level=self.config.get("compression_level", 3)
+                ).stream_writer(compressed, closefd=False)
+            case _:
+                raise ValueError(f"Unsupported compression codec={codec}")
+        with writer:
+            while chunk := fileobj.read(chunk_size):
+                writer.write(chunk)
+                if scanner is not None:
+                    scanner.feed(chunk)
+        compressed.seek(0)
+        return compressed
+
+    def scan_fileobj(self, fileobj, scanner: "GeometryStatsScanner", chunk_size: int = 1024 * 1024):
+        """Feed a file by chunks to a scanner, then rewind it for the upload"""
+        while chunk := fileobj.read(chunk_size):
+            scanner.feed(chunk)
+        fileobj.seek(0)
+
+    def get_geometry_stats(self, s3_url: str) -> GeometryStats | None:
+        """Statistics stored in the metadata of a geometry at upload time, a HEAD request, nothing is downloaded
+
+        Args:
+            s3_url (str): url of a s3 object formatted as `<my_s3>://<bucket_name>/<key>`
+
+        Returns:
+            GeometryStats | None: None for geometries uploaded without statistics
+        """
+        bucket, key = self.parse_url_s3_as_bucket_and_filename(s3_url)
+        try:
+            head = self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as ce:
+            logger_f.warning(f"No head for s3_url={s3_url}, error={ce}")
+            return None
+        return GeometryStats.from_s3_metadata(head.get("Metadata", {}))
+
+    def decompress_reader(self, fileobj, codec: str | None):
+        """Wrap a binary stream with the streaming decoder of `codec`, None or unknown codecs return it as is"""
+        match codec:
+            case "gzip":
+                return gzip.GzipFile(fileobj=fileobj, mode="rb")
+            case "zstd":
+                return io.BufferedReader(
+                    zstandard.ZstdDecompressor().stream_reader(
+                        fileobj, read_across_frames=True, closefd=False
+                    )
+                )  # line reads for the text parsers
+            case _:
+                return fileobj
+
+    @staticmethod
+    def logical_size(head: dict) -> int | None:
+        """Size of an object once decoded, from its `head_object` response. None for an object
+        compressed at rest before its logical size was recorded in its metadata
+        """
+        metadata = head.get("Metadata", {})
+        if metadata.get("biglake-codec") or head.get("ContentEncoding"):
+            size = metadata.get("biglake-size")
+            return int(size) if size is not None else None
+        return head.get("ContentLength")
+
+    @contextmanager
+    def open_geometry(self, s3_url: str, mode: str = "rb"):
+        """Open a stored geometry for streaming reads, transparently decoding the codec it was stored with.
+        The raw stream is opened with compression='disable' so smart_open never guesses from the key suffix.
+
+        Args:
+            s3_url (str): url of a s3 object formatted as `<my_s3>://<bucket_name>/<key>`
+            mode (str, optional): "rb" or "r" (utf-8 text). Defaults to "rb".
+
+        Yields:
+            file-like: decoded content
+        """
+        bucket, key = self.parse_url_s3_as_bucket_and_filename(s3_url)
+        head = self.client.head_object(Bucket=bucket, Key=key)
+        codec = head.get("Metadata", {}).get("biglake-codec") or head.get("ContentEncoding")
+
+        with smart_open.open(
+            s3_url, "rb", transport_params=dict(client=self.client), compression="disable"
+        ) as raw:
+            decoded = self.decompress_reader(raw, codec)
+            try:
+                if "b" in mode:
+                    yield decoded
+                else:
+                    yield io.TextIOWrapper(decoded, encoding="utf-8")
+            finally:
+                if decoded is not raw:
+                    decoded.close()
+
     # ---------------------------------------------------------
     # DOWNLOAD
     # ---------------------------------------------------------
-    def create_presigned_url(self, s3_url: str, expiration: int = 3600):
+    def create_presigned_url(
+        self, s3_url: str, expiration: int = 3600, method: str = "get_object"
+    ):
+        """Presigned url of an s3 object, served from cache while the cached signature is still valid.
+        Returning the same url for the same object lets browsers and CDNs cache the downloaded
+        content, a new signature would be a new url and a cache miss each time. Urls are cached per
+        requested expiration, and a cached one is served only while it stays valid for more than
+        the refresh margin (at most half of `expiration`).
+
+        Args:
+            s3_url (str): url of a s3 object formatted as `<my_s3>://<bucket_name>/<key>`
+            expiration (int, optional): validity of a newly signed url in seconds. Defaults to 3600.
+            method (str, optional): s3 client method to presign. Defaults to "get_object".
+
+        Returns:
+            str | None: the presigned url, None if the signature failed or the object is internal
+        """
         bucket_name, object_name = self.parse_url_s3_as_bucket_and_filename(s=s3_url)
-        # return self.parse_url_s3(s=s3_url)
+        if method == "get_object" and self.is_internal_key(object_name):
+            logger_f.error(f"(create_presigned_url) {s3_url} is internal, it may be stored with 'zstd', not presigning it")
+            return None
+        cache_key = (bucket_name, object_name, method, expiration)
+        margin = self.config.get("presigned_refresh_margin", 300)
+        refresh_margin = min(margin, expiration / 2)
+
+        now = time.time()
+        with self._presigned_lock:
+            cached = self._presigned_cache.get(cache_key)
+        if cached is not None and now < cached[1] - refresh_margin:
+            return cached[0]
 
         try:
             response = self.client.generate_presigned_url(
-                "get_object",
+                method,
                 Params={"Bucket": bucket_name, "Key": object_name},
                 ExpiresIn=expiration,
             )
@@ -391,9 +1142,40 @@ class S3(CloudUpload):
             logger_f.error(e)
             return None
 
+        maxsize = self.config.get("presigned_cache_maxsize", 4096)
+        with self._presigned_lock:
+            if len(self._presigned_cache) >= maxsize:
+                self._presigned_cache = {
+                    k: v for k, v in self._presigned_cache.items() if now < v[1] - min(margin, k[3] / 2)
+                }  # drop stale signatures first
+                while len(self._presigned_cache) >= maxsize:
+                    self._presigned_cache.pop(next(iter(self._presigned_cache)))  # then the oldest ones
+            self._presigned_cache[cache_key] = (response, now + expiration)
+
         # The response contains the presigned URL
         return response
 
+    def create_presigned_urls(
+        self, s3_urls: list[str], expiration: int = 3600, method: str = "get_object"
+    ) -> dict[str, str | None]:
+        """Batch version of `create_presigned_url` for listing endpoints, signing is local
+        (no request to s3) so cached and new urls are simply resolved in one pass.
+
+        Args:
+            s3_urls (list[str]): urls of s3 objects formatted as `<my_s3>://<bucket_name>/<key>`
+            expiration (int, optional): validity of newly signed urls in seconds. Defaults to 3600.
+            method (str, optional): s3 client method to presign. Defaults to "get_object".
+
+        Returns:
+            dict[str, str | None]: presigned url for each s3 url
+        """
+        return {
+            s3_url: self.create_presigned_url(
+                s3_url=s3_url, expiration=expiration, method=method
+            )
+            for s3_url in dict.fromkeys(s3_urls)
+        }
+
     ## --------------------------------------------------------
     ## DOWNLOAD Geometries
     ## --------------------------------------------------------
@@ -401,9 +1183,7 @@ class S3(CloudUpload):
         try:
             s3_url_suffix = Path(s3_url).suffix
             # extra_args = self.config.get("extra_args", {})
-            with smart_open.open(
-                s3_url, "r", transport_params=dict(client=self.client)
-            ) as fin:
+            with self.open_geometry(s3_url, "r") as fin:
                 match s3_url_suffix:
                     case ".pts":
                         np_table = np.genfromtxt(fin, delimiter=" ")
@@ -469,9 +1249,7 @@ class S3(CloudUpload):
         if allow_bool:
             ply_dtypes[b"bool"] = "?"
 
-        with smart_open.open(
-            s3_url, "rb", transport_params=dict(client=self.client)
-        ) as ply:
+        with self.open_geometry(s3_url, "rb") as ply:
             # with smart_open.open(filename, 'rb') as ply:
             if b"ply" not in ply.readline():
                 raise ValueError("The file does not start with the word ply")
@@ -561,9 +1339,7 @@ class S3(CloudUpload):
 
             names = [x[0] for x in dtypes["vertex"]]
 
-            with smart_open.open(
-                s3_url, "rb", transport_params=dict(client=self.client)
-            ) as dply:
+            with self.open_geometry(s3_url, "rb") as dply:
                 data["points"] = pd.read_csv(
                     dply,
                     sep=" ",
@@ -585,15 +1361,16 @@ class S3(CloudUpload):
                 usecols = [1, 2, 3, 5, 6, 7, 8, 9, 10] if has_texture else [1, 2, 3]
                 names = names[usecols]
 
-                data["mesh"] = pd.read_csv(
-                    s3_url,
-                    sep=" ",
-                    header=None,
-                    engine="python",
-                    skiprows=top,
-                    usecols=usecols,
-                    names=names,
-                )
+                with self.open_geometry(s3_url, "rb") as mply:
+                    data["mesh"] = pd.read_csv(
+                        mply,
+                        sep=" ",
+                        header=None,
+                        engine="python",
+                        skiprows=top,
+                        usecols=usecols,
+                        names=names,
+                    )
 
                 for n, col in enumerate(data["mesh"].columns):
                     data["mesh"][col] = data["mesh"][col].astype(
@@ -603,9 +1380,7 @@ class S3(CloudUpload):
         else:
             # with open(s3_url, 'rb') as ply:
             logger_f.debug(f"(smart_read_ply) bin .ply file at url={s3_url}")
-            with smart_open.open(
-                s3_url, "rb", transport_params=dict(client=self.client)
-            ) as ply:
+            with self.open_geometry(s3_url, "rb") as ply:
                 ply.seek(end_header)
                 # points_np = np.fromfile(ply, dtype=dtypes["vertex"], count=points_size)
                 points_np = np.frombuffer(
@@ -651,6 +1426,201 @@ class S3(CloudUpload):
         return element
 
 
+class GeometryStatsScanner:
+    """Incremental statistics of a point cloud fed by chunks of its file, for .ply (ascii or binary), .pts and .xyz.
+    Only the vertex coordinates are parsed, in blocks, faces and other properties are skipped.
+    """
+
+    ply_dtypes = {
+        b"int8": "i1", b"char": "i1", b"uint8": "u1", b"uchar": "u1",
+        b"int16": "i2", b"short": "i2", b"uint16": "u2", b"ushort": "u2",
+        b"int32": "i4", b"int": "i4", b"uint32": "u4", b"uint": "u4",
+        b"float32": "f4", b"float": "f4", b"float64": "f8", b"double": "f8",
+    }
+
+    def __init__(self, geometry_format: str):
+        self.geometry_format = geometry_format  # "ply", "pts" or "xyz"
+        self._buffer = b""
+        self._in_header = geometry_format == "ply"
+        self._ascii = geometry_format != "ply"
+        self._vertex_dtype = None
+        self._vertices_left = None  # None: unbounded, text formats
+        self._n_columns = None
+        self._first_line = True
+        self._error = None
+        self.stats = GeometryStats(dtype="ascii" if self._ascii else "")
+        self._min = np.full(3, np.inf)
+        self._max = np.full(3, -np.inf)
+        self._sum = np.zeros(3)
+
+    @classmethod
+    def for_key(cls, key: str) -> "GeometryStatsScanner | None":
+        match Path(key).suffix.lower():
+            case ".ply":
+                return cls("ply")
+            case ".pts":
+                return cls("pts")
+            case ".xyz":
+                return cls("xyz")
+            case _:
+                return None
+
+    def feed(self, chunk: bytes):
+        if self._error is not None or self._vertices_left == 0:
+            return
+        try:
+            self._buffer += chunk
+            if self._in_header:
+                self._parse_ply_header()
+            if not self._in_header:
+                self._parse_body()
+        except Exception as e:
+            self._error = e
+            logger_f.warning(f"(GeometryStatsScanner) statistics skipped, unparsable {self.geometry_format}: {e}")
+
+    def result(self) -> GeometryStats | None:
+        if self._error is not None or self._in_header:
+            return None
+        if self._buffer and self._ascii:
+            self._buffer += b"\n"  # last line without a line break
+            self._parse_body()
+        if self.stats.count > 0:
+            self.stats.bbox_min = tuple(float(v) for v in self._min)
+            self.stats.bbox_max = tuple(float(v) for v in self._max)
+            self.stats.centroid = tuple(float(v) for v in self._sum / self.stats.count)
+        return self.stats
+
+    def _parse_ply_header(self):
+        end = self._buffer.find(b"end_header")
+        if end == -1:
+            return
+        end = self._buffer.find(b"\n", end) + 1
+        if end == 0:
+            return  # the chunk ends right after `end_header`, wait for its line break
+        header, self._buffer = self._buffer[:end], self._buffer[end:]
+        self._in_header = False
+
+        element, fields = None, []
+        for line in header.splitlines():
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == b"format":
+                self._ascii = words[1] == b"ascii"
+                byteorder = {b"binary_big_endian": ">", b"binary_little_endian": "<"}.get(words[1], "")
+            elif words[0] == b"element":
+                if element is None and words[1] != b"vertex":
+                    raise ValueError(f"vertex is not the first element, first element={words[1].decode()}")
+                element = words[1]
+                if element == b"vertex":
+                    self._vertices_left = int(words[2])
+            elif words[0] == b"property" and element == b"vertex":
+                if words[1] == b"list":
+                    raise ValueError("list properties on vertices are not supported")
+                fields.append((words[2].decode(), byteorder + self.ply_dtypes[words[1]]))
+
+        names = [name for name, _ in fields]
+        if not {"x", "y", "z"} <= set(names):
+            raise ValueError(f"no x, y, z vertex properties, properties={names}")
+        self.stats.properties = names
+        self._xyz = [names.index("x"), names.index("y"), names.index("z")]
+        if self._ascii:
+            self.stats.dtype = "ascii"
+            self._n_columns = len(names)
+        else:
+            self._vertex_dtype = np.dtype(fields)
+            self.stats.dtype = np.dtype(dict(fields)["x"]).name
+
+    def _parse_body(self):
+        if self._ascii:
+            cut = self._buffer.rfind(b"\n") + 1
+            if cut == 0:
+                return
+            block, self._buffer = self._buffer[:cut], self._buffer[cut:]
+            lines = block.splitlines()
+            if self._first_line:
+                self._first_line = False
+                if self.geometry_format != "ply" and len(lines[0].replace(b",", b" ").split()) < 3:
+                    lines = lines[1:]  # .pts files may start with the number of points
+            if self._vertices_left is not None:
+                lines = lines[: self._vertices_left]
+                self._vertices_left -= len(lines)
+            lines = [line for line in lines if line.strip()]
+            if not lines:
+                return
+            if self._n_columns is None:
+                self._n_columns = len(lines[0].replace(b",", b" ").split())
+                self.stats.properties = [f"col{i}" for i in range(self._n_columns)]
+                self._xyz = [0, 1, 2]
+            values = np.array(b" ".join(lines).replace(b",", b" ").replace(b";", b" ").split(), dtype=np.float64)
+            points = values.reshape(-1, self._n_columns)[:, self._xyz]
+        else:
+            n = min(len(self._buffer) // self._vertex_dtype.itemsize, self._vertices_left)
+            if n == 0:
+                return
+            records = np.frombuffer(self._buffer, dtype=self._vertex_dtype, count=n)
+            self._buffer = self._buffer[n * self._vertex_dtype.itemsize:]
+            self._vertices_left -= n
+            points = np.column_stack([records[name].astype(np.float64) for name in ("x", "y", "z")])
+            if self._vertices_left == 0:
+                self._buffer = b""  # faces and other elements are not scanned
+
+        self.stats.count += len(points)
+        self._min = np.minimum(self._min, points.min(axis=0))
+        self._max = np.maximum(self._max, points.max(axis=0))
+        self._sum += points.sum(axis=0)
+
+
+class _RateLimiter:
+    """Token bucket shared by the workers of a bulk operation, `rate` requests per second (None: no limit)"""
+
+    def __init__(self, rate: float | None = None):
+        self.rate = rate
+        self._tokens = rate or 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait_time = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def _is_retryable(e: Exception) -> bool:
+    """Throttling, timeouts and server-side errors are worth a retry, missing keys or denied access are not"""
+    if isinstance(e, ClientError):
+        code = e.response.get("Error", {}).get("Code", "")
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return code in ("SlowDown", "Throttling", "RequestTimeout", "InternalError", "ServiceUnavailable") or status >= 500
+    return isinstance(e, (BotoCoreError, ConnectionError, TimeoutError))
+
+
+class _ArchiveChunks:
+    """Write-only, unseekable file object collecting what an archive writer produces until `pop`"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
 #    __              __
 #   / /__  _______ _/ /
 #  / / _ \/ __/ _ `/ /
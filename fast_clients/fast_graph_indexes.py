@@ -0,0 +1,593 @@
+# 1.0.dev304.6
+
+import sys, re
+from bisect import bisect_left, insort
+from difflib import SequenceMatcher, get_close_matches
+from itertools import islice
+import threading
+import unicodedata
+import time
+
+from app.loggers import logger_t  # Import
+
+# logger_t = logging.getLogger()  # Declare
+# logger_t.setLevel(logging.INFO)  # Declare
+
+from rdflib import URIRef
+
+from typing import Mapping, Iterator, NamedTuple
+
+
+# In-memory indexes
+class RefreshedIndex:
+    """Base of the in-process indexes built from the store: `refresh()` is run in a background
+    thread when the index is missing, marked stale, or `refresh_interval` has elapsed since the last check.
+    Readers keep being served the previous index until the new one is complete.
+    When graph versions are shared through store markers, the fingerprint is only queried once they changed.
+    """
+
+    def __init__(self, store: "TripleStore", refresh_interval: float):
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self.fingerprint: tuple | None = None
+        self.graph_version: tuple | None = None
+        self.checked_at = 0.0
+        self._stale = True
+        self._refreshing = threading.Lock()
+
+    @property
+    def is_ready(self) -> bool:
+        return self.fingerprint is not None
+
+    def indexed_graphs(self) -> list[str]:
+        return [self.named_graph_uri]
+
+    def store_fingerprint(self) -> tuple:
+        raise NotImplementedError
+
+    def load(self):
+        raise NotImplementedError
+
+    def refresh(self, force: bool = False) -> bool:
+        """Reload if the indexed data changed (or if `force`), returns True if reloaded"""
+        with self._refreshing:
+            self.checked_at = time.monotonic()
+            version = self.store.graph_versions.version(self.indexed_graphs())
+            unchanged = version == self.graph_version
+            if force or self._stale or (not unchanged and self.store_fingerprint() != self.fingerprint):
+                self.load()
+                self._stale = False
+                self.graph_version = version
+                return True
+            self.graph_version = version
+            return False
+
+    def maybe_refresh(self):
+        """Non-blocking: start a background refresh when the index is missing, stale or due for a check"""
+        due = time.monotonic() - self.checked_at >= self.refresh_interval
+        if (self._stale or due) and not self._refreshing.locked():
+            self.checked_at = time.monotonic()  # one check per interval, even if it fails
+            threading.Thread(target=self._refresh_quietly, daemon=True).start()
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger_t.error(f"{type(self).__name__} refresh failed: {type(e)} {e}")
+
+    def mark_stale(self):
+        self._stale = True
+
+    def update(self, uris: list[str]):
+        """Re-read some indexed entities only"""
+        raise NotImplementedError
+
+    def on_ingestion(self, subject_uris: list[str] | None = None):
+        """Non-blocking: re-read the entities touched by an ingestion job, then reload everything
+        if the store's fingerprint still differs from the index's one (or if the entities are unknown)
+        """
+
+        def run():
+            try:
+                if subject_uris:
+                    self.update(subject_uris)
+                self.refresh(force=not subject_uris)
+            except Exception as e:
+                logger_t.error(f"{type(self).__name__} update failed: {type(e)} {e}")
+                self.mark_stale()
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+class ThesaurusMirror(RefreshedIndex):
+    """In-process index of thesaurus graphs: concept URI -> preferred labels per language,
+    alternative labels and broader concepts. Rows are enriched locally instead of joining
+    the thesaurus graphs in every query. The index is rebuilt in the background when
+    `refresh_interval` has elapsed and the graphs' fingerprint (triple counts) changed.
+    """
+
+    LOAD_QUERY = """PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+SELECT ?concept ?p ?o (LANG(?o) AS ?lang) WHERE {
+    VALUES ?p { skos:prefLabel skos:altLabel rdfs:label skos:broader }
+    ?concept ?p ?o .
+}"""
+    FINGERPRINT_QUERY = "SELECT (COUNT(*) AS ?n) WHERE { ?s ?p ?o }"
+    SKOS = "http://www.w3.org/2004/02/skos/core#"
+
+    def __init__(
+        self,
+        store: "TripleStore",
+        graphs: list[str],
+        refresh_interval: float = 3600.0,
+        languages: tuple[str, ...] = ("fr", "en", ""),
+    ):
+        super().__init__(store, refresh_interval)
+        self.graphs = frozenset(graphs)
+        self.languages = languages
+        self._labels: dict[str, dict[str, str]] = {}
+        self._alt_labels: dict[str, tuple[str, ...]] = {}
+        self._broader: dict[str, tuple[str, ...]] = {}
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def indexed_graphs(self) -> list[str]:
+        return sorted(self.graphs)
+
+    def store_fingerprint(self) -> tuple:
+        return tuple(
+            self.store.select_rows(self.FINGERPRINT_QUERY, g)[1][0]["n"]
+            for g in sorted(self.graphs)
+        )
+
+    def load(self):
+        """Rebuild the index from the store, the previous index is served until the new one is complete"""
+        fingerprint = self.store_fingerprint()
+        labels, alt_labels, broader = {}, {}, {}
+        for g in sorted(self.graphs):
+            _, rows = self.store.select_rows(self.LOAD_QUERY, g)
+            for row in rows:
+                concept = sys.intern(row["concept"])
+                match row["p"]:
+                    case p if p == self.SKOS + "broader":
+                        broader.setdefault(concept, []).append(sys.intern(row["o"]))
+                    case p if p == self.SKOS + "altLabel":
+                        alt_labels.setdefault(concept, []).append(str(row["o"]))
+                    case p if p == self.SKOS + "prefLabel":
+                        labels.setdefault(concept, {})[row["lang"] or ""] = str(row["o"])
+                    case _:  # rdfs:label, only when no skos:prefLabel in that language
+                        labels.setdefault(concept, {}).setdefault(row["lang"] or "", str(row["o"]))
+
+        self._labels = labels
+        self._alt_labels = {c: tuple(v) for c, v in alt_labels.items()}
+        self._broader = {c: tuple(v) for c, v in broader.items()}
+        self.fingerprint = fingerprint
+        self.store.result_cache.invalidate()  # cached rows carry the previous labels
+        logger_t.info(f"Thesaurus mirror loaded {len(labels)} concepts from {sorted(self.graphs)}")
+
+    # Lookups
+    def label(self, concept: str, lang: str | None = None) -> str | None:
+        labels = self._labels.get(concept)
+        if not labels:
+            return None
+        for language in ((lang,) if lang is not None else ()) + self.languages:
+            if language in labels:
+                return labels[language]
+        return next(iter(labels.values()))
+
+    def labels(self, concept: str) -> dict[str, str]:
+        return dict(self._labels.get(concept, {}))
+
+    def alt_labels(self, concept: str) -> tuple[str, ...]:
+        return self._alt_labels.get(concept, ())
+
+    def broader(self, concept: str) -> tuple[str, ...]:
+        return self._broader.get(concept, ())
+
+    def ancestors(self, concept: str) -> list[str]:
+        seen, todo = [], list(self.broader(concept))
+        while todo:
+            c = todo.pop(0)
+            if c not in seen:
+                seen.append(c)
+                todo.extend(self.broader(c))
+        return seen
+
+    def enrich(
+        self, rows: list[dict], fields: Mapping[str, str], lang: str | None = None
+    ) -> list[dict]:
+        """Fill label columns from concept columns, e.g. `{"feature_type": "feature_type_label"}`,
+        values already bound by the query are kept
+        """
+        for row in rows:
+            for concept_field, label_field in fields.items():
+                if row.get(label_field) is None and row.get(concept_field) is not None:
+                    row[label_field] = self.label(row[concept_field], lang)
+        return rows
+
+class BuiltworkTree(NamedTuple):
+    """One version of the builtwork trees, never changed once published"""
+
+    parent: dict[str, str | None]
+    children: dict[str, tuple[str, ...]]  # sorted by label
+    labels: dict[str, str | None]
+    geometries: dict[str, int]
+    roots: tuple[str, ...]
+
+
+class BuiltworkHierarchy(RefreshedIndex):
+    """In-process index of the builtwork trees (`acrm:P89_falls_within`): parent, children sorted by label,
+    labels and geometry counts. Built from one bulk query, then updated per builtwork after ingestions
+    (`update`), tree and part requests no longer reach the store.
+    The maps are one immutable `BuiltworkTree`: updates build a new one and swap it in,
+    a lookup reads the tree it started with and never sees it change.
+    """
+
+    PREFIXES = """PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX acrm: <http://astragale.cnrs.fr/sem/acrm/>
+"""
+    LOAD_QUERY = PREFIXES + """SELECT ?builtwork (SAMPLE(?p) AS ?parent) (SAMPLE(?l) AS ?label) (COUNT(DISTINCT ?geometry) AS ?geometries) WHERE {
+    ?builtwork a acrm:E22_HumanMadeObject .
+    OPTIONAL { ?builtwork acrm:P89_falls_within ?p }
+    OPTIONAL { ?builtwork rdfs:label ?l }
+    OPTIONAL { ?geometry acrm:P138_represents ?builtwork }
+} GROUP BY ?builtwork"""
+    FINGERPRINT_QUERY = PREFIXES + """SELECT (COUNT(DISTINCT ?b) AS ?builtworks) (COUNT(DISTINCT ?child) AS ?parts) (COUNT(DISTINCT ?represents) AS ?geometries) WHERE {
+    ?b a acrm:E22_HumanMadeObject .
+    { } UNION { ?b acrm:P89_falls_within ?p BIND(?b AS ?child) } UNION { ?g acrm:P138_represents ?b BIND(CONCAT(STR(?g), " ", STR(?b)) AS ?represents) }
+}"""  # counted as the index counts them, see `index_fingerprint`
+
+    def __init__(self, store: "TripleStore", named_graph_uri: str, refresh_interval: float = 600.0):
+        super().__init__(store, refresh_interval)
+        self.named_graph_uri = named_graph_uri
+        self._tree = BuiltworkTree({}, {}, {}, {}, ())
+        self._updating = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._tree.parent)
+
+    def __contains__(self, uri: str) -> bool:
+        return uri in self._tree.parent
+
+    def store_fingerprint(self) -> tuple:
+        row = self.store.select_rows(self.FINGERPRINT_QUERY, self.named_graph_uri)[1][0]
+        return (row["builtworks"], row["parts"], row["geometries"])
+
+    def index_fingerprint(self) -> tuple:
+        """Fingerprint of what the index holds, equal to the store's one when nothing else changed"""
+        tree = self._tree
+        return (
+            len(tree.parent),
+            sum(1 for p in tree.parent.values() if p is not None),
+            sum(tree.geometries.values()),
+        )
+
+    def load(self):
+        """Rebuild the whole index from the store"""
+        fingerprint = self.store_fingerprint()
+        _, rows = self.store.select_rows(self.LOAD_QUERY, self.named_graph_uri)
+        parent, labels, geometries, children = {}, {}, {}, {}
+        for row in rows:
+            uri = sys.intern(row["builtwork"])
+            parent[uri] = row["parent"]
+            labels[uri] = row["label"]
+            geometries[uri] = row["geometries"] or 0
+            if row["parent"] is not None:
+                children.setdefault(row["parent"], []).append(uri)
+        key = lambda uri: (labels.get(uri) or "", uri)
+        children = {p: tuple(sorted(siblings, key=key)) for p, siblings in children.items()}
+        roots = tuple(sorted((u for u, p in parent.items() if p is None or p not in parent), key=key))
+
+        with self._updating:
+            self._tree = BuiltworkTree(parent, children, labels, geometries, roots)
+            self.fingerprint = fingerprint
+        logger_t.info(f"Builtwork hierarchy loaded {len(parent)} builtworks, {len(roots)} roots")
+
+    def update(self, uris: list[str]):
+        """Re-read the given builtworks only (new, moved, relabelled, new geometries, deleted)"""
+        if len(uris) == 0 or not self.is_ready:
+            return
+        _, rows = self.store.select_rows(
+            self.store.bind_values(self.LOAD_QUERY, [{"builtwork": URIRef(u)} for u in uris]),
+            self.named_graph_uri,
+        )
+        found = {row["builtwork"]: row for row in rows}
+        with self._updating:
+            # copy-on-write: new maps, the sibling tuples are replaced, never changed
+            tree = self._tree
+            parent, children = dict(tree.parent), dict(tree.children)
+            labels, geometries, roots = dict(tree.labels), dict(tree.geometries), list(tree.roots)
+            for uri in uris:
+                self._detach(parent, children, labels, geometries, roots, uri)
+                if uri not in found:
+                    continue
+                row = found[uri]
+                parent[uri] = row["parent"]
+                labels[uri] = row["label"]
+                geometries[uri] = row["geometries"] or 0
+                self._attach(parent, children, labels, roots, uri)
+            self._tree = BuiltworkTree(parent, children, labels, geometries, tuple(roots))
+            # not the store's fingerprint: writes to other builtworks still differ and trigger a reload
+            self.fingerprint = self.index_fingerprint()
+        logger_t.debug(f"Builtwork hierarchy updated {len(found)}/{len(uris)} builtworks")
+
+    # A builtwork is always in the children of its parent, even when the parent is not indexed (yet),
+    # and it is a root while its parent is not indexed: orphans are reattached when their parent comes back
+    @staticmethod
+    def _detach(parent: dict, children: dict, labels: dict, geometries: dict, roots: list, uri: str):
+        if uri not in parent:
+            return
+        key = lambda u: (labels.get(u) or "", u)
+        uri_parent = parent.pop(uri)
+        if uri_parent is not None:
+            siblings = tuple(u for u in children.get(uri_parent, ()) if u != uri)
+            if len(siblings) > 0:
+                children[uri_parent] = siblings
+            else:
+                children.pop(uri_parent, None)
+        if uri in roots:
+            roots.remove(uri)
+        for child in children.get(uri, ()):
+            insort(roots, child, key=key)
+        labels.pop(uri, None)
+        geometries.pop(uri, None)
+
+    @staticmethod
+    def _attach(parent: dict, children: dict, labels: dict, roots: list, uri: str):
+        key = lambda u: (labels.get(u) or "", u)
+        uri_parent = parent[uri]
+        if uri_parent is not None:
+            siblings = list(children.get(uri_parent, ()))
+            insort(siblings, uri, key=key)
+            children[uri_parent] = tuple(siblings)
+        if uri_parent is None or uri_parent not in parent:
+            insort(roots, uri, key=key)
+        for child in children.get(uri, ()):
+            if child in roots:
+                roots.remove(child)
+
+    # Lookups
+    @staticmethod
+    def _node(tree: "BuiltworkTree", uri: str) -> dict:
+        return {
+            "builtwork": uri,
+            "label": tree.labels.get(uri),
+            "parent": tree.parent.get(uri),
+            "children": len(tree.children.get(uri, ())),
+            "geometries": tree.geometries.get(uri, 0),
+        }
+
+    def node(self, uri: str) -> dict:
+        return self._node(self._tree, uri)
+
+    def roots(self, offset: int = 0, limit: int | None = None) -> list[dict]:
+        tree = self._tree
+        return [self._node(tree, u) for u in tree.roots[offset : None if limit is None else offset + limit]]
+
+    def children(self, uri: str, offset: int = 0, limit: int | None = None) -> list[dict]:
+        tree = self._tree
+        siblings = tree.children.get(uri, ())
+        return [self._node(tree, u) for u in siblings[offset : None if limit is None else offset + limit]]
+
+    def ancestors(self, uri: str) -> list[str]:
+        """Parents up to the root, nearest first"""
+        tree = self._tree
+        ancestors, parent = [], tree.parent.get(uri)
+        while parent is not None and parent in tree.parent and parent not in ancestors:
+            ancestors.append(parent)
+            parent = tree.parent.get(parent)
+        return ancestors
+
+    def is_descendant(self, uri: str, ancestor: str) -> bool:
+        return ancestor in self.ancestors(uri)
+
+    def _walk(self, tree: "BuiltworkTree", uri: str, max_depth: int | None) -> Iterator[tuple[int, str]]:
+        stack = [(1, child) for child in reversed(tree.children.get(uri, ()))]
+        while stack:
+            depth, current = stack.pop()
+            yield depth, current
+            if max_depth is None or depth < max_depth:
+                stack.extend((depth + 1, c) for c in reversed(tree.children.get(current, ())))
+
+    def walk(self, uri: str, max_depth: int | None = None) -> Iterator[tuple[int, str]]:
+        """Depth-first, pre-order `(depth, uri)` of the subtree below `uri` (excluded)"""
+        return self._walk(self._tree, uri, max_depth)
+
+    def subtree(
+        self, uri: str, offset: int = 0, limit: int | None = None, max_depth: int | None = None
+    ) -> list[dict]:
+        """One page of the subtree below `uri`, in depth-first order"""
+        tree = self._tree
+        page = islice(self._walk(tree, uri, max_depth), offset, None if limit is None else offset + limit)
+        return [self._node(tree, u) | {"depth": depth} for depth, u in page]
+
+class LabelIndex(NamedTuple):
+    """One version of the label search maps, never changed once published"""
+
+    entries: dict[str, list[tuple[str, str | None]]]  # uri -> (label, type)
+    postings: dict[str, set[str]]  # token -> uris
+    vocabulary: list[str] | None  # sorted tokens, None until the next search sorts them
+    by_length: dict[int, list[str]] | None
+
+
+class LabelSearchIndex(RefreshedIndex):
+    """In-process inverted index over the labels of the instance graph (builtworks, geometries, annotations...):
+    normalized token -> entries, a sorted vocabulary for prefix matching and tokens bucketed by length
+    for fuzzy matching. Incremental updates leave the vocabulary unsorted, it is sorted on the next search.
+    The maps are one immutable `LabelIndex`: updates build a new one and swap it in,
+    a search reads the index it started with and never sees it change.
+    """
+
+    LOAD_QUERY = """PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+SELECT ?entity ?label (SAMPLE(?t) AS ?type) WHERE {
+    { ?entity rdfs:label ?label } UNION { ?entity skos:prefLabel ?label }
+    OPTIONAL { ?entity a ?t }
+} GROUP BY ?entity ?label"""
+    FINGERPRINT_QUERY = """PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+SELECT (COUNT(*) AS ?n) WHERE { { ?e rdfs:label ?l } UNION { ?e skos:prefLabel ?l } }"""
+    TOKEN_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, store: "TripleStore", named_graph_uri: str, refresh_interval: float = 600.0):
+        super().__init__(store, refresh_interval)
+        self.named_graph_uri = named_graph_uri
+        self._index = LabelIndex({}, {}, [], {})
+        self._updating = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._index.entries)
+
+    @classmethod
+    def tokens(cls, text: str) -> list[str]:
+        """Casefolded, accent-free words"""
+        text = unicodedata.normalize("NFKD", text.casefold())
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        return cls.TOKEN_PATTERN.findall(text)
+
+    def store_fingerprint(self) -> tuple:
+        return (self.store.select_rows(self.FINGERPRINT_QUERY, self.named_graph_uri)[1][0]["n"],)
+
+    @classmethod
+    def _add(cls, entries: dict, postings: dict, uri: str, label: str, type: str | None):
+        entries.setdefault(uri, []).append((label, type))
+        for token in cls.tokens(label):
+            postings.setdefault(token, set()).add(uri)
+
+    @classmethod
+    def _remove(cls, entries: dict, postings: dict, uri: str):
+        for label, _ in entries.pop(uri, []):
+            for token in cls.tokens(label):
+                uris = postings.get(token)
+                if uris is not None:
+                    uris.discard(uri)
+                    if len(uris) == 0:
+                        del postings[token]
+
+    def load(self):
+        """Rebuild the whole index from the store"""
+        fingerprint = self.store_fingerprint()
+        _, rows = self.store.select_rows(self.LOAD_QUERY, self.named_graph_uri)
+        entries, postings = {}, {}
+        for row in rows:
+            self._add(entries, postings, sys.intern(row["entity"]), str(row["label"]), row["type"])
+        with self._updating:
+            self._index = LabelIndex(entries, postings, None, None)
+            self.fingerprint = fingerprint
+        logger_t.info(f"Label search index loaded {len(rows)} labels, {len(postings)} tokens")
+
+    def update(self, uris: list[str]):
+        """Re-read the labels of the given entities"""
+        if len(uris) == 0 or not self.is_ready:
+            return
+        _, rows = self.store.select_rows(
+            self.store.bind_values(self.LOAD_QUERY, [{"entity": URIRef(u)} for u in uris]),
+            self.named_graph_uri,
+        )
+        with self._updating:
+            index = self._index
+            touched = {uri: index.entries[uri] for uri in uris if uri in index.entries}
+            touched_tokens = {t for labels in touched.values() for label, _ in labels for t in self.tokens(label)}
+            touched_tokens |= {t for row in rows for t in self.tokens(str(row["label"]))}
+            # copy-on-write: only the posting sets of the touched tokens are copied
+            entries = dict(index.entries)
+            postings = dict(index.postings)
+            for token in touched_tokens:
+                if token in postings:
+                    postings[token] = set(postings[token])
+            for uri in uris:
+                self._remove(entries, postings, uri)
+            for row in rows:
+                self._add(entries, postings, row["entity"], str(row["label"]), row["type"])
+            self._index = LabelIndex(entries, postings, None, None)
+
+    def _sorted(self, index: LabelIndex) -> LabelIndex:
+        """`index` with its vocabulary, published unless an update replaced it meanwhile"""
+        if index.vocabulary is not None:
+            return index
+        vocabulary = sorted(index.postings)
+        by_length = {}
+        for token in vocabulary:
+            by_length.setdefault(len(token), []).append(token)
+        index = index._replace(vocabulary=vocabulary, by_length=by_length)
+        with self._updating:
+            if self._index.postings is index.postings:
+                self._index = index
+        return index
+
+    @staticmethod
+    def _matches(
+        token: str,
+        prefix: bool,
+        fuzzy: bool,
+        postings: dict[str, set[str]],
+        vocabulary: list[str],
+        by_length: dict[int, list[str]],
+    ) -> dict[str, float]:
+        """Vocabulary tokens matching `token` with their score: exact 1, prefix 0.8, fuzzy up to 0.6"""
+        matches = {}
+        if token in postings:
+            matches[token] = 1.0
+        if prefix:
+            i = bisect_left(vocabulary, token)
+            while i < len(vocabulary) and vocabulary[i].startswith(token):
+                matches.setdefault(vocabulary[i], 0.8)
+                i += 1
+        if fuzzy and len(matches) == 0 and len(token) > 2:
+            candidates = [
+                t for n in range(len(token) - 2, len(token) + 3) for t in by_length.get(n, [])
+            ]
+            for t in get_close_matches(token, candidates, n=10, cutoff=0.75):
+                matches[t] = 0.6 * SequenceMatcher(None, token, t).ratio()
+        return matches
+
+    def search(
+        self,
+        q: str,
+        limit: int = 20,
+        types: list[str] | None = None,
+        fuzzy: bool = True,
+    ) -> list[dict]:
+        """Entities whose labels match every word of `q`, the last word as a prefix (autocomplete)
+
+        Args:
+            q (str): searched text
+            limit (int, optional): number of results. Defaults to 20.
+            types (list[str] | None, optional): only entities of these classes. Defaults to None.
+            fuzzy (bool, optional): tolerate typos on words without exact or prefix match. Defaults to True.
+
+        Returns:
+            list[dict]: `{"uri", "label", "type", "score"}` best first
+        """
+        query_tokens = self.tokens(q)
+        if len(query_tokens) == 0:
+            return []
+        entries, postings, vocabulary, by_length = self._sorted(self._index)  # one consistent version
+
+        scores = None
+        for n, token in enumerate(query_tokens):
+            token_scores = {}
+            matches = self._matches(token, n == len(query_tokens) - 1, fuzzy, postings, vocabulary, by_length)
+            for match, score in matches.items():
+                for uri in postings.get(match, ()):
+                    token_scores[uri] = max(token_scores.get(uri, 0.0), score)
+            scores = (
+                token_scores
+                if scores is None
+                else {uri: s + token_scores[uri] for uri, s in scores.items() if uri in token_scores}
+            )
+            if len(scores) == 0:
+                return []
+
+        q_norm = " ".join(query_tokens)
+        results = []
+        for uri, score in scores.items():
+            label, type = min(entries.get(uri, [("", None)]), key=lambda e: len(e[0]))
+            if types is not None and type not in types:
+                continue
+            if " ".join(self.tokens(label)).startswith(q_norm):
+                score += 0.5  # the label starts with the searched text
+            results.append({"uri": uri, "label": label, "type": type, "score": round(score, 3)})
+        results.sort(key=lambda r: (-r["score"], len(r["label"]), r["label"]))
+        return results[:limit]
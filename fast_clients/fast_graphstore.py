@@ -0,0 +1,537 @@
+# 1.0.dev304.6
+
+import re, json
+from abc import ABC, abstractmethod
+from string import Template
+
+import requests
+
+from urllib.error import URLError
+
+from app.loggers import logger_t  # Import
+
+# logger_t = logging.getLogger()  # Declare
+# logger_t.setLevel(logging.INFO)  # Declare
+
+from rdflib import Graph, Literal, URIRef
+from rdflib.plugins.sparql.processor import SPARQLResult
+
+import pandas as pd
+
+from typing import Optional, Mapping, Any
+
+try:
+    from functools import cache
+except ImportError:
+    from functools import lru_cache
+
+    cache = lru_cache(maxsize=None)
+
+from fast_clients.fast_sparql import (
+    SparqlTemplateRegistry,
+    literal_to_python,
+    slots_to_variables,
+    values_block,
+)
+from fast_clients.fast_sparql_async import ASYNC_CONNECTION_ERRORS
+from fast_clients.fast_query_cache import QueryResultCache
+from fast_clients.fast_query_profiler import QueryProfiler
+
+
+class GraphStore(ABC):
+    @abstractmethod
+    def __init__(self, **kwargs):
+        """"""
+
+    # Select
+    @abstractmethod
+    def select_templated(
+        self,
+        query_filename: str,
+        format: str = "dataframe",
+        override_named_graph_uri: Optional[str] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        """"""
+
+    @abstractmethod
+    def select_templated_parametrized(
+        self,
+        query_filename: str,
+        format: str = "dataframe",
+        enforce_parameters: Mapping[str, Any] | list[Mapping[str, Any]] | None = None,
+        override_named_graph_uri: Optional[str] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        """Select with query variables bound to `enforce_parameters`, one mapping or a list of mappings (one row each).
+        Values are bound, never pasted into the query: `URIRef` and strings holding an absolute `http(s)://` or `urn:` IRI
+        are IRIs, other values are literals, `None` leaves the variable free.
+        """
+
+    # Update
+    @abstractmethod
+    def update_static(
+        self,
+        query_string: str,
+    ) -> pd.DataFrame:
+        """"""
+
+    @abstractmethod
+    def update_templated(self, query_filename: str, **kwargs) -> pd.DataFrame:
+        """"""
+
+    @property
+    @cache
+    def profiler(self) -> QueryProfiler:
+        return QueryProfiler(
+            samples=self.config.get("query_profile_samples", 1024),
+            slow_seconds=self.config.get("query_profile_slow_seconds"),
+        )
+
+    # Templates
+    @property
+    @cache
+    def select_templates(self) -> SparqlTemplateRegistry:
+        return SparqlTemplateRegistry(
+            self.config["datapip_sparql_select_path"],
+            check_interval=self.config.get("sparql_templates_check_interval", 2.0),
+        ).load()
+
+    @property
+    @cache
+    def update_templates(self) -> SparqlTemplateRegistry:
+        return SparqlTemplateRegistry(
+            self.config["datapip_sparql_update_path"],
+            check_interval=self.config.get("sparql_templates_check_interval", 2.0),
+        ).load()
+
+    def load_templates(self):
+        """Compile the configured template directories up front, instead of on the first request"""
+        if "datapip_sparql_select_path" in self.config:
+            self.select_templates
+        if "datapip_sparql_update_path" in self.config:
+            self.update_templates
+
+    def _render_select_template(self, query_filename: str, kwargs: dict) -> str:
+        template = self.select_templates.get(query_filename)
+        if len(kwargs) == 0:
+            return template.text
+        return template.substitute(kwargs)
+
+    def _render_update_template(
+        self, query_filename: str, kwargs: dict, terms: bool = False
+    ) -> tuple[str, dict]:
+        """Update template filled with `kwargs` and newly minted URIs, as escaped SPARQL terms if `terms`
+        (see `SparqlTemplate.substitute_terms`)
+        """
+        template = self.update_templates.get(query_filename)
+        uris = template.mint_uris(self.config["default_triples_root_uri"])
+        logger_t.debug(f"Created {len(uris)} URIs : {uris}")
+
+        supdate = (template.substitute_terms if terms else template.substitute)(kwargs | uris)
+        logger_t.debug(f"--- --- SUBSTITUED TEMPLATE CONTENT --- ---\n{supdate}")
+        return supdate, uris
+
+    # Batched selects
+    BATCH_VARIABLE_PREFIX = "_bind_"
+    AGGREGATE_PATTERN = re.compile(
+        r"(?is)\(\s*(COUNT|SUM|MIN|MAX|AVG|SAMPLE|GROUP_CONCAT)\s*\(.*?\)\s*AS\s+\?(\w+)\s*\)"
+    )
+    EMPTY_AGGREGATES = {"COUNT": 0, "SUM": 0, "AVG": 0, "GROUP_CONCAT": ""}  # others are unbound
+
+    def _batch_query(
+        self, query_filename: str, keys: list[str], kwargs: dict
+    ) -> tuple[str, dict[str, str], dict | None]:
+        """Template of `select_many` with the slots of the batched keys turned into projected variables.
+        A slot is either an IRI `<$key>` or a quoted literal `"$key"`.
+        An aggregate over the whole solution set (no GROUP BY) is grouped by the batched variables.
+
+        Returns:
+            tuple[str, dict[str, str], dict | None]: query without its VALUES block, kind of each key ('iri' or 'literal'),
+                and for an aggregate without GROUP BY, the row of an input row without any solution
+        """
+        try:
+            text, kinds = slots_to_variables(
+                self.select_templates.get(query_filename).text, keys, self.BATCH_VARIABLE_PREFIX
+            )
+        except ValueError as e:
+            raise ValueError(f"SPARQL template {query_filename} cannot be batched: {e}")
+        query_string = Template(text).substitute(kwargs)
+
+        # Project the batched variables, results are split back on them
+        tail = query_string[query_string.rindex("}") :]
+        if re.search(r"(?i)\b(LIMIT|OFFSET)\b", tail) is not None:
+            raise ValueError(
+                f"SPARQL template {query_filename} has a LIMIT/OFFSET, its results cannot be split per row"
+            )
+        variables = " ".join(f"?{self.BATCH_VARIABLE_PREFIX}{key}" for key in keys)
+        select = re.search(r"(?i)\bSELECT\s+((DISTINCT|REDUCED)\s+)?", query_string)
+        if not query_string[select.end() :].startswith("*"):
+            query_string = (
+                query_string[: select.end()] + variables + " " + query_string[select.end() :]
+            )
+        group_by = re.search(r"(?i)\bGROUP\s+BY\s+", tail)
+        aggregates = self.AGGREGATE_PATTERN.findall(
+            query_string[select.end() : self._where_clause_position(query_string)]
+        )
+        empty = None
+        if group_by is not None:
+            position = query_string.rindex("}") + group_by.end()
+            query_string = query_string[:position] + variables + " " + query_string[position:]
+        elif len(aggregates) > 0:  # one group per input row, instead of one for all of them
+            position = query_string.rindex("}") + 1
+            query_string = query_string[:position] + f"\nGROUP BY {variables}" + query_string[position:]
+            empty = {var: self.EMPTY_AGGREGATES.get(name.upper()) for name, var in aggregates}
+        return query_string, kinds, empty
+
+    def _batch_bindings(
+        self, keys: list[str], kinds: dict[str, str], distinct_rows: list[tuple]
+    ) -> list[dict]:
+        return [
+            {
+                f"{self.BATCH_VARIABLE_PREFIX}{key}": URIRef(value)
+                if kinds[key] == "iri"
+                else Literal(value)
+                for key, value in zip(keys, row)
+            }
+            for row in distinct_rows
+        ]
+
+    def _batch_split(
+        self,
+        keys: list[str],
+        rows: list[Mapping[str, Any]],
+        variables: list[str],
+        results: list[dict],
+        format: str,
+        empty: dict | None = None,
+    ) -> list:
+        batch_variables = [f"{self.BATCH_VARIABLE_PREFIX}{key}" for key in keys]
+        by_row: dict[tuple, list[dict]] = {}
+        for result in results:
+            row_key = tuple(str(result.pop(var)) for var in batch_variables)
+            by_row.setdefault(row_key, []).append(result)
+        variables = [var for var in variables if var not in batch_variables]
+        return [
+            self.sparql_rows_to(
+                variables,
+                QueryResultCache._copy(
+                    by_row.get(tuple(str(row[key]) for key in keys), [] if empty is None else [empty])
+                ),
+                format,
+            )
+            for row in rows
+        ]
+
+    @staticmethod
+    def _batch_chunks(
+        keys: list[str], rows: list[Mapping[str, Any]], chunk_size: int
+    ) -> list[list[tuple]]:
+        distinct_rows = list(dict.fromkeys(tuple(str(row[key]) for key in keys) for row in rows))
+        return [
+            distinct_rows[i : i + chunk_size]
+            for i in range(0, len(distinct_rows), chunk_size)
+        ]
+
+    # Utils
+    def get_target_named_graphs(self, named_graph_uri: str) -> Graph:
+        logger_t.info(f"named_graph_uri={named_graph_uri}")
+        g = Graph(
+            store=self.client,
+            identifier=named_graph_uri,  # .lstrip('/'),
+            bind_namespaces="none",
+        )  # Do not load default rdflib namespaces, keep queries self-contained
+        return g
+
+    def query_target_named_graphs(
+        self, query_string: str, named_graph_uri: str | list[str]
+    ) -> SPARQLResult:
+        """Query one named graph, or the union of several named graphs resolved by the store itself.
+        A list of graphs is sent as `FROM` clauses of the query: only results cross the wire,
+        where a union of rdflib `Graph` objects would first download every triple of every graph.
+
+        Args:
+            query_string (str): SPARQL query
+            named_graph_uri (str | list[str]): named graph(s) queried as the default graph
+
+        Returns:
+            SPARQLResult: _description_
+        """
+        if isinstance(named_graph_uri, str):
+            return self.get_target_named_graphs(named_graph_uri).query(query_string)
+        logger_t.info(f"named_graph_uri={named_graph_uri}")
+        return self.client.query(
+            self.inject_dataset_clauses(query_string, named_graph_uri)
+        )  # no `default-graph-uri` sent, it would override the `FROM` clauses
+
+    def inject_dataset_clauses(
+        self,
+        query_string: str,
+        default_graph_uris: list[str],
+        named_graph_uris: list[str] | None = None,
+    ) -> str:
+        """Add `FROM <g>` (and `FROM NAMED <g>`) dataset clauses to a query, right before its WHERE clause
+
+        Args:
+            query_string (str): SPARQL query, SELECT, CONSTRUCT, DESCRIBE or ASK
+            default_graph_uris (list[str]): graphs merged as the default graph
+            named_graph_uris (list[str] | None, optional): graphs reachable with `GRAPH` patterns. Defaults to None.
+
+        Returns:
+            str: the query with its dataset
+        """
+        clauses = "".join(f"FROM <{g}>\n" for g in default_graph_uris) + "".join(
+            f"FROM NAMED <{g}>\n" for g in (named_graph_uris or [])
+        )
+        position = self._where_clause_position(query_string)
+        return query_string[:position] + clauses + query_string[position:]
+
+    @staticmethod
+    def parameter_rows(
+        query_string: str,
+        parameters: Mapping[str, Any] | list[Mapping[str, Any]],
+    ) -> tuple[list[str], list[Mapping[str, Any]]]:
+        """Variables and rows to bind: variables absent from the query are left out,
+        `None` values leave their variable unbound (`UNDEF`)
+        """
+        rows = [parameters] if isinstance(parameters, Mapping) else list(parameters)
+        variables = []
+        for row in rows:
+            for var in row:
+                if var not in variables:
+                    variables.append(var)
+        unknown = [
+            var for var in variables
+            if re.search(rf"[?$]{re.escape(var)}\b", query_string) is None
+        ]
+        if len(unknown) > 0:
+            logger_t.warning(f"Parameters {unknown} are not variables of the query, ignored")
+        return [var for var in variables if var not in unknown], rows
+
+    def bind_values(
+        self,
+        query_string: str,
+        parameters: Mapping[str, Any] | list[Mapping[str, Any]],
+    ) -> str:
+        """Bind query variables with a `VALUES` block at the top of the WHERE clause.
+        The query text only depends on the bound variables, one query binds many rows at once.
+
+        Args:
+            query_string (str): SPARQL query
+            parameters (Mapping[str, Any] | list[Mapping[str, Any]]): variable name (without `?`) to value, or a list of them
+
+        Returns:
+            str: the query with its inline data
+        """
+        variables, rows = self.parameter_rows(query_string, parameters)
+        if len(variables) == 0 or len(rows) == 0:
+            return query_string
+        position = query_string.index("{", self._where_clause_position(query_string)) + 1
+        return (
+            query_string[:position]
+            + "\n"
+            + values_block(variables, rows)
+            + query_string[position:]
+        )
+
+    @staticmethod
+    def _where_clause_position(query_string: str) -> int:
+        """Index of the WHERE clause (keyword or opening brace) of a query, skipping IRIs, strings,
+        comments and the template of a CONSTRUCT query
+        """
+        keyword = re.compile(r"(?i)(WHERE|CONSTRUCT)\b")
+        construct_template, template_depth = False, 0
+        i, n = 0, len(query_string)
+        while i < n:
+            c = query_string[i]
+            if c == "#":
+                i = query_string.find("\n", i)
+                i = n if i == -1 else i
+            elif c == "<":
+                j = query_string.find(">", i)
+                if j != -1 and not any(ch.isspace() for ch in query_string[i + 1 : j]):
+                    i = j  # IRI
+            elif c in "\"'":
+                j = i + 1
+                while j < n and query_string[j] != c:
+                    j += 2 if query_string[j] == "\\" else 1
+                i = j
+            elif c == "{":
+                if not construct_template and template_depth == 0:
+                    return i
+                construct_template = False
+                template_depth += 1  # the template is scanned as the rest: braces in its strings are skipped
+            elif c == "}" and template_depth > 0:
+                template_depth -= 1
+            elif template_depth > 0:
+                pass
+            elif (c.isalpha() and (i == 0 or not (query_string[i - 1].isalnum() or query_string[i - 1] in "_?$:"))):
+                m = keyword.match(query_string, i)
+                if m is not None and m.group(1).upper() == "WHERE":
+                    return i
+                if m is not None:
+                    construct_template = query_string[m.end() :].lstrip().startswith("{")
+                    i = m.end() - 1
+            i += 1
+        raise ValueError(f"No WHERE clause found in query:\n{query_string}")
+
+
+    # Results
+    def sparql_results_to(self, results: SPARQLResult, format: str = "dataframe"):
+        if format == "dataframe":
+            return self.sparql_results_to_df(results)
+        variables = [str(x) for x in results.vars]
+        rows = [
+            {
+                var: self.term_to_python(term)
+                for var, term in zip(variables, row)
+            }
+            for row in results
+        ]
+        return self.sparql_rows_to(variables, rows, format)
+
+    def sparql_rows_to(
+        self, variables: list[str], rows: list[dict], format: str = "dataframe"
+    ):
+        """Output rows of Python values in the requested format, pandas is only imported into it for `dataframe`
+
+        Args:
+            variables (list[str]): projected variables, columns of the dataframe
+            rows (list[dict]): rows as given by `sparql_json_to_rows`
+            format (str, optional): 'dict', 'json' or 'dataframe'. Defaults to "dataframe".
+        """
+        match format:
+            case "dict":
+                return rows
+            case "json":
+                return json.dumps(rows, ensure_ascii=False)
+            case "dataframe":
+                return pd.DataFrame(rows, columns=variables)
+            case _:
+                logger_t.warning(
+                    f"Unrecoginzed format={format}, defaulting to 'dataframe' output"
+                )
+                return pd.DataFrame(rows, columns=variables)
+
+    @staticmethod
+    def term_to_python(term):
+        if term is None:
+            return None
+        if isinstance(term, Literal):
+            return literal_to_python(
+                str(term), None if term.datatype is None else str(term.datatype)
+            )
+        return str(term)  # URIRef, BNode
+
+    def sparql_results_to_df(self, results: SPARQLResult) -> pd.DataFrame:
+        """Export results from an rdflib SPARQL query into a `pandas.DataFrame`,
+            using Python types. See https://github.com/RDFLib/rdflib/issues/1179.
+
+        Args:
+            results (SPARQLResult): _description_
+
+        Returns:
+            DataFrame: _description_
+        """
+        return pd.DataFrame(
+            data=(
+                [None if x is None else x.toPython() for x in row] for row in results
+            ),
+            columns=[str(x) for x in results.vars],
+        )
+
+    def sparql_results_to_json(self, results: SPARQLResult) -> str:
+        """Export results from an rdflib SPARQL query into a JSON string of records
+
+        Args:
+            results (SPARQLResult): _description_
+
+        Returns:
+            str: _description_
+        """
+        return self.sparql_results_to(results, format="json")
+
+    def sparql_results_to_dict(self, results: SPARQLResult) -> list[dict]:
+        """Export results from an rdflib SPARQL query into a list of records
+
+        Args:
+            results (SPARQLResult): _description_
+
+        Returns:
+            list[dict]: _description_
+        """
+        return self.sparql_results_to(results, format="dict")
+
+    # Exception handling
+    def raise_exceptions_query(func):
+        def wrapper(self, *args, **kwargs):
+            """Profiles the call, logs its failure with the store's context and re-raises it
+
+            Raises:
+                FileNotFoundError, URLError, KeyError, ValueError: and any other error of the call
+            """
+            query_filename = kwargs.get("query_filename", args[0] if args else "")
+            try:
+                return self.profiler.call(
+                    QueryProfiler.name_of(func, args, kwargs), func, self, *args, **kwargs
+                )
+            except FileNotFoundError as fnfe:
+                logger_t.error(f"{type(fnfe)} {fnfe}")
+                logger_t.error(f"No SPARQL file found at path: {fnfe.filename}")
+                raise
+            except (URLError, requests.ConnectionError) as ue:
+                logger_t.error(f"{type(ue)} {ue}")
+                logger_t.error(
+                    f"Error connecting RDF-graph database: query_endpoint={self.config_store['query_endpoint']}, update_endpoint={self.config_store['update_endpoint']}"
+                )
+                raise
+            except KeyError as ke:
+                logger_t.error(f"{type(ke)} {ke}")
+                logger_t.error(
+                    f"JSON data input is not compliant with the Data Pipeline Schema for data substitution: schema={query_filename.split('.')[0]}"
+                )
+                # logger_t.error(
+                #     f"Please, check missing value \n{Template(s).safe_substitute(kwargs)}"
+                # )
+                raise
+            except ValueError as ve:
+                logger_t.error(f"{type(ve)} {ve}")
+                logger_t.error(
+                    f"Check connexion with the TripleStore: query_endpoint={self.config_store['query_endpoint']}, update_endpoint={self.config_store['update_endpoint']}"
+                )
+                raise
+            except Exception as e:
+                logger_t.error(f"Unhandled error: {type(e)} {e}")
+                raise
+
+        return wrapper
+
+    def raise_exceptions_aquery(func):
+        async def wrapper(self, *args, **kwargs):
+            """Async counterpart of `raise_exceptions_query`, cancellation is never caught"""
+            query_filename = kwargs.get("query_filename", args[0] if args else "")
+            try:
+                return await self.profiler.acall(
+                    QueryProfiler.name_of(func, args, kwargs), func, self, *args, **kwargs
+                )
+            except FileNotFoundError as fnfe:
+                logger_t.error(f"{type(fnfe)} {fnfe}")
+                logger_t.error(f"No SPARQL file found at path: {fnfe.filename}")
+                raise
+            except ASYNC_CONNECTION_ERRORS as ue:
+                logger_t.error(f"{type(ue)} {ue}")
+                logger_t.error(
+                    f"Error connecting RDF-graph database: query_endpoint={self.config_store['query_endpoint']}, update_endpoint={self.config_store['update_endpoint']}"
+                )
+                raise
+            except KeyError as ke:
+                logger_t.error(f"{type(ke)} {ke}")
+                logger_t.error(
+                    f"JSON data input is not compliant with the Data Pipeline Schema for data substitution: schema={query_filename.split('.')[0]}"
+                )
+                raise
+            except Exception as e:
+                logger_t.error(f"Unhandled error: {type(e)} {e}")
+                raise
+
+        return wrapper
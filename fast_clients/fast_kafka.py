@@ -153,7 +153,7 @@ class KafkaAio():
             # print(e.message, e.args)
             print(e)
 
-    async def produce_message_str(self, topic: str, key: str, value: str):
+    async def produce_message_str(self, topic: str, key: str, value: str, headers: list[tuple[str, bytes]] | None = None):
         """Simple wrapper for Kafka Producer
         note: override the send_and_wait to avoid the unreadable ValueError due to async or bad bytes format
 
@@ -161,13 +161,14 @@ class KafkaAio():
             topic (str): the Kafka topic name, aimed for message production
             key (str): Kafka message key, encoded in utf-8
             value (str): Kafka message value, encoded in utf-8
+            headers (list[tuple[str, bytes]] | None): Kafka message headers, metadata kept out of the record's schema
 
         Returns:
             _type_: _description_
         """
         try:
             logger_k.info(f"AIOProducing message {key}:{value} to topic {topic}")
-            return await self._producer.send_and_wait(topic=topic, key=key.encode('utf-8'), value=value.encode('utf-8'))
+            return await self._producer.send_and_wait(topic=topic, key=key.encode('utf-8'), value=value.encode('utf-8'), headers=headers)
         except BaseException as e:
             # print(e.message, e.args)
             print(e)
@@ -0,0 +1,428 @@
+# 1.0.dev304.6
+
+import os, re, json
+import gzip
+import pickle
+from pathlib import Path
+import time
+
+from app.loggers import logger_t  # Import
+
+# logger_t = logging.getLogger()  # Declare
+# logger_t.setLevel(logging.INFO)  # Declare
+
+from rdflib import Graph, Dataset, Namespace, Literal, URIRef, BNode, Variable
+from rdflib.graph import ReadOnlyGraphAggregate
+from rdflib.plugin import PluginException
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser, ParseError, r_wspace, r_tail
+from rdflib.plugins.sparql import prepareQuery, prepareUpdate
+
+import pandas as pd
+
+from typing import Optional, Mapping, Any
+
+from fast_clients.fast_sparql import bound_term, slot_bindings, slots_to_variables
+from fast_clients.fast_graphstore import GraphStore
+
+
+class _BulkQuadsParser(W3CNTriplesParser):
+    """N-Triples/N-Quads line parser feeding `store.addN` by batches, where `Graph.parse` adds
+    and indexes the triples one by one. Triples without a graph go to `default_graph_uri`.
+    Built on rdflib internals (`r_wspace`, `r_tail`, the parser's `eat`/`readline`), hence the rdflib
+    pin in requirements.txt.
+    """
+
+    def __init__(self, dataset: Dataset, default_graph_uri: str, batch_size: int = 50000):
+        super().__init__()
+        self.dataset = dataset
+        self.default_graph = dataset.graph(URIRef(default_graph_uri))
+        self.batch_size = batch_size
+        self.count = 0
+        self._graphs = {}
+        self._batch = []
+
+    def load(self, file) -> int:
+        self.file, self.buffer = file, ""
+        while True:
+            self.line = line = self.readline()
+            if self.line is None:
+                break
+            try:
+                self.parseline()
+            except ParseError as e:
+                raise ParseError(f"Invalid line ({e}):\n{line!r}")
+        self.flush()
+        return self.count
+
+    def parseline(self, bnode_context=None):
+        self.eat(r_wspace)
+        if (not self.line) or self.line.startswith("#"):
+            return
+        subject = self.subject(bnode_context)
+        self.eat(r_wspace)
+        predicate = self.predicate()
+        self.eat(r_wspace)
+        obj = self.object(bnode_context)
+        self.eat(r_wspace)
+        context = self.uriref() or self.nodeid(bnode_context)
+        self.eat(r_tail)
+        if self.line:
+            raise ParseError("Trailing garbage")
+
+        self._batch.append((subject, predicate, obj, self._graph(context)))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def _graph(self, context) -> Graph:
+        if not context:
+            return self.default_graph
+        if context not in self._graphs:
+            self._graphs[context] = self.dataset.graph(context)
+        return self._graphs[context]
+
+    def flush(self):
+        self.dataset.store.addN(self._batch)
+        self.count += len(self._batch)
+        self._batch = []
+
+
+class LocalTripleStore(GraphStore):
+    BULK_LOAD_FORMATS = {".nt": "nt", ".nq": "nquads"}
+    SNAPSHOT_FORMAT = ("LocalTripleStore.snapshot", 1)  # bump when the encoding of the quads changes
+
+    def __init__(
+        self,
+        config: dict,
+        config_namespaces: dict[str, str] | None = None,
+        bootstrap_rdffiles: list[str | Path] | None = None,
+    ):
+        """
+        Keyword Args:
+            config (dict): A dictionnary of config settings, as for `TripleStore`
+                - ['local_store'] (str): rdflib store plugin, default "Memory". A persistent one (e.g. "BerkeleyDB",
+                    "Oxigraph" with `oxrdflib`) keeps its data between runs and is only bootstrapped again when the files change
+                - ['local_store_path'] (str): location of the persistent store
+                - ['local_snapshot_path'] (str): snapshot of the bootstrapped "Memory" store, reloaded instead
+                    of parsing `bootstrap_rdffiles` while they are unchanged
+                - ['local_bulk_load_batch_size'] (int): quads added per batch by `bulk_load`, default 50000
+                - ['local_prepare_queries'] (bool): parse select templates once and bind their slots, default True
+                - ['local_prepare_updates'] (bool): same for update templates, default False
+            config_namespaces (dict[str, str] | None): prefixes bound on the dataset
+            bootstrap_rdffiles (list[str | Path] | None): RDF files loaded at construction, N-Triples/N-Quads
+                (optionally gzipped) are streamed by `bulk_load`. Triples land in the default named graph.
+        """
+        # Config
+        self.config = config
+        try:
+            self.default_named_graph_uri = "".join(
+                [
+                    self.config["default_named_graph_root_uri"],
+                    self.config["default_named_graph_name"],
+                ]
+            )
+            self.default_triples_root_uri = self.config["default_triples_root_uri"]
+        except:
+            raise ValueError(
+                f"GraphStore Class API configuration error, cannot define default named graph with provided config, config={self.config}"
+            )
+
+        # Dataset, named graphs as on `TripleStore`
+        self.store_name = self.config.get("local_store", "Memory")
+        try:
+            self.g = Dataset(store=self.store_name, default_union=False)
+        except PluginException:
+            raise ValueError(
+                f"LocalTripleStore configuration error, rdflib store plugin local_store={self.store_name} is not installed"
+            )
+        if self.store_name != "Memory":
+            self.g.open(self.config["local_store_path"], create=True)
+
+        if config_namespaces is not None:
+            for name, uri in config_namespaces.items():
+                self.g.bind(name, Namespace(uri))
+
+        if bootstrap_rdffiles is not None:
+            self.bootstrap(bootstrap_rdffiles)
+
+        self._prepared: dict[tuple[str, str], tuple] = {}
+        self.load_templates()
+
+    def graph(self, named_graph_uri: str | list[str] | None = None) -> Graph:
+        """One named graph, or a read-only union of several ones, the default named graph if None"""
+        named_graph_uri = named_graph_uri or self.default_named_graph_uri
+        if isinstance(named_graph_uri, str):
+            return self.g.graph(URIRef(named_graph_uri))
+        return ReadOnlyGraphAggregate([self.g.graph(URIRef(uri)) for uri in named_graph_uri])
+
+    # Bootstrap
+    @staticmethod
+    def _manifest(rdffiles: list[str | Path]) -> dict:
+        manifest = {}
+        for rdffile in rdffiles:
+            stat = os.stat(rdffile)
+            manifest[str(Path(rdffile).resolve())] = [stat.st_size, stat.st_mtime_ns]
+        return manifest
+
+    def bootstrap(self, rdffiles: list[str | Path]):
+        """Load `rdffiles`, unless the persistent store or the snapshot already holds these versions of them"""
+        manifest = self._manifest(rdffiles)
+        if self.store_name != "Memory":
+            manifest_path = Path(f"{self.config['local_store_path']}.bootstrap.json")
+            if manifest_path.exists() and json.loads(manifest_path.read_text()) == manifest:
+                logger_t.info(f"Local store {self.config['local_store_path']} is up to date with {len(rdffiles)} files")
+                return
+            for context in list(self.g.contexts()):  # rebuilt from the new files
+                self.g.remove_graph(context)
+        elif "local_snapshot_path" in self.config and self.load_snapshot(manifest):
+            return
+
+        start = time.perf_counter()
+        for rdffile in rdffiles:
+            self.load_file(rdffile)
+        logger_t.info(f"Bootstrapped {len(self.g)} quads from {len(rdffiles)} files in {time.perf_counter() - start:.1f}s")
+
+        if self.store_name != "Memory":
+            self.g.commit()
+            manifest_path.write_text(json.dumps(manifest))
+        elif "local_snapshot_path" in self.config:
+            self.save_snapshot(manifest)
+
+    def load_file(self, rdffile: str | Path, named_graph_uri: str | None = None) -> int:
+        """Load one RDF file, N-Triples/N-Quads through `bulk_load`, other formats through `Graph.parse`"""
+        suffixes = Path(rdffile).suffixes
+        suffix = suffixes[-2] if suffixes[-1:] == [".gz"] and len(suffixes) > 1 else Path(rdffile).suffix
+        if suffix in self.BULK_LOAD_FORMATS:
+            return self.bulk_load(rdffile, named_graph_uri)
+        g = self.graph(named_graph_uri)
+        n = len(g)
+        g.parse(rdffile)
+        return len(g) - n
+
+    def bulk_load(self, rdffile: str | Path, named_graph_uri: str | None = None) -> int:
+        """Stream an N-Triples/N-Quads file (`.gz` included) into the store by batches of quads
+
+        Args:
+            rdffile (str | Path): `.nt`, `.nq`, `.nt.gz` or `.nq.gz` file
+            named_graph_uri (str | None, optional): graph of the triples without a graph. Defaults to None.
+
+        Returns:
+            int: number of quads read
+        """
+        parser = _BulkQuadsParser(
+            self.g,
+            named_graph_uri or self.default_named_graph_uri,
+            batch_size=self.config.get("local_bulk_load_batch_size", 50000),
+        )
+        opener = gzip.open if str(rdffile).endswith(".gz") else open
+        with opener(rdffile, "rt", encoding="utf-8") as file:
+            return parser.load(file)
+
+    # Snapshot
+    @staticmethod
+    def _encode_term(term):
+        if isinstance(term, URIRef):
+            return str(term)
+        if isinstance(term, BNode):
+            return ("_", str(term))
+        return (str(term), term.datatype and str(term.datatype), term.language)
+
+    def save_snapshot(self, manifest: dict | None = None):
+        """Write every quad to `local_snapshot_path` as plain tuples pickled under `SNAPSHOT_FORMAT`,
+        reloaded without any RDF parsing. Written next to the target then renamed, a reader never sees
+        half a snapshot.
+        """
+        encode = self._encode_term
+        quads = [
+            (encode(s), encode(p), encode(o), encode(g.identifier if isinstance(g, Graph) else g))
+            for s, p, o, g in self.g.quads()
+        ]
+        path = Path(self.config["local_snapshot_path"])
+        with open(path.with_suffix(".tmp"), "wb") as file:
+            pickle.dump(
+                {"format": self.SNAPSHOT_FORMAT, "manifest": manifest or {}, "quads": quads},
+                file,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(path.with_suffix(".tmp"), path)
+        logger_t.info(f"Saved snapshot of {len(quads)} quads to {path}")
+
+    def load_snapshot(self, manifest: dict | None = None) -> bool:
+        """Reload `local_snapshot_path` if it has the current `SNAPSHOT_FORMAT` and was made from these
+        versions of the bootstrap files, the snapshot is only a cache and is otherwise ignored
+        """
+        path = Path(self.config["local_snapshot_path"])
+        try:
+            with open(path, "rb") as file:
+                snapshot = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError, AttributeError, ImportError) as e:
+            logger_t.info(f"No usable snapshot at {path}: {type(e).__name__}")
+            return False
+        if not isinstance(snapshot, dict) or snapshot.get("format") != self.SNAPSHOT_FORMAT:
+            logger_t.info(f"Snapshot {path} has another format than {self.SNAPSHOT_FORMAT}")
+            return False
+        if manifest is not None and snapshot["manifest"] != manifest:
+            logger_t.info(f"Snapshot {path} is older than the bootstrap files")
+            return False
+
+        terms, graphs = {}, {}
+
+        def decode(x):
+            try:
+                return terms[x]  # URIs and literals repeat a lot, build each of them once
+            except KeyError:
+                if isinstance(x, str):
+                    term = URIRef(x)
+                elif x[0] == "_":
+                    term = BNode(x[1])
+                else:
+                    term = Literal(x[0], datatype=x[1], lang=x[2])
+                terms[x] = term
+                return term
+
+        def graph(x):
+            if x not in graphs:
+                graphs[x] = self.g.graph(decode(x))
+            return graphs[x]
+
+        start = time.perf_counter()
+        self.g.store.addN(
+            (decode(s), decode(p), decode(o), graph(g)) for s, p, o, g in snapshot["quads"]
+        )
+        logger_t.info(f"Loaded snapshot of {len(snapshot['quads'])} quads from {path} in {time.perf_counter() - start:.1f}s")
+        return True
+
+    # Prepared queries
+    PREPARED_VARIABLE_PREFIX = "_slot_"
+
+    def _prepared_template(self, kind: str, query_filename: str) -> tuple:
+        """Template, and its rdflib `prepareQuery`/`prepareUpdate` with its `<$x>`/`"$x"` slots turned into
+        variables bound at execution, parsed once per version of the template file. The prepared query
+        is None when the template cannot be prepared (raw SPARQL placeholders, `SELECT *`, variables in
+        `INSERT DATA`...), it is then substituted as text.
+        """
+        template = (self.select_templates if kind == "select" else self.update_templates).get(query_filename)
+        cached = self._prepared.get((kind, query_filename))
+        if cached is not None and cached[0] is template and cached[1] == template.mtime:
+            return template, cached[2], cached[3]
+
+        prepared, kinds = None, {}
+        try:
+            text, kinds = slots_to_variables(
+                template.text,
+                sorted(template.variables | template.uri_slots),
+                self.PREPARED_VARIABLE_PREFIX,
+            )
+            namespaces = dict(self.g.namespaces())
+            if kind == "update":
+                if re.search(r"(?i)\b(INSERT|DELETE)\s+DATA\b", text) is None:  # no variables in DATA blocks
+                    prepared = prepareUpdate(text, initNs=namespaces)
+            elif re.search(r"(?i)\bSELECT\s+((DISTINCT|REDUCED)\s+)?\*", text) is None:
+                prepared = prepareQuery(text, initNs=namespaces)  # `SELECT *` would project the slots
+        except Exception as e:
+            logger_t.debug(f"SPARQL template {query_filename} is substituted, not prepared: {type(e).__name__} {e}")
+        self._prepared[(kind, query_filename)] = (template, template.mtime, prepared, kinds)
+        return template, prepared, kinds
+
+    def _prepared_query(self, query_filename: str, kwargs: dict) -> tuple:
+        """Prepared select and its bindings, or None and the substituted query text"""
+        if not self.config.get("local_prepare_queries", True):
+            return None, self._render_select_template(query_filename, kwargs)
+        template, prepared, kinds = self._prepared_template("select", query_filename)
+        if prepared is None:
+            return None, self._render_select_template(query_filename, kwargs)
+        template.check(kwargs)
+        return prepared, slot_bindings(kinds, kwargs, self.PREPARED_VARIABLE_PREFIX)
+
+    def close(self):
+        """Flush and close a persistent store"""
+        if self.store_name != "Memory":
+            self.g.close(commit_pending_transaction=True)
+
+    # Select
+    @GraphStore.raise_exceptions_query
+    def select_templated(
+        self,
+        query_filename: str,
+        format: str = "dataframe",
+        override_named_graph_uri: Optional[str | list[str]] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        if "datapip_sparql_select_path" not in self.config:
+            logger_t.error(
+                f"Incomplete config for select queries, add  'datapip_sparql_select_path' to your config={self.config}"
+            )
+            return None
+
+        prepared, bindings = self._prepared_query(query_filename, kwargs)
+        if prepared is None:
+            logger_t.debug(f"Select Query:\n{bindings}")
+            qr = self.graph(override_named_graph_uri).query(bindings)
+        else:
+            qr = self.graph(override_named_graph_uri).query(prepared, initBindings=bindings)
+        return self.sparql_results_to(qr, format)
+
+    @GraphStore.raise_exceptions_query
+    def select_templated_parametrized(
+        self,
+        query_filename: str,
+        format: str = "dataframe",
+        enforce_parameters: Mapping[str, Any] | list[Mapping[str, Any]] | None = None,
+        override_named_graph_uri: Optional[str | list[str]] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        if "datapip_sparql_select_path" not in self.config:
+            logger_t.error(
+                f"Incomplete config for select queries, add  'datapip_sparql_select_path' to your config={self.config}"
+            )
+            return None
+
+        g = self.graph(override_named_graph_uri)
+        if enforce_parameters is None or isinstance(enforce_parameters, Mapping):
+            prepared, bindings = self._prepared_query(query_filename, kwargs)
+            query_string = self.select_templates.get(query_filename).text if prepared is not None else bindings
+            logger_t.debug(f"Select Query:\n{query_string}\nenforce={enforce_parameters}")
+            if prepared is None:
+                prepared, bindings = query_string, {}
+            if enforce_parameters is not None:
+                variables, _ = self.parameter_rows(query_string, enforce_parameters)
+                bindings |= {
+                    Variable(var): bound_term(enforce_parameters[var])
+                    for var in variables
+                    if enforce_parameters[var] is not None
+                }
+            qr = g.query(prepared, initBindings=bindings)  # bound by rdflib, the query text is left untouched
+        else:
+            query_string = self._render_select_template(query_filename, kwargs)
+            logger_t.debug(f"Select Query:\n{query_string}\nenforce={enforce_parameters}")
+            qr = g.query(self.bind_values(query_string, enforce_parameters))
+        return self.sparql_results_to(qr, format)
+
+    # Update
+    @GraphStore.raise_exceptions_query
+    def update_static(self, query_string: str, **kwargs):
+        self.graph().update(query_string)
+
+    @GraphStore.raise_exceptions_query
+    def update_templated(
+        self, query_filename: str, query_graph_override: str | None = None, **kwargs
+    ) -> pd.DataFrame:
+        if "datapip_sparql_update_path" not in self.config:
+            logger_t.error(
+                f"Incomplete config for select queries, add  'datapip_sparql_update_path' to your config={self.config}"
+            )
+            return None
+
+        if self.config.get("local_prepare_updates", False):
+            template, prepared, kinds = self._prepared_template("update", query_filename)
+            if prepared is not None:
+                template.check(kwargs)
+                uris = template.mint_uris(self.config["default_triples_root_uri"])
+                self.graph(query_graph_override).update(
+                    prepared,
+                    initBindings=slot_bindings(kinds, kwargs | uris, self.PREPARED_VARIABLE_PREFIX),
+                )
+                return uris
+
+        supdate, uris = self._render_update_template(query_filename, kwargs)
+        self.graph(query_graph_override).update(supdate)
+        return uris
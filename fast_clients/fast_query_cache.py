@@ -0,0 +1,300 @@
+# 1.0.dev304.6
+
+from collections import Counter, OrderedDict
+import hashlib
+import threading
+import time
+
+import asyncio
+
+from app.loggers import logger_t  # Import
+
+# logger_t = logging.getLogger()  # Declare
+# logger_t.setLevel(logging.INFO)  # Declare
+
+import pandas as pd
+
+from typing import Mapping, Any, Awaitable, Callable
+
+
+# Results cache
+class QueryResultCache:
+    """LRU cache of query results with a time-to-live, scoped by named graph.
+    Results are copied in and out, callers may mutate what they get.
+    An invalidation also drops the results of queries still running when it happened.
+    """
+
+    MISS = object()
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[float, frozenset, Any]] = OrderedDict()
+        self._keys_by_graph: dict[str, set[tuple]] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @staticmethod
+    def graphs_of(named_graph_uri: str | list[str]) -> frozenset:
+        if isinstance(named_graph_uri, str):
+            return frozenset([named_graph_uri])
+        return frozenset(named_graph_uri)
+
+    @staticmethod
+    def make_key(
+        query_name: str,
+        bindings: Mapping[str, Any],
+        named_graph_uri: str | list[str],
+        format: str,
+    ) -> tuple:
+        return (
+            query_name,
+            tuple(sorted((k, repr(v)) for k, v in bindings.items())),
+            tuple(sorted(QueryResultCache.graphs_of(named_graph_uri))),
+            format,
+        )
+
+    @staticmethod
+    def _copy(value):
+        if isinstance(value, list):
+            return [dict(row) if isinstance(row, dict) else row for row in value]
+        if isinstance(value, pd.DataFrame):
+            return value.copy()
+        return value  # str, immutable
+
+    def get(self, key: tuple):
+        if not self.enabled:
+            return self.MISS
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return self.MISS
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return self._copy(entry[2])
+
+    def put(self, key: tuple, named_graph_uri: str | list[str], value, generation: int):
+        """Store a result computed while the cache was at `generation`, returns a copy of it"""
+        if not self.enabled:
+            return value
+        graphs = self.graphs_of(named_graph_uri)
+        stored = self._copy(value)
+        with self._lock:
+            if generation != self._generation:
+                return value  # graphs changed while the query ran
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, graphs, stored)
+            for g in graphs:
+                self._keys_by_graph.setdefault(g, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+        return value
+
+    def invalidate(self, named_graph_uris: str | list[str] | None = None) -> int:
+        """Drop the results read from any of the graphs, or every result if `None`. Returns the number of dropped results"""
+        with self._lock:
+            self._generation += 1
+            if named_graph_uris is None:
+                n = len(self._entries)
+                self._entries.clear()
+                self._keys_by_graph.clear()
+                return n
+            keys = set()
+            for g in self.graphs_of(named_graph_uris):
+                keys |= self._keys_by_graph.pop(g, set())
+            for key in keys:
+                self._drop(key)
+            return len(keys)
+
+    def _drop(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for g in entry[1]:
+                keys = self._keys_by_graph.get(g)
+                if keys is not None:
+                    keys.discard(key)
+                    if len(keys) == 0:
+                        del self._keys_by_graph[g]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Graph versions
+class GraphVersions:
+    """Change version per named graph, read from the primary endpoint so that every process agrees on it.
+    The version of several graphs is the tuple of their `(graph, version)`, so one value tells a cache,
+    an index or an HTTP validator (`token`) whether anything it read from has changed.
+
+    With `marker` each graph holds a marker triple (`<graph> MARKER_PREDICATE n`), incremented by
+    `marker_update` statements sent in the same request as the writes (`TripleStore.versioned_update`).
+    Without `marker` the version of a graph is its number of triples, as the indexes' fingerprints:
+    a write keeping the number of triples (e.g. replacing a label) is not seen, use markers for that.
+    Versions are read again at most every `check_interval` seconds, right away after a write of this
+    process: writes of other processes are seen within `check_interval`, and writers bypassing
+    the store classes must increment the marker themselves.
+    """
+
+    MARKER_PREDICATE = "http://astragale.cnrs.fr/sem/inlk/graph_version"
+    MARKER_READ_QUERY = "SELECT ?v WHERE {{ <{graph}> <{predicate}> ?v }}"
+    MARKER_INCREMENT_UPDATE = """DELETE {{ GRAPH <{graph}> {{ <{graph}> <{predicate}> ?v }} }}
+INSERT {{ GRAPH <{graph}> {{ <{graph}> <{predicate}> ?n }} }}
+WHERE {{
+    OPTIONAL {{ GRAPH <{graph}> {{ <{graph}> <{predicate}> ?v }} }}
+    BIND(COALESCE(?v, 0) + 1 AS ?n)
+}}"""
+    TRIPLE_COUNT_QUERY = "SELECT (COUNT(*) AS ?v) WHERE { ?s ?p ?o }"
+
+    def __init__(self, store: "TripleStore", marker: bool = False, check_interval: float = 5.0):
+        self.store = store
+        self.marker = marker
+        self.check_interval = check_interval
+        self._versions: dict[str, int] = {}
+        self._checked_at: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def version(self, named_graph_uris: str | list[str]) -> tuple:
+        """Version of the graphs, read first from the primary if due (blocking)"""
+        graphs = QueryResultCache.graphs_of(named_graph_uris)
+        with self.store.replicas.on_primary():  # a lagging replica would answer an older version
+            for g in self._due(graphs):
+                self._store_version(g, self.store.select_rows(self._read_query(g), g)[1])
+        return self._versions_of(graphs)
+
+    async def aversion(self, named_graph_uris: str | list[str]) -> tuple:
+        """Async `version`"""
+        graphs = QueryResultCache.graphs_of(named_graph_uris)
+        due = self._due(graphs)
+        with self.store.replicas.on_primary():  # the gathered tasks copy the context
+            results = await asyncio.gather(*(self.store.aselect_rows(self._read_query(g), g) for g in due))
+        for g, (_, rows) in zip(due, results):
+            self._store_version(g, rows)
+        return self._versions_of(graphs)
+
+    def token(self, version: tuple, *variant: str) -> str:
+        """Weak ETag of a representation built from graphs at `version`, the same in every process"""
+        digest = hashlib.sha1(repr(version).encode("utf-8")).hexdigest()[:16]
+        return 'W/"' + "-".join([digest, *variant]) + '"'
+
+    def marker_update(self, named_graph_uri: str) -> str:
+        """SPARQL Update statement incrementing the marker of the graph, empty without `marker`"""
+        if not self.marker:
+            return ""
+        return self.MARKER_INCREMENT_UPDATE.format(graph=named_graph_uri, predicate=self.MARKER_PREDICATE)
+
+    def bump(self, named_graph_uris: str | list[str] | None = None):
+        """Record a write to the graphs, to every known graph if `None`: their markers are read on the next `version`"""
+        with self._lock:
+            if named_graph_uris is None:
+                self._checked_at.clear()
+            else:
+                for g in QueryResultCache.graphs_of(named_graph_uris):
+                    self._checked_at.pop(g, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"marker": self.marker, "graphs": dict(self._versions)}
+
+    def _read_query(self, named_graph_uri: str) -> str:
+        if not self.marker:
+            return self.TRIPLE_COUNT_QUERY
+        return self.MARKER_READ_QUERY.format(graph=named_graph_uri, predicate=self.MARKER_PREDICATE)
+
+    def _store_version(self, named_graph_uri: str, rows: list[dict]):
+        stored = max((int(row["v"]) for row in rows if row.get("v") is not None), default=0)
+        with self._lock:
+            self._versions[named_graph_uri] = stored
+            self._checked_at[named_graph_uri] = time.monotonic()
+
+    def _due(self, graphs: frozenset) -> list[str]:
+        now = time.monotonic()
+        with self._lock:
+            return sorted(g for g in graphs if now - self._checked_at.get(g, -self.check_interval) >= self.check_interval)
+
+    def _versions_of(self, graphs: frozenset) -> tuple:
+        with self._lock:
+            return tuple((g, self._versions.get(g, 0)) for g in sorted(graphs))
+
+
+# Single-flight
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """Coalesce identical concurrent calls: the first caller runs the query, the other callers
+    wait for its result instead of sending the same query to the store.
+    Works for threads (`do`) and for coroutines of one event loop (`ado`), with per-template counters.
+    """
+
+    def __init__(self):
+        self.executed = Counter()
+        self.coalesced = Counter()
+        self._flights: dict[tuple, _Flight] = {}
+        self._tasks: dict[tuple, asyncio.Task] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: tuple, name: str, fn: Callable[[], Any]):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.executed[name] += 1
+            else:
+                self.coalesced[name] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return QueryResultCache._copy(flight.result)
+
+        try:
+            result = fn()
+            flight.result = QueryResultCache._copy(result)  # followers never see the leader's own copy
+            return result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def ado(self, key: tuple, name: str, coro_fn: Callable[[], Awaitable]):
+        task = self._tasks.get(key)
+        with self._lock:
+            if task is None:
+                self.executed[name] += 1
+            else:
+                self.coalesced[name] += 1
+        if task is None:
+            task = asyncio.ensure_future(coro_fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        # shielded: a disconnected client does not cancel the query the other callers wait for
+        return QueryResultCache._copy(await asyncio.shield(task))
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            name: {"executed": self.executed[name], "coalesced": self.coalesced[name]}
+            for name in sorted(set(self.executed) | set(self.coalesced))
+        }
@@ -0,0 +1,177 @@
+# 1.0.dev304.6
+
+from collections import deque
+import threading
+from contextvars import ContextVar
+import time
+
+import pandas as pd
+
+from typing import Callable
+
+
+# Profiling
+class _QueryRecord:
+    """What the store saw of one profiled call, filled by `select_rows`/`aselect_rows`"""
+
+    __slots__ = ("rows", "bytes", "query")
+
+    def __init__(self):
+        self.rows = None
+        self.bytes = 0
+        self.query = None
+
+    def add(self, query: str, rows: int, nbytes: int):
+        self.rows = (self.rows or 0) + rows
+        self.bytes += nbytes
+        self.query = query
+
+
+CURRENT_QUERY: ContextVar[_QueryRecord | None] = ContextVar("current_query", default=None)
+
+
+class _TemplateStats:
+    __slots__ = ("calls", "errors", "rows", "bytes", "seconds", "max_seconds", "latencies")
+
+    def __init__(self, samples: int):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.latencies = deque(maxlen=samples)  # most recent calls, percentiles are computed on them
+
+
+class QueryProfiler:
+    """Per-template call counts, latency percentiles, result rows, response bytes and errors
+    of the queries going through `GraphStore.raise_exceptions_query`/`raise_exceptions_aquery`.
+    Queries slower than `slow_seconds` are kept with their text, the `slow_kept` latest ones.
+    """
+
+    QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+    def __init__(self, samples: int = 1024, slow_seconds: float | None = None, slow_kept: int = 50):
+        self.samples = samples
+        self.slow_seconds = slow_seconds
+        self.slow_queries = deque(maxlen=slow_kept)
+        self._stats: dict[str, _TemplateStats] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def name_of(func: Callable, args: tuple, kwargs: dict) -> str:
+        """Template of the call, the method name for static queries"""
+        query_filename = kwargs.get("query_filename", args[0] if args else "")
+        return query_filename if isinstance(query_filename, str) and query_filename.endswith(".sparql") else func.__name__
+
+    def call(self, name: str, func: Callable, /, *args, **kwargs):
+        record, start = _QueryRecord(), time.perf_counter()
+        token = CURRENT_QUERY.set(record)
+        result = error = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            CURRENT_QUERY.reset(token)
+            self.record(name, time.perf_counter() - start, record, result, error)
+
+    async def acall(self, name: str, func: Callable, /, *args, **kwargs):
+        """Async `call`"""
+        record, start = _QueryRecord(), time.perf_counter()
+        token = CURRENT_QUERY.set(record)
+        result = error = None
+        try:
+            result = await func(*args, **kwargs)
+            return result
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            CURRENT_QUERY.reset(token)
+            self.record(name, time.perf_counter() - start, record, result, error)
+
+    def record(self, name: str, seconds: float, record: _QueryRecord, result=None, error=None):
+        failed = error is not None
+        rows = record.rows
+        if rows is None:  # served from the cache, or by a local store
+            rows = len(result) if isinstance(result, (list, pd.DataFrame)) else 0
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = _TemplateStats(self.samples)
+            stats.calls += 1
+            stats.errors += failed
+            stats.rows += rows
+            stats.bytes += record.bytes
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.latencies.append(seconds)
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            self.slow_queries.append(
+                {
+                    "template": name,
+                    "seconds": round(seconds, 4),
+                    "rows": rows,
+                    "bytes": record.bytes,
+                    "error": repr(error or result) if failed else None,
+                    "at": time.time(),
+                    "query": record.query,
+                }
+            )
+
+    def _quantiles(self, latencies) -> dict[float, float]:
+        ordered = sorted(latencies)
+        if len(ordered) == 0:
+            return {q: 0.0 for q in self.QUANTILES}
+        return {q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] for q in self.QUANTILES}
+
+    def stats(self) -> dict[str, dict]:
+        with self._lock:
+            snapshot = {name: (s, list(s.latencies)) for name, s in self._stats.items()}
+        return {
+            name: {
+                "calls": s.calls,
+                "errors": s.errors,
+                "rows": s.rows,
+                "bytes": s.bytes,
+                "seconds": round(s.seconds, 4),
+                "max_seconds": round(s.max_seconds, 4),
+                "mean_seconds": round(s.seconds / s.calls, 4) if s.calls else 0.0,
+            }
+            | {f"p{int(q * 100)}_seconds": round(v, 4) for q, v in self._quantiles(latencies).items()}
+            for name, (s, latencies) in sorted(snapshot.items())
+        }
+
+    def to_prometheus(self, prefix: str = "biglake_sparql") -> str:
+        """Prometheus text exposition format (counters and a summary per template)"""
+        with self._lock:
+            snapshot = {name: (s, list(s.latencies)) for name, s in self._stats.items()}
+        label = lambda name: name.replace("\\", "\\\\").replace('"', '\\"')
+        lines = []
+        for metric, help, attribute in (
+            ("queries_total", "Queries per template", "calls"),
+            ("query_errors_total", "Failed queries per template", "errors"),
+            ("query_rows_total", "Result rows per template", "rows"),
+            ("query_bytes_total", "Response bytes per template", "bytes"),
+        ):
+            lines += [f"# HELP {prefix}_{metric} {help}", f"# TYPE {prefix}_{metric} counter"]
+            lines += [
+                f'{prefix}_{metric}{{template="{label(name)}"}} {getattr(s, attribute)}'
+                for name, (s, _) in sorted(snapshot.items())
+            ]
+        metric = f"{prefix}_query_duration_seconds"
+        lines += [f"# HELP {metric} Query latency per template", f"# TYPE {metric} summary"]
+        for name, (s, latencies) in sorted(snapshot.items()):
+            for q, v in self._quantiles(latencies).items():
+                lines.append(f'{metric}{{template="{label(name)}",quantile="{q}"}} {v:.6f}')
+            lines.append(f'{metric}_sum{{template="{label(name)}"}} {s.seconds:.6f}')
+            lines.append(f'{metric}_count{{template="{label(name)}"}} {s.calls}')
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.slow_queries.clear()
@@ -0,0 +1,375 @@
+# 1.0.dev304.6
+
+import os, re, json
+from pathlib import Path
+from string import Template
+import uuid
+import threading
+import time
+
+from app.loggers import logger_t  # Import
+
+# logger_t = logging.getLogger()  # Declare
+# logger_t.setLevel(logging.INFO)  # Declare
+
+from rdflib import Literal, URIRef, Variable
+
+from typing import Mapping, Any, Iterable
+
+
+# Typed literals
+XSD = "http://www.w3.org/2001/XMLSchema#"
+XSD_INTEGER_TYPES = {
+    XSD + t
+    for t in (
+        "integer", "int", "long", "short", "byte",
+        "nonNegativeInteger", "positiveInteger", "nonPositiveInteger", "negativeInteger",
+        "unsignedLong", "unsignedInt", "unsignedShort", "unsignedByte",
+    )
+}
+XSD_FLOAT_TYPES = {XSD + t for t in ("decimal", "double", "float")}
+XSD_BOOLEAN = XSD + "boolean"
+
+
+def literal_to_python(value: str, datatype: str | None = None):
+    """JSON-ready Python value of a typed literal: numbers and booleans are converted,
+    dates and every other datatype keep their lexical form (ISO strings for dates)
+    """
+    try:
+        if datatype in XSD_INTEGER_TYPES:
+            return int(value)
+        if datatype in XSD_FLOAT_TYPES:
+            return float(value)
+    except ValueError:
+        return value  # ill-typed literal
+    if datatype == XSD_BOOLEAN:
+        return value in ("true", "1")
+    return value
+
+
+def sparql_json_to_rows(body: bytes | str) -> tuple[list[str], list[dict]]:
+    """Parse an `application/sparql-results+json` document straight into rows of Python values,
+    without rdflib terms nor pandas. Unbound variables are `None`, ASK results give one `boolean` row.
+
+    Args:
+        body (bytes | str): response body of the SPARQL endpoint
+
+    Returns:
+        tuple[list[str], list[dict]]: variables and rows
+    """
+    results = json.loads(body)
+    if "boolean" in results:
+        return ["boolean"], [{"boolean": results["boolean"]}]
+
+    variables = results["head"].get("vars", [])
+    rows = []
+    for binding in results["results"]["bindings"]:
+        row = dict.fromkeys(variables)
+        for var, term in binding.items():
+            if term["type"] in ("literal", "typed-literal"):
+                row[var] = literal_to_python(term["value"], term.get("datatype"))
+            else:
+                row[var] = term["value"]  # uri, bnode
+        rows.append(row)
+    return variables, rows
+
+
+# Named graph of an update
+_STRING = "|".join(
+    [
+        r"'([^'\\]|\\.)*'",
+        r'"([^"\\]|\\.)*"',
+        r"'''(('|'')?([^'\\]|\\.))*'''",
+        r'"""(("|"")?([^"\\]|\\.))*"""',
+    ]
+)
+_BLOCK_PATTERN = re.compile(
+    r"(?P<block_start>\{)|(?P<block_end>\})|(?P<block_content>"
+    + "|".join([_STRING, r'<([^<>"{}|^`\]\\[\x00-\x20])*>', r"#[^\r\n]*([\r\n]|\Z)", r"\\."])
+    + ")"
+)
+
+
+def insert_named_graph(query: str, named_graph_uri: str) -> str:
+    """Wrap the content of every top-level block of a SPARQL Update in `GRAPH <named_graph_uri> { }`,
+    what `SPARQLUpdateStore.update(queryGraph=...)` sends. Braces in strings, IRIs and comments are skipped.
+    Kept here rather than calling rdflib's private `_insert_named_graph`.
+    """
+    graph_open, graph_close = f" GRAPH <{named_graph_uri}> {{", "} "
+    level, pos, parts = 0, 0, []
+    for m in _BLOCK_PATTERN.finditer(query):
+        if m.group("block_start") is not None:
+            level += 1
+            if level == 1:
+                parts += [query[pos : m.end()], graph_open]
+                pos = m.end()
+        elif m.group("block_end") is not None:
+            if level == 1:
+                content = query[pos : m.start()]
+                if parts[-1] is graph_open and content.strip() == "":
+                    parts.pop()  # no empty GRAPH block, some endpoints refuse it
+                    parts.append(content)
+                else:
+                    parts += [content, graph_close]
+                pos = m.start()
+            level -= 1
+    parts.append(query[pos:])
+    return "".join(parts)
+
+
+# Query patterns
+_OPTIONAL_PATTERN = re.compile(r"\bOPTIONAL\s*$", re.IGNORECASE)
+
+
+def required_variables(query: str, variables: Iterable[str]) -> list[str]:
+    """Variables of `variables` used by the query outside its OPTIONAL groups, i.e. removing the triples
+    binding them would remove solutions. The prologue and the projection are not read, what follows
+    the query pattern (GROUP BY, ORDER BY...) is. Braces in strings, IRIs and comments are skipped.
+    """
+    start = query.find("{")
+    if start < 0:
+        return []
+    level, optional_level, pos, kept = 0, None, start, []
+    for m in _BLOCK_PATTERN.finditer(query, start):
+        if m.group("block_start") is not None:
+            if optional_level is None and _OPTIONAL_PATTERN.search(query, pos, m.start()) is not None:
+                kept.append(query[pos : m.start()])
+                optional_level = level
+            level += 1
+        elif m.group("block_end") is not None:
+            level -= 1
+            if optional_level is not None and level == optional_level:
+                optional_level, pos = None, m.end()
+    if optional_level is None:
+        kept.append(query[pos:])
+    kept = "".join(kept)
+    return [v for v in variables if re.search(r"\?" + re.escape(v) + r"\b", kept) is not None]
+
+
+# Parameter binding
+IRI_PATTERN = re.compile(r"(?:https?://|urn:)[^\s<>\"{}|\\^`]+\Z")
+
+
+def bound_term(value) -> URIRef | Literal:
+    """rdflib term of a bound value: rdflib terms as they are, a `str` holding an absolute
+    `http(s)://` or `urn:` IRI as an IRI, any other Python value as a typed literal
+    """
+    if isinstance(value, (URIRef, Literal)):
+        return value
+    if isinstance(value, str) and IRI_PATTERN.match(value) is not None:
+        return URIRef(value)
+    return Literal(value)
+
+
+def sparql_term(value) -> str:
+    """SPARQL syntax of a bound value (see `bound_term`), `None` as `UNDEF`.
+    Pass a `Literal` to bind an IRI-looking string as a string.
+    """
+    if value is None:
+        return "UNDEF"
+    return bound_term(value).n3()  # escapes quotes, backslashes and newlines
+
+
+def values_block(variables: list[str], rows: list[Mapping[str, Any]]) -> str:
+    """`VALUES (?a ?b) { (x y) ... }` inline data, missing values are `UNDEF`"""
+    header = " ".join(f"?{var}" for var in variables)
+    lines = "\n".join(
+        "    (" + " ".join(sparql_term(row.get(var)) for var in variables) + ")"
+        for row in rows
+    )
+    return f"VALUES ({header}) {{\n{lines}\n}}\n"
+
+
+def slots_to_variables(text: str, keys: list[str], prefix: str) -> tuple[str, dict[str, str]]:
+    """Turn the `<$key>` IRI slots and `"$key"` literal slots of a template into `?{prefix}key` variables
+
+    Raises:
+        ValueError: a placeholder is used any other way (inside a larger IRI or literal, as raw SPARQL...)
+
+    Returns:
+        tuple[str, dict[str, str]]: template text, kind of each key ('iri' or 'literal')
+    """
+    kinds = {}
+    for key in keys:
+        placeholder = r"\$(?:" + re.escape(key) + r"\b|\{" + re.escape(key) + r"\})"
+        variable = f"?{prefix}{key}"
+        text, n_iri = re.subn("<" + placeholder + ">", variable, text)
+        text, n_literal = re.subn(r"(['\"])" + placeholder + r"\1(?![@^])", variable, text)
+        if re.search(placeholder, text) is not None or n_iri * n_literal > 0:
+            raise ValueError(f"Placeholder ${key} is not always an IRI <${key}> or a quoted literal")
+        kinds[key] = "iri" if n_iri > 0 else "literal"
+    return text, kinds
+
+
+def slot_bindings(kinds: dict[str, str], values: Mapping[str, Any], prefix: str) -> dict:
+    """rdflib bindings of the variables made by `slots_to_variables`, as the text substitution would read them"""
+    return {
+        Variable(f"{prefix}{key}"): URIRef(str(values[key])) if kind == "iri" else Literal(str(values[key]))
+        for key, kind in kinds.items()
+    }
+
+
+# RDF serializations
+CONSTRUCT_FORMATS = {
+    "nt": "application/n-triples",
+    "nq": "application/n-quads",
+    "ttl": "text/turtle",
+}
+
+
+class NQuadsRewriter:
+    """Turn an N-Triples byte stream into N-Quads of one graph, chunk by chunk: only the last
+    incomplete line of a chunk is kept until the next one.
+    """
+
+    def __init__(self, graph_uri: str):
+        self.graph = f" <{graph_uri}> .\n".encode("utf-8")
+        self._tail = b""
+
+    def feed(self, chunk: bytes) -> bytes:
+        lines = (self._tail + chunk).split(b"\n")
+        self._tail = lines.pop()
+        return b"".join(self._quad(line) for line in lines)
+
+    def close(self) -> bytes:
+        tail, self._tail = self._tail, b""
+        return self._quad(tail)
+
+    def _quad(self, line: bytes) -> bytes:
+        line = line.strip()
+        if len(line) == 0 or line.startswith(b"#"):
+            return b""
+        return line[:-1].rstrip() + self.graph  # drop the final "."
+
+
+# Templates
+URI_SLOT_PATTERN = re.compile(r"<\$__uri__(.*?)>")
+
+
+class SparqlTemplate:
+    """A `.sparql` file compiled once: its `Template`, placeholders and `<$__uri__N>` URI slots"""
+
+    def __init__(self, name: str, path: Path):
+        self.name = name
+        self.path = Path(path)
+        self.checked_at = 0.0
+        self.compile()
+
+    def compile(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, "r", encoding="utf-8") as file:
+            text = file.read()
+
+        placeholders, invalid = set(), []
+        for m in Template.pattern.finditer(text):
+            if m.group("invalid") is not None:
+                invalid.append(text.count("\n", 0, m.start()) + 1)
+            elif (m.group("named") or m.group("braced")) is not None:
+                placeholders.add(m.group("named") or m.group("braced"))
+        if len(invalid) > 0:
+            logger_t.warning(
+                f"SPARQL template {self.path} has invalid placeholders at lines {invalid}, substitutions will fail"
+            )
+
+        self.text = text
+        self.template = Template(text)
+        self.uri_slots = frozenset(
+            f"__uri__{n}" for n in URI_SLOT_PATTERN.findall(text)
+        )
+        self.variables = frozenset(placeholders - self.uri_slots)
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+
+    def refresh(self) -> bool:
+        """Recompile the template if its file changed on disk, returns True if it did"""
+        self.checked_at = time.monotonic()
+        if os.stat(self.path).st_mtime_ns == self.mtime:
+            return False
+        logger_t.info(f"Reloading SPARQL template {self.path}")
+        self.compile()
+        return True
+
+    def check(self, kwargs: Mapping[str, Any]):
+        """Every missing variable is reported at once before anything is sent"""
+        missing = self.variables.difference(kwargs)
+        if len(missing) > 0:
+            raise KeyError(
+                f"Missing variables {sorted(missing)} for SPARQL template {self.name}"
+            )
+
+    def substitute(self, kwargs: Mapping[str, Any]) -> str:
+        """Fill the template"""
+        self.check(kwargs)
+        return self.template.substitute(kwargs)
+
+    TERM_PREFIX = "_term_"
+
+    def substitute_terms(self, kwargs: Mapping[str, Any]) -> str:
+        """Fill the template with SPARQL terms: `<$key>` slots with IRIs, `"$key"` slots with escaped literals,
+        so that no value can end its IRI or literal early and inject SPARQL
+
+        Raises:
+            ValueError: a placeholder is not a whole IRI or literal slot, or a value is not a valid IRI
+        """
+        self.check(kwargs)
+        text, kinds = slots_to_variables(self.text, sorted(self.variables | self.uri_slots), self.TERM_PREFIX)
+        terms = {}
+        for variable, term in slot_bindings(kinds, kwargs, self.TERM_PREFIX).items():
+            try:
+                terms[str(variable)] = term.n3()
+            except Exception as e:  # rdflib refuses to serialize an IRI holding <>"{}|^` or spaces
+                raise ValueError(f"SPARQL template {self.name}: {e}")
+        if len(terms) == 0:
+            return text
+        pattern = re.compile(r"\?(" + "|".join(re.escape(v) for v in sorted(terms, key=len, reverse=True)) + r")\b")
+        return pattern.sub(lambda m: terms[m.group(1)], text)  # one pass, values are never read again
+
+    def mint_uris(self, root_uri: str) -> dict[str, str]:
+        return {slot: root_uri + str(uuid.uuid4())[:8] for slot in self.uri_slots}
+
+
+class SparqlTemplateRegistry:
+    """Compiled SPARQL templates of a directory, reloaded when their file changes.
+    The modification time of a template is checked at most every `check_interval` seconds.
+    """
+
+    def __init__(self, path: str | Path, check_interval: float = 2.0):
+        self.path = Path(path)
+        self.check_interval = check_interval
+        self._templates: dict[str, SparqlTemplate] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> "SparqlTemplateRegistry":
+        if not self.path.is_dir():
+            logger_t.warning(f"No SPARQL templates directory at path: {self.path}")
+            return self
+        for path in sorted(self.path.glob("*.sparql")):
+            self._templates[path.name] = SparqlTemplate(path.name, path)
+        logger_t.info(f"Loaded {len(self._templates)} SPARQL templates from {self.path}")
+        return self
+
+    def get(self, name: str) -> SparqlTemplate:
+        template = self._templates.get(name)
+        if (
+            template is not None
+            and time.monotonic() - template.checked_at < self.check_interval
+        ):
+            return template
+
+        with self._lock:
+            try:
+                if template is None:
+                    template = SparqlTemplate(name, Path(self.path, name))
+                    self._templates[name] = template
+                else:
+                    template.refresh()
+            except FileNotFoundError:
+                self._templates.pop(name, None)
+                raise
+        return template
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._templates
+
+    def __len__(self) -> int:
+        return len(self._templates)
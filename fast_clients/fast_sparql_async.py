@@ -0,0 +1,150 @@
+# 1.0.dev304.6
+
+import asyncio
+
+from urllib.error import URLError
+
+from typing import AsyncIterator
+
+import aiohttp
+
+from fast_clients.fast_sparql import sparql_json_to_rows
+from fast_clients.fast_query_profiler import CURRENT_QUERY
+
+
+ASYNC_CONNECTION_ERRORS = (URLError, asyncio.TimeoutError, aiohttp.ClientError)
+
+
+class EndpointUnavailable(URLError):
+    """A SPARQL endpoint answered 5xx: the request may be retried on another replica"""
+
+
+class AsyncSparqlClient:
+    """Asynchronous SPARQL 1.1 protocol client, the asyncio counterpart of rdflib's `SPARQLUpdateStore`.
+    Connections are kept alive in a shared pool, each endpoint gets its own concurrency limit,
+    and a cancelled request (e.g. client disconnected) releases its connection right away.
+    """
+
+    def __init__(
+        self,
+        query_endpoint: str,
+        update_endpoint: str | None = None,
+        auth: tuple[str, str] | None = None,
+        pool_size: int = 32,
+        limit_per_endpoint: int = 8,
+        timeout: float = 60.0,
+        connect_timeout: float = 5.0,
+    ):
+        self.query_endpoint = query_endpoint
+        self.update_endpoint = update_endpoint or query_endpoint
+        self.auth = aiohttp.BasicAuth(*auth) if auth is not None else None
+        self.pool_size = pool_size
+        self.limit_per_endpoint = limit_per_endpoint
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._session = None
+        self._semaphores = {}
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size,
+                    limit_per_host=0,  # per endpoint limits are the semaphores
+                    keepalive_timeout=30,
+                ),
+                timeout=self.timeout,
+                auth=self.auth,
+            )
+        return self._session
+
+    def _get_semaphore(self, endpoint: str) -> asyncio.Semaphore:
+        if endpoint not in self._semaphores:
+            self._semaphores[endpoint] = asyncio.Semaphore(self.limit_per_endpoint)
+        return self._semaphores[endpoint]
+
+    async def _post(self, endpoint: str, data: dict, headers: dict) -> bytes:
+        async with self._get_semaphore(endpoint):
+            async with self._get_session().post(
+                endpoint, data=data, headers=headers
+            ) as response:
+                body = await response.read()
+                if response.status >= 500:
+                    raise EndpointUnavailable(
+                        f"SPARQL endpoint {endpoint} answered {response.status}: {body[:500].decode('utf-8', 'replace')}"
+                    )
+                if response.status >= 400:
+                    raise URLError(
+                        f"SPARQL endpoint {endpoint} answered {response.status}: {body[:500].decode('utf-8', 'replace')}"
+                    )
+                return body
+
+    async def construct(
+        self,
+        query_string: str,
+        accept: str = "application/n-triples",
+        default_graph_uri: str | None = None,
+        endpoint: str | None = None,
+        chunk_size: int = 1 << 16,
+    ) -> AsyncIterator[bytes]:
+        """CONSTRUCT/DESCRIBE query, the serialized graph is yielded as it arrives. The request is sent
+        on the first iteration, the connection is released when the iteration ends or is closed.
+        """
+        endpoint = endpoint or self.query_endpoint
+        data = {"query": query_string}
+        if default_graph_uri is not None:
+            data["default-graph-uri"] = default_graph_uri
+        async with self._get_semaphore(endpoint):
+            async with self._get_session().post(
+                endpoint, data=data, headers={"Accept": accept}
+            ) as response:
+                if response.status >= 400:
+                    body = await response.content.read(500)
+                    error = EndpointUnavailable if response.status >= 500 else URLError
+                    raise error(
+                        f"SPARQL endpoint {endpoint} answered {response.status}: {body.decode('utf-8', 'replace')}"
+                    )
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    yield chunk
+
+    async def query(
+        self,
+        query_string: str,
+        default_graph_uri: str | None = None,
+        endpoint: str | None = None,
+    ) -> tuple[list[str], list[dict]]:
+        """SELECT/ASK query, results are parsed from `application/sparql-results+json`
+
+        Args:
+            query_string (str): SPARQL query
+            default_graph_uri (str | None, optional): sent as `default-graph-uri`. Defaults to None.
+            endpoint (str | None, optional): a replica of the query endpoint. Defaults to None.
+
+        Returns:
+            tuple[list[str], list[dict]]: variables and rows, see `sparql_json_to_rows`
+        """
+        data = {"query": query_string}
+        if default_graph_uri is not None:
+            data["default-graph-uri"] = default_graph_uri
+        body = await self._post(
+            endpoint or self.query_endpoint,
+            data=data,
+            headers={"Accept": "application/sparql-results+json"},
+        )
+        variables, rows = sparql_json_to_rows(body)
+        record = CURRENT_QUERY.get()
+        if record is not None:
+            record.add(query_string, len(rows), len(body))
+        return variables, rows
+
+    async def update(self, update_string: str) -> None:
+        """SPARQL Update, graphs must already be explicit in `update_string`
+
+        Args:
+            update_string (str): SPARQL update
+        """
+        await self._post(self.update_endpoint, data={"update": update_string}, headers={})
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,208 @@
+# 1.0.dev304.6
+
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+import time
+
+import requests
+
+import asyncio
+
+from app.loggers import logger_t  # Import
+
+# logger_t = logging.getLogger()  # Declare
+# logger_t.setLevel(logging.INFO)  # Declare
+
+from typing import Mapping, Any, Awaitable, Callable, Iterable
+
+import aiohttp
+
+from fast_clients.fast_sparql_async import EndpointUnavailable
+
+
+REPLICA_FAILOVER_ERRORS = (
+    EndpointUnavailable,
+    requests.ConnectionError,
+    requests.Timeout,
+    asyncio.TimeoutError,
+    aiohttp.ClientConnectionError,
+)
+
+# Deadline of the read-your-writes pinning of the current request chain (asyncio task or thread)
+READ_YOUR_WRITES_UNTIL: ContextVar[float] = ContextVar("read_your_writes_until", default=0.0)
+# Reads sent from within `ReplicaRouter.on_primary`
+READ_FROM_PRIMARY: ContextVar[bool] = ContextVar("read_from_primary", default=False)
+
+
+class _Replica:
+    def __init__(self, url: str, weight: float = 1.0):
+        self.url = url
+        self.weight = weight
+        self.outstanding = 0
+        self.served = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+
+class ReplicaRouter:
+    """Routes reads across replicated SPARQL query endpoints: least outstanding requests relative
+    to the endpoint's weight, failover to the next replica on connection errors and 5xx answers,
+    which also put the replica aside for a cooldown (doubled at each consecutive failure).
+    After a write, the reads of the same request chain and the reads of the written graphs by any request
+    (e.g. the client's next HTTP request) are pinned to the primary (first endpoint) for `pin_seconds`
+    so that they see it.
+    """
+
+    def __init__(
+        self,
+        endpoints: str | list[str | Mapping[str, Any]],
+        cooldown: float = 30.0,
+        pin_seconds: float = 5.0,
+    ):
+        if isinstance(endpoints, str):
+            endpoints = [endpoints]
+        self.replicas = [
+            _Replica(e) if isinstance(e, str) else _Replica(e["url"], e.get("weight", 1.0))
+            for e in endpoints
+        ]
+        if len(self.replicas) == 0:
+            raise ValueError("ReplicaRouter needs at least one query endpoint")
+        self.cooldown = cooldown
+        self.pin_seconds = pin_seconds
+        self._graphs_pinned_until: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self) -> str:
+        return self.replicas[0].url
+
+    def __len__(self) -> int:
+        return len(self.replicas)
+
+    def pin(self, graphs: str | Iterable[str] = ()):
+        """Reads of the current request chain, and reads of `graphs` by any request, go to the primary
+        for `pin_seconds`. The request chain only covers the caller's context: tasks and threads started
+        before the write, e.g. by `asyncio.gather`, and later HTTP requests rely on the graphs' pins.
+        """
+        now = time.monotonic()
+        READ_YOUR_WRITES_UNTIL.set(now + self.pin_seconds)
+        graphs = [graphs] if isinstance(graphs, str) else graphs
+        with self._lock:
+            pinned = {g: t for g, t in self._graphs_pinned_until.items() if t > now}
+            pinned.update((g, now + self.pin_seconds) for g in graphs)
+            self._graphs_pinned_until = pinned
+
+    @contextmanager
+    def on_primary(self):
+        """Reads sent within the block, and by the tasks it starts, go to the primary"""
+        token = READ_FROM_PRIMARY.set(True)
+        try:
+            yield
+        finally:
+            READ_FROM_PRIMARY.reset(token)
+
+    def is_pinned(self, graphs: str | Iterable[str] = ()) -> bool:
+        """True if the current request chain or one of `graphs` was written less than `pin_seconds` ago"""
+        now = time.monotonic()
+        if READ_FROM_PRIMARY.get() or READ_YOUR_WRITES_UNTIL.get() > now:
+            return True
+        graphs = [graphs] if isinstance(graphs, str) else graphs
+        pinned = self._graphs_pinned_until
+        return any(pinned.get(g, 0.0) > now for g in graphs)
+
+    def choose(self, exclude: list[_Replica] = (), graphs: str | Iterable[str] = ()) -> _Replica:
+        candidates = [r for r in self.replicas if r not in exclude]
+        if self.is_pinned(graphs) and self.replicas[0] in candidates:
+            return self.replicas[0]
+        now = time.monotonic()
+        healthy = [r for r in candidates if r.down_until <= now]
+        if len(healthy) == 0:  # everything is down, try the one that recovers first
+            return min(candidates, key=lambda r: r.down_until)
+        return min(healthy, key=lambda r: ((r.outstanding + 1) / r.weight, r.served))
+
+    def _start(self, replica: _Replica):
+        with self._lock:
+            replica.outstanding += 1
+
+    def _done(self, replica: _Replica, failed: bool = False):
+        with self._lock:
+            replica.outstanding -= 1
+            if failed:
+                replica.failures += 1
+                replica.down_until = time.monotonic() + self.cooldown * 2 ** min(replica.failures - 1, 5)
+            else:
+                replica.served += 1
+                replica.failures = 0
+
+    def _failed_over(self, replica: _Replica, tried: list, e: Exception) -> bool:
+        self._done(replica, failed=True)
+        tried.append(replica)
+        logger_t.warning(f"Query endpoint {replica.url} failed ({type(e).__name__}: {e}), {len(self) - len(tried)} replicas left")
+        return len(tried) < len(self)
+
+    def call(self, fn: Callable[[str], Any], graphs: str | Iterable[str] = ()) -> Any:
+        """Run `fn(endpoint_url)` on the chosen replica, then on the next ones while it fails over,
+        `graphs` are the graphs read (see `pin`)
+        """
+        tried = []
+        while True:
+            replica = self.choose(exclude=tried, graphs=graphs)
+            self._start(replica)
+            try:
+                result = fn(replica.url)
+            except REPLICA_FAILOVER_ERRORS as e:
+                if self._failed_over(replica, tried, e):
+                    continue
+                raise
+            except BaseException:
+                self._done(replica)  # the query itself is at fault, not the replica
+                raise
+            self._done(replica)
+            return result
+
+    async def acall(self, coro_fn: Callable[[str], Awaitable], graphs: str | Iterable[str] = ()) -> Any:
+        """Async `call`"""
+        tried = []
+        while True:
+            replica = self.choose(exclude=tried, graphs=graphs)
+            self._start(replica)
+            try:
+                result = await coro_fn(replica.url)
+            except REPLICA_FAILOVER_ERRORS as e:
+                if self._failed_over(replica, tried, e):
+                    continue
+                raise
+            except BaseException:
+                self._done(replica)
+                raise
+            self._done(replica)
+            return result
+
+    def check(self, probe: Callable[[str], Any]) -> dict:
+        """Active health check: `probe(endpoint_url)` on every replica, failing ones are put aside"""
+        for replica in self.replicas:
+            self._start(replica)
+            try:
+                probe(replica.url)
+            except Exception as e:
+                self._done(replica, failed=True)
+                logger_t.warning(f"Query endpoint {replica.url} health check failed: {type(e).__name__}: {e}")
+            else:
+                self._done(replica)
+                replica.down_until = 0.0
+        return self.stats()
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "url": r.url,
+                "weight": r.weight,
+                "outstanding": r.outstanding,
+                "served": r.served,
+                "failures": r.failures,
+                "down_for": round(max(r.down_until - now, 0.0), 3),
+            }
+            for r in self.replicas
+        ]
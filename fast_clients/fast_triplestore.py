@@ -1,20 +1,11 @@
 # 1.0.dev304.6
 
-import os, sys, re, io
-from abc import ABC, abstractmethod
-from logging import getLogger
-from pathlib import Path
-from string import Template
-import uuid
+import re, io
 
 import requests
-from functools import reduce
 
-import logging
+import asyncio
 
-# import asyncio
-
-from urllib.parse import urlparse
 from urllib.error import URLError
 
 from app.loggers import logger_t  # Import
@@ -22,13 +13,13 @@ from app.loggers import logger_t  # Import
 # logger_t = logging.getLogger()  # Declare
 # logger_t.setLevel(logging.INFO)  # Declare
 
-from rdflib import Graph, Namespace
+from rdflib import Literal, URIRef
+from rdflib.namespace import RDF
 from rdflib.plugins.stores import sparqlstore
-from rdflib.plugins.sparql.processor import SPARQLResult
 
 import pandas as pd
 
-from typing import Optional, Mapping, List, Any
+from typing import Optional, Mapping, Any, AsyncIterator, Iterator
 
 try:
     from functools import cache
@@ -37,181 +28,95 @@ except ImportError:
 
     cache = lru_cache(maxsize=None)
 
+from fast_clients.fast_sparql import (
+    CONSTRUCT_FORMATS,
+    NQuadsRewriter,
+    insert_named_graph,
+    required_variables,
+    sparql_json_to_rows,
+    sparql_term,
+    bound_term,
+    XSD,
+    XSD_INTEGER_TYPES,
+    XSD_FLOAT_TYPES,
+    XSD_BOOLEAN,
+    literal_to_python,
+    values_block,
+    slots_to_variables,
+    slot_bindings,
+    URI_SLOT_PATTERN,
+    SparqlTemplate,
+    SparqlTemplateRegistry,
+)
+from fast_clients.fast_sparql_async import (
+    AsyncSparqlClient,
+    EndpointUnavailable,
+    ASYNC_CONNECTION_ERRORS,
+)
+from fast_clients.fast_sparql_replicas import (
+    ReplicaRouter,
+    REPLICA_FAILOVER_ERRORS,
+    READ_YOUR_WRITES_UNTIL,
+)
+from fast_clients.fast_query_cache import GraphVersions, QueryResultCache, SingleFlight
+from fast_clients.fast_query_profiler import CURRENT_QUERY, QueryProfiler
+from fast_clients.fast_update_batcher import UpdateBatcher
+from fast_clients.fast_graph_indexes import (
+    BuiltworkHierarchy,
+    LabelSearchIndex,
+    ThesaurusMirror,
+    RefreshedIndex,
+)
+from fast_clients.fast_graphstore import GraphStore
+from fast_clients.fast_local_triplestore import LocalTripleStore
+
+RDF_LANG_STRING = str(RDF.langString)
 
-class GraphStore(ABC):
-    @abstractmethod
-    def __init__(self, **kwargs):
-        """"""
-
-    # Select
-    @abstractmethod
-    def select_templated(
-        self,
-        query_filename: str,
-        format: str = "dataframe",
-        override_named_graph_uri: Optional[str] = None,
-        **kwargs,
-    ) -> pd.DataFrame:
-        """"""
 
-    @abstractmethod
-    def select_templated_parametrized(
-        self,
-        query_filename: str,
-        format: str = "dataframe",
-        enforce_parameters: Mapping[str, str] | None = None,
-        override_named_graph_uri: Optional[str] = None,
-        **kwargs,
-    ) -> pd.DataFrame:
-        """"""
-
-    # Update
-    @abstractmethod
-    def update_static(
-        self,
-        query_string: str,
-    ) -> pd.DataFrame:
-        """"""
-
-    @abstractmethod
-    def update_templated(self, query_filename: str, **kwargs) -> pd.DataFrame:
-        """"""
-
-    # Utils
-    def get_target_named_graphs(self, named_graph_uri: str | list[str]) -> Graph:
-        logger_t.info(f"named_graph_uri={named_graph_uri}")
-        if isinstance(named_graph_uri, str):
-            g = Graph(
-                store=self.client,
-                identifier=named_graph_uri,  # .lstrip('/'),
-                bind_namespaces="none",
-            )  # Do not load default rdflib namespaces, keep queries self-contained
-            return g
-        else: # isinstance(override_named_graph_uri, List[str])
-            # TODO: resolve with rdflib.ConjunctiveGraph or rdflib.Dataset for performance
-            graphs_named = []
-            for ng in named_graph_uri:
-                graphs_named.append( 
-                    Graph(
-                        store=self.client,
-                        identifier=ng,  # .lstrip('/'),
-                        bind_namespaces="none",
-                    )
-                )
-            g = reduce(lambda x,y: x+y, graphs_named)
-            return g
-
-
-
-    # Results
-    def sparql_results_to_df(self, results: SPARQLResult) -> pd.DataFrame:
-        """Export results from an rdflib SPARQL query into a `pandas.DataFrame`,
-            using Python types. See https://github.com/RDFLib/rdflib/issues/1179.
-
-        Args:
-            results (SPARQLResult): _description_
-
-        Returns:
-            DataFrame: _description_
-        """
-        return pd.DataFrame(
-            data=(
-                [None if x is None else x.toPython() for x in row] for row in results
-            ),
-            columns=[str(x) for x in results.vars],
-        )
-
-    def sparql_results_to_json(self, results: SPARQLResult):
-        """Export results from an rdflib SPARQL query into dictionary
-        Warning: SLOW version, using converters from pd.dataframe via sparql_results_to_df
-        TODO: build directly the json string
-
-        Args:
-            results (SPARQLResult): _description_
-
-        Returns:
-            DataFrame: _description_
+class TripleStore(GraphStore):
+    def __init__(self, config: dict | None = None, config_store: dict | None = None):
         """
-        return pd.DataFrame(
-            data=(
-                [None if x is None else x.toPython() for x in row] for row in results
-            ),
-            columns=[str(x) for x in results.vars],
-        ).to_json(orient="records", force_ascii=False)
-
-    def sparql_results_to_dict(self, results: SPARQLResult):
-        """Export results from an rdflib SPARQL query into dictionary
-        Warning: SLOW version, using converters from pd.dataframe via sparql_results_to_df
-        TODO: build directly the json string
-
-        Args:
-            results (SPARQLResult): _description_
-
-        Returns:
-            DataFrame: _description_
+        Keyword Args:
+            config_store (dict): A dictionary of config settings for sparqlstore.SPARQLUpdateStore client
+                - ['query_endpoint'] (str | list[str | dict]): one endpoint, or replicas as URLs or `{"url", "weight"}`,
+                    the first one is the primary, it gets the reads that follow a write
+            config (dict): A dictionnary of config settings for Triplestore behaviour depending on its context (local/online)
+                - ['path']
+                - ['sparql_async_pool_size'] (int): connections kept alive by the async client, default 32
+                - ['sparql_async_limit_per_endpoint'] (int): concurrent async requests per endpoint, default 8
+                - ['sparql_async_timeout'] (float): total seconds per async request, default 60
+                - ['sparql_async_connect_timeout'] (float): seconds to open a connection, default 5
+                - ['sparql_templates_check_interval'] (float): seconds between mtime checks of a template, default 2
+                - ['query_cache_ttl'] (float): seconds a select result is served from memory, default 0 (no cache).
+                    Only the writes of this process invalidate it, enable it when the graphs are written through this API only
+                - ['query_cache_maxsize'] (int): number of select results kept in memory, default 1024
+                - ['update_batch_max_statements'] (int): statements joined in one batched update request, default 100
+                - ['update_batch_window'] (float): seconds a batched statement waits for others, default 0.05
+                - ['update_batch_max_retries'] (int): times a batch failing with a transient error is sent again before it is dropped, default 3
+                - ['update_batch_retry_delay'] (float): seconds before a failed batch is sent again, doubled each time, default 0.5
+                - ['annotation_layer_update_template'] (str): update template of one annotation record, when set; its placeholders
+                    must be whole `<$key>` IRI or `"$key"` literal slots, filled with escaped terms
+                    `LoadGeometryAnnotations` writes the records through the update batcher instead of Kafka, default None
+                - ['thesaurus_named_graph_full_uris'] (list[str]): thesaurus graphs mirrored in memory
+                - ['thesaurus_local_resolution'] (dict[str, dict[str, str]]): per select template, concept column -> label column
+                    resolved from the mirror, the thesaurus graphs are then left out of that template's queries. The template
+                    must bind the label columns in OPTIONAL groups only and must not name the thesaurus graphs (FROM, GRAPH),
+                    otherwise it keeps querying them remotely
+                - ['thesaurus_refresh_interval'] (float): seconds between checks of the thesaurus graphs, default 3600
+                - ['thesaurus_languages'] (list[str]): label languages by preference, default ["fr", "en", ""]
+                - ['builtwork_hierarchy_refresh_interval'] (float): seconds between checks of the builtwork trees, default 600
+                - ['label_search_refresh_interval'] (float): seconds between checks of the label search index, default 600
+                - ['replica_cooldown'] (float): seconds a failing query endpoint is put aside, doubled at each failure, default 30
+                - ['replica_pin_seconds'] (float): seconds the reads of the writing request, and every read of the written
+                    graphs, go to the primary after a write, default 5
+                - ['query_profile_samples'] (int): latest latencies per template kept for the percentiles, default 1024
+                - ['query_profile_slow_seconds'] (float): queries slower than this are kept with their text, default None (off)
+                - ['graph_version_marker'] (bool): keep graph versions in a marker triple of each graph, shared by processes,
+                    default False: the version of a graph is its number of triples, writes keeping it are not seen
+                - ['graph_version_check_interval'] (float): seconds between reads of a graph's version, default 5
         """
-        return pd.DataFrame(
-            data=(
-                [None if x is None else x.toPython() for x in row] for row in results
-            ),
-            columns=[str(x) for x in results.vars],
-        ).to_dict(orient="records")
-
-    # Exception handling
-    def raise_exceptions_query(func):
-        def wrapper(self, *args, **kwargs):
-            """
-
-            kwargs['query_filename'],
-
-            Returns:
-                _type_: _description_
-            """
-            try:
-                return func(self, *args, **kwargs)
-            except FileNotFoundError as fnfe:
-                logger_t.error(f"{type(fnfe)} {fnfe}")
-                logger_t.error(
-                    f"No SPARQL file found at path: {Path(self.config['datapip_sparql_select_path'], kwargs['query_filename'])}"
-                )
-                return fnfe
-            except URLError as ue:
-                logger_t.error(f"{type(ue)} {ue}")
-                logger_t.error(
-                    f"Error connecting RDF-graph database: query_endpoint={self.config_store['query_endpoint']}, update_endpoint={self.config_store['update_endpoint']}"
-                )
-                return ue
-            except KeyError as ke:
-                logger_t.error(f"{type(ke)} {ke}")
-                logger_t.error(
-                    f"JSON data input is not compliant with the Data Pipeline Schema for data substitution: schema={kwargs['query_filename'].split('.')[0]}"
-                )
-                # logger_t.error(
-                #     f"Please, check missing value \n{Template(s).safe_substitute(kwargs)}"
-                # )
-                return ke
-            except ValueError as ve:
-                logger_t.error(f"{type(ve)} {ve}")
-                logger_t.error(
-                    f"Check connexion with the TripleStore: query_endpoint={self.config_store['query_endpoint']}, update_endpoint={self.config_store['update_endpoint']}"
-                )
-                return ve
-            except Exception as e:
-                logger_t.error(f"Unhandled error: {type(e)} {e}")
-                return e
-
-        return wrapper
-
-
-class LocalTripleStore(GraphStore):
-    def __init__(
-        self,
-        config: dict,
-        config_namespaces: dict[str, str] | None = None,
-        bootstrap_rdffiles: list[str | Path] | None = None,
-    ):
-        # Config
-        self.config = config
+        self.config = config or {}
+        self.config_store = config_store or {}
         try:
             self.default_named_graph_uri = "".join(
                 [
@@ -219,192 +124,255 @@ class LocalTripleStore(GraphStore):
                     self.config["default_named_graph_name"],
                 ]
             )
-            self.default_triples_root_uri = self.config["default_triples_root_uri"]
         except:
             raise ValueError(
-                f"GraphStore Class API configuration error, cannot define default named graph with provided config, config={self.config}"
+                f"TripleStore Class API configuration error, cannot define default named graph with provided config, config={self.config}"
             )
+        self.load_templates()
 
-        # Graph
-        self.g = Graph(bind_namespaces="none")
+    @property
+    @cache
+    def client(self):
+        return sparqlstore.SPARQLUpdateStore(
+            **(self.config_store | {"query_endpoint": self.replicas.primary})
+        )
 
-        if config_namespaces is not None:
-            for name, uri in config_namespaces.items():
-                self.g.bind(name, Namespace(uri))
+    @property
+    @cache
+    def replicas(self) -> ReplicaRouter:
+        return ReplicaRouter(
+            self.config_store["query_endpoint"],
+            cooldown=self.config.get("replica_cooldown", 30.0),
+            pin_seconds=self.config.get("replica_pin_seconds", 5.0),
+        )
 
-        if bootstrap_rdffiles is not None:
-            for rdffile in bootstrap_rdffiles:
-                self.g.parse(rdffile)
+    def check_replicas(self) -> list[dict]:
+        """Send `ASK {}` to every query endpoint, failing ones stop receiving reads for a cooldown"""
 
-    # Select
-    @GraphStore.raise_exceptions_query
-    def select_templated(
-        self,
-        query_filename: str,
-        format: str = "dataframe",
-        override_named_graph_uri: Optional[str] = None,
-        **kwargs,
-    ) -> pd.DataFrame:
-        try:
-            query_path = Path(self.config["datapip_sparql_select_path"], query_filename)
-        except KeyError as ke1:
-            logger_t.error(ke1)
-            logger_t.error(
-                f"Incomplete config for select queries, add  'datapip_sparql_select_path' to your config={self.config}"
+        def probe(endpoint: str):
+            r = self.session.post(
+                endpoint,
+                data={"query": "ASK {}"},
+                headers={"Accept": "application/sparql-results+json"},
+                timeout=5,
             )
-            return None
-
-        with open(query_path, "r", encoding="utf-8") as file:
-            if len(kwargs) == 0:
-                query_string = file.read()
-            else:
-                s = file.read()
-                query_string = Template(s).substitute(
-                    kwargs
-                )  # squery = s.format(**kwargs)
-
-        logger_t.debug(f"Select Query:\n{query_string}")
-        qr = self.g.query(query_string)
-
-        match format:
-            case "dataframe":
-                return self.sparql_results_to_df(qr)
-            case "json":
-                return self.sparql_results_to_json(qr)
-            case "dict":
-                return self.sparql_results_to_dict(qr)
-            case _:
-                logger_t.warning(
-                    f"Unrecoginzed format={format}, defaulting to 'dataframe' output"
-                )
-                return self.sparql_results_to_df(qr)
+            r.raise_for_status()
 
-    @GraphStore.raise_exceptions_query
-    def select_templated_parametrized(
-        self,
-        query_filename: str,
-        format: str = "dataframe",
-        enforce_parameters: Mapping[str, str] | None = None,
-        override_named_graph_uri: Optional[str] = None,
-        **kwargs,
-    ) -> pd.DataFrame:
-        try:
-            query_path = Path(self.config["datapip_sparql_select_path"], query_filename)
-        except KeyError as ke1:
-            logger_t.error(ke1)
-            logger_t.error(
-                f"Incomplete config for select queries, add  'datapip_sparql_select_path' to your config={self.config}"
-            )
-            return None
+        return self.replicas.check(probe)
 
-        with open(query_path, "r", encoding="utf-8") as file:
-            if len(kwargs) == 0:
-                query_string = file.read()
-            else:
-                s = file.read()
-                query_string = Template(s).substitute(
-                    kwargs
-                )  # squery = s.format(**kwargs)
+    @property
+    @cache
+    def result_cache(self) -> QueryResultCache:
+        return QueryResultCache(
+            maxsize=self.config.get("query_cache_maxsize", 1024),
+            ttl=self.config.get("query_cache_ttl", 0.0),
+        )
 
-            if enforce_parameters is not None:
-                logger_t.debug(f"enforce={enforce_parameters}")
-                enforce_parameters = {
-                    f"?{k}": f"'{v}'"
-                    for k, v in enforce_parameters.items()
-                    if v is not None
-                }  # escapes `None` values, add the `?` for wildcards replacements (cf SPARQL 1.1)
-                logger_t.debug(f"enforcepost={enforce_parameters}")
-                if enforce_parameters is not {}:
-                    keys = (re.escape(k) for k in enforce_parameters.keys())
-                    pattern = re.compile(r"(" + "".join(keys) + r")")
-                    query_string = pattern.sub(
-                        lambda x: enforce_parameters[x.group()], query_string
-                    )
-
-        logger_t.debug(f"Select Query:\n{query_string}")
-        qr = self.g.query(query_string)
-
-        match format:
-            case "dataframe":
-                return self.sparql_results_to_df(qr)
-            case "json":
-                return self.sparql_results_to_json(qr)
-            case "dict":
-                return self.sparql_results_to_dict(qr)
-            case _:
-                logger_t.warning(
-                    f"Unrecoginzed format={format}, defaulting to 'dataframe' output"
-                )
-                return self.sparql_results_to_df(qr)
+    @property
+    @cache
+    def graph_versions(self) -> GraphVersions:
+        return GraphVersions(
+            self,
+            marker=self.config.get("graph_version_marker", False),
+            check_interval=self.config.get("graph_version_check_interval", 5.0),
+        )
 
-    # Update
-    @GraphStore.raise_exceptions_query
-    def update_static(self, query_string: str, **kwargs):
-        self.g.update(query_string)
+    @property
+    @cache
+    def update_batcher(self) -> UpdateBatcher:
+        return UpdateBatcher(
+            self,
+            max_statements=self.config.get("update_batch_max_statements", 100),
+            window=self.config.get("update_batch_window", 0.05),
+            max_retries=self.config.get("update_batch_max_retries", 3),
+            retry_delay=self.config.get("update_batch_retry_delay", 0.5),
+        )
 
-    @GraphStore.raise_exceptions_query
-    def update_templated(self, query_filename: str, **kwargs) -> pd.DataFrame:
-        try:
-            query_path = Path(self.config["datapip_sparql_update_path"], query_filename)
-        except KeyError as ke1:
-            logger_t.error(ke1)
-            logger_t.error(
-                f"Incomplete config for select queries, add  'datapip_sparql_update_path' to your config={self.config}"
-            )
-            return None
+    @property
+    @cache
+    def single_flight(self) -> SingleFlight:
+        return SingleFlight()
 
-        uris = {}
-        with open(query_path, "r", encoding="utf-8") as file:
-            s = file.read()
+    @property
+    @cache
+    def thesaurus(self) -> ThesaurusMirror:
+        return ThesaurusMirror(
+            self,
+            graphs=self.config.get("thesaurus_named_graph_full_uris", []),
+            refresh_interval=self.config.get("thesaurus_refresh_interval", 3600.0),
+            languages=tuple(self.config.get("thesaurus_languages", ("fr", "en", ""))),
+        )
 
-            uris_match = set(
-                re.findall(pattern="<\\$__uri__(.*?)>", string=s)
-            )  # set(findall(pattern, string)) for distincts matches
-            for u_number in uris_match:
+    @property
+    @cache
+    def builtwork_hierarchy(self) -> BuiltworkHierarchy:
+        return BuiltworkHierarchy(
+            self,
+            named_graph_uri=self.default_named_graph_uri,
+            refresh_interval=self.config.get("builtwork_hierarchy_refresh_interval", 600.0),
+        )
 
-                def simple_uuid_uri_generator() -> str:
-                    return (
-                        self.config["default_triples_root_uri"] + str(uuid.uuid4())[:8]
-                    )
+    @property
+    @cache
+    def label_search(self) -> LabelSearchIndex:
+        return LabelSearchIndex(
+            self,
+            named_graph_uri=self.default_named_graph_uri,
+            refresh_interval=self.config.get("label_search_refresh_interval", 600.0),
+        )
 
-                urikey = f"__uri__{u_number}"
-                uris[urikey] = simple_uuid_uri_generator()
-            logger_t.debug(f"Created {len(uris_match)} URIs : {uris}")
+    def _thesaurus_resolution(
+        self, query_filename: str, named_graph_uri: str | list[str]
+    ) -> tuple[str | list[str], Mapping[str, str] | None]:
+        """Graphs actually queried for a template and the label columns to fill from the thesaurus mirror.
+        Until the mirror is loaded, and for templates whose solutions need the thesaurus graphs
+        (required label patterns, thesaurus graphs named in the query), they keep being queried remotely.
+        """
+        fields = self.config.get("thesaurus_local_resolution", {}).get(query_filename)
+        if fields is None or isinstance(named_graph_uri, str):
+            return named_graph_uri, None
+        text = self.select_templates.get(query_filename).text
+        required = required_variables(text, fields.values())
+        if len(required) > 0 or any(g in text for g in self.thesaurus.graphs):
+            logger_t.debug(f"{query_filename} needs the thesaurus graphs (required {required}), resolved remotely")
+            return named_graph_uri, None
+        self.thesaurus.maybe_refresh()
+        if not self.thesaurus.is_ready:
+            return named_graph_uri, None
+        instance_graphs = [g for g in named_graph_uri if g not in self.thesaurus.graphs]
+        if len(instance_graphs) == len(named_graph_uri) or len(instance_graphs) == 0:
+            return named_graph_uri, None
+        return instance_graphs[0] if len(instance_graphs) == 1 else instance_graphs, fields
+
+    def _thesaurus_enrich(
+        self, variables: list[str], rows: list[dict], fields: Mapping[str, str]
+    ) -> tuple[list[str], list[dict]]:
+        self.thesaurus.enrich(rows, fields)
+        return variables + [f for f in fields.values() if f not in variables], rows
+
+    def _result_cache_key(
+        self, query_filename: str, bindings: dict, named_graph_uri, format: str
+    ) -> tuple:
+        template = self.select_templates.get(query_filename)
+        return self.result_cache.make_key(
+            f"{query_filename}@{template.mtime}", bindings, named_graph_uri, format
+        )  # an edited template never serves the results of its previous version
+
+    def on_graph_changed(self, named_graph_uris: str | list[str] | None = None):
+        """Single entry point for writes: every cached result read from the graphs is dropped
+        and their versions are bumped. It may run on a background thread (batched updates),
+        the read-your-writes pinning is done by the write methods, in the request's own context.
 
-            supdate = Template(s).substitute(kwargs | uris)
-            logger_t.debug(f"--- --- SUBSTITUED TEMPLATE CONTENT --- ---\n{supdate}")
+        Args:
+            named_graph_uris (str | list[str] | None, optional): changed graphs, `None` when unknown. Defaults to None.
+        """
+        n = self.result_cache.invalidate(named_graph_uris)
+        self.graph_versions.bump(named_graph_uris)
+        if self.config.get("thesaurus_local_resolution") and (
+            named_graph_uris is None
+            or not self.thesaurus.graphs.isdisjoint(
+                [named_graph_uris] if isinstance(named_graph_uris, str) else named_graph_uris
+            )
+        ):
+            self.thesaurus.mark_stale()
+        logger_t.debug(f"Graph changed named_graph_uris={named_graph_uris}, {n} cached results dropped")
 
-            self.g.update(supdate)
-        return uris
+    def versioned_update(self, statements: str, named_graph_uri: str) -> str:
+        """Append the increment of the graph's version marker to an update request, so that both are
+        applied together. `statements` must already carry their `GRAPH` (`insert_named_graph`)
+        """
+        marker_update = self.graph_versions.marker_update(named_graph_uri)
+        if marker_update == "":
+            return statements
+        return statements.strip().rstrip(";") + " ;\n" + marker_update
 
+    def on_ingestion_completed(
+        self, destination: str | None = None, subject_uris: list[str] | None = None
+    ):
+        """Called once an ingress job has written to the graph (`{duuid}://end` message)
 
-class TripleStore(GraphStore):
-    def __init__(self, config: dict | None = None, config_store: dict | None = None):
-        """
-        Keyword Args:
-            config_store (dict): A dictionary of config settings for sparqlstore.SPARQLUpdateStore client
-            config (dict): A dictionnary of config settings for Triplestore behaviour depending on its context (local/online)
-                - ['path']
+        Args:
+            destination (str | None, optional): named graph name or URI targeted by the job,
+                the default named graph if None. Defaults to None.
+            subject_uris (list[str] | None, optional): builtworks known to be touched by the job,
+                the whole builtwork hierarchy is reloaded if None. Defaults to None.
         """
-        self.config = config or {}
-        self.config_store = config_store or {}
-        try:
-            self.default_named_graph_uri = "".join(
-                [
-                    self.config["default_named_graph_root_uri"],
-                    self.config["default_named_graph_name"],
-                ]
-            )
-        except:
-            raise ValueError(
-                f"TripleStore Class API configuration error, cannot define default named graph with provided config, config={self.config}"
-            )
+        graph = self._ingested_graph(destination)
+        if self.graph_versions.marker:  # the job wrote to the store directly
+            self.client.update(self.graph_versions.marker_update(graph))
+        self._on_ingested(graph, subject_uris)
+
+    async def aon_ingestion_completed(
+        self, destination: str | None = None, subject_uris: list[str] | None = None
+    ):
+        """Async `on_ingestion_completed`, for the ingress handlers"""
+        graph = self._ingested_graph(destination)
+        if self.graph_versions.marker:
+            await self.aclient.update(self.graph_versions.marker_update(graph))
+        self._on_ingested(graph, subject_uris)
+
+    def _ingested_graph(self, destination: str | None) -> str:
+        if destination is None:
+            return self.default_named_graph_uri
+        if ":" in destination:  # already a graph URI
+            return destination
+        return self.config["default_named_graph_root_uri"] + destination
+
+    def _on_ingested(self, graph: str, subject_uris: list[str] | None):
+        self.on_graph_changed(graph)
+        self.replicas.pin(graph)  # the ingress request that waited for the job, and the next reads of the graph
+
+        for index in (self.builtwork_hierarchy, self.label_search):
+            if graph == index.named_graph_uri and index.is_ready:
+                index.on_ingestion(subject_uris)
 
     @property
     @cache
-    def client(self):
-        return sparqlstore.SPARQLUpdateStore(**self.config_store)
+    def session(self) -> requests.Session:
+        session = requests.Session()  # keep-alive connections to the endpoint
+        if self.config_store.get("auth") is not None:
+            session.auth = tuple(self.config_store["auth"])
+        return session
+
+    def select_rows(
+        self, query_string: str, named_graph_uri: str | list[str]
+    ) -> tuple[list[str], list[dict]]:
+        """Run a SELECT/ASK query on one or several named graphs (see `query_target_named_graphs`)
+        and parse its `application/sparql-results+json` response straight into rows.
+
+        Args:
+            query_string (str): SPARQL query
+            named_graph_uri (str | list[str]): named graph(s) queried as the default graph
+
+        Returns:
+            tuple[list[str], list[dict]]: variables and rows, see `sparql_json_to_rows`
+        """
+        data = {"query": query_string}
+        if isinstance(named_graph_uri, str):
+            data["default-graph-uri"] = named_graph_uri
+        else:
+            data["query"] = self.inject_dataset_clauses(query_string, named_graph_uri)
 
+        def post(endpoint: str) -> requests.Response:
+            r = self.session.post(
+                endpoint,
+                data=data,
+                headers={"Accept": "application/sparql-results+json"},
+            )
+            if r.status_code >= 500:
+                raise EndpointUnavailable(
+                    f"SPARQL endpoint {endpoint} answered {r.status_code}: {r.text[:500]}"
+                )
+            if r.status_code >= 400:
+                raise URLError(f"SPARQL endpoint {endpoint} answered {r.status_code}: {r.text[:500]}")
+            return r
+
+        r = self.replicas.call(post, named_graph_uri)
+        variables, rows = sparql_json_to_rows(r.content)
+        record = CURRENT_QUERY.get()
+        if record is not None:
+            record.add(data["query"], len(rows), len(r.content))
+        return variables, rows
 
     # Select
     @GraphStore.raise_exceptions_query
@@ -415,29 +383,10 @@ class TripleStore(GraphStore):
         format: str = "dataframe",
     ) -> pd.DataFrame:
 
-        if override_named_graph_uri is None:
-            g = Graph(
-                store=self.client,
-                identifier=self.default_named_graph_uri,  # .lstrip('/'),
-                bind_namespaces="none",
-            )  # Do not load default rdflib namespaces, keep queries self-contained
-        else:
-            g = self.get_target_named_graphs(override_named_graph_uri)
-
-        qr = g.query(query_string)
-
-        match format:
-            case "dataframe":
-                return self.sparql_results_to_df(qr)
-            case "json":
-                return self.sparql_results_to_json(qr)
-            case "dict":
-                return self.sparql_results_to_dict(qr)
-            case _:
-                logger_t.warning(
-                    f"Unrecoginzed format={format}, defaulting to 'dataframe' output"
-                )
-                return self.sparql_results_to_df(qr)
+        variables, rows = self.select_rows(
+            query_string, override_named_graph_uri or self.default_named_graph_uri
+        )
+        return self.sparql_rows_to(variables, rows, format)
 
 
     
@@ -447,149 +396,521 @@ class TripleStore(GraphStore):
         query_filename: str,
         format: str = "dataframe",
         override_named_graph_uri: Optional[str | list[str]] = None,
+        cached: bool = True,
         **kwargs,
     ) -> pd.DataFrame:
-        query_path = Path(self.config["datapip_sparql_select_path"], query_filename)
-        with open(query_path, "r", encoding="utf-8") as file:
-            if len(kwargs) == 0:
-                query_string = file.read()
-            else:
-                s = file.read()
-                query_string = Template(s).substitute(
-                    kwargs
-                )  # squery = s.format(**kwargs)
-
-        logger_t.debug(f"Select Query:\n{query_string}")
-
-        
-        if override_named_graph_uri is None:
-            g = Graph(
-                store=self.client,
-                identifier=self.default_named_graph_uri,  # .lstrip('/'),
-                bind_namespaces="none",
-            )  # Do not load default rdflib namespaces, keep queries self-contained
-        else:
-            g = self.get_target_named_graphs(override_named_graph_uri)
-        qr = g.query(query_string)
-
-        match format:
-            case "dataframe":
-                return self.sparql_results_to_df(qr)
-            case "json":
-                return self.sparql_results_to_json(qr)
-            case "dict":
-                return self.sparql_results_to_dict(qr)
-            case _:
-                logger_t.warning(
-                    f"Unrecoginzed format={format}, defaulting to 'dataframe' output"
-                )
-                return self.sparql_results_to_df(qr)
+        """Select with a template, `cached=False` always reads the store (state checks before a write)"""
+        named_graph_uri, thesaurus_fields = self._thesaurus_resolution(
+            query_filename, override_named_graph_uri or self.default_named_graph_uri
+        )
+        key = self._result_cache_key(query_filename, kwargs, named_graph_uri, format)
+        if cached:
+            result = self.result_cache.get(key)
+            if result is not QueryResultCache.MISS:
+                return result
+        generation = self.result_cache.generation
+
+        def fetch():
+            query_string = self._render_select_template(query_filename, kwargs)
+            logger_t.debug(f"Select Query:\n{query_string}")
+
+            variables, rows = self.select_rows(query_string, named_graph_uri)
+            if thesaurus_fields is not None:
+                variables, rows = self._thesaurus_enrich(variables, rows, thesaurus_fields)
+            result = self.sparql_rows_to(variables, rows, format)
+            if not cached:
+                return result
+            return self.result_cache.put(key, named_graph_uri, result, generation)
+
+        if not cached:  # a flight started before the caller's write would answer pre-write rows
+            return fetch()
+        return self.single_flight.do(key, query_filename, fetch)
 
     @GraphStore.raise_exceptions_query
     def select_templated_parametrized(
         self,
         query_filename: str,
         format: str = "dataframe",
-        enforce_parameters: Mapping[str, str] | None = None,
+        enforce_parameters: Mapping[str, Any] | list[Mapping[str, Any]] | None = None,
         named_graph_uri: Optional[str] = None,
+        cached: bool = True,
         **kwargs,
     ) -> pd.DataFrame:
-        query_path = Path(self.config["datapip_sparql_select_path"], query_filename)
-        with open(query_path, "r", encoding="utf-8") as file:
-            if len(kwargs) == 0:
-                query_string = file.read()
-            else:
-                s = file.read()
-                query_string = Template(s).substitute(
-                    kwargs
-                )  # squery = s.format(**kwargs)
-
-        if enforce_parameters is not None:
-                logger_t.debug(f"enforce={enforce_parameters}")
-                enforce_parameters = {
-                    f"?{k}": f"'{v}'"
-                    for k, v in enforce_parameters.items()
-                    if v is not None
-                }  # escapes `None` values, add the `?` for wildcards replacements (cf SPARQL 1.1)
-                logger_t.debug(f"enforcepost={enforce_parameters}")
-                if enforce_parameters is not {}:
-                    keys = (re.escape(k) for k in enforce_parameters.keys())
-                    pattern = re.compile(r"(" + "".join(keys) + r")")
-                    query_string = pattern.sub(
-                        lambda x: enforce_parameters[x.group()], query_string
-                    )
-
-        logger_t.debug(f"Select Query:\n{query_string}")
-
-        g = Graph(
-            store=self.client,
-            identifier=named_graph_uri,  # .lstrip('/'),
-            bind_namespaces="none",
-        )  # Do not load default rdflib namespaces, keep queries self-contained
-        qr = g.query(query_string)
-
-        match format:
-            case "dataframe":
-                return self.sparql_results_to_df(qr)
-            case "json":
-                return self.sparql_results_to_json(qr)
-            case "dict":
-                return self.sparql_results_to_dict(qr)
-            case _:
-                logger_t.warning(
-                    f"Unrecoginzed format={format}, defaulting to 'dataframe' output"
-                )
-                return self.sparql_results_to_df(qr)
+        named_graph_uri = named_graph_uri or self.default_named_graph_uri
+        key = self._result_cache_key(
+            query_filename,
+            kwargs | {"__enforce_parameters__": enforce_parameters},
+            named_graph_uri,
+            format,
+        )
+        if cached:
+            result = self.result_cache.get(key)
+            if result is not QueryResultCache.MISS:
+                return result
+        generation = self.result_cache.generation
+
+        def fetch():
+            query_string = self._render_select_template(query_filename, kwargs)
+            if enforce_parameters is not None:
+                query_string = self.bind_values(query_string, enforce_parameters)
+
+            logger_t.debug(f"Select Query:\n{query_string}")
+
+            variables, rows = self.select_rows(query_string, named_graph_uri)
+            result = self.sparql_rows_to(variables, rows, format)
+            if not cached:
+                return result
+            return self.result_cache.put(key, named_graph_uri, result, generation)
+
+        if not cached:  # a flight started before the caller's write would answer pre-write rows
+            return fetch()
+        return self.single_flight.do(key, query_filename, fetch)
+
+    # Streaming
+    PROJECTION_PATTERN = re.compile(r"(?is)\(.*?\bAS\s+\?(\w+)\s*\)|[?$](\w+)")
+
+    def _projected_variables(self, query_string: str) -> list[str]:
+        """Variables of the SELECT clause, `[]` for `SELECT *`"""
+        select = re.search(r"(?i)\bSELECT\s+((DISTINCT|REDUCED)\s+)?", query_string)
+        projection = query_string[select.end() : self._where_clause_position(query_string)]
+        return [alias or var for alias, var in self.PROJECTION_PATTERN.findall(projection)]
+
+    @staticmethod
+    def _keyset_filter(order_by: str, after) -> str:
+        """Rows sorting after `after` in `ORDER BY ?order_by`: numbers and typed literals (dates...) are compared
+        as values, IRIs and strings by their text
+        """
+        v = f"?{order_by}"
+        if isinstance(after, (int, float)):
+            return f"FILTER({v} > {sparql_term(after)})"
+        text = sparql_term(Literal(str(after)))
+        return (
+            f"FILTER(IF(isLiteral({v}) && DATATYPE({v}) NOT IN (<{XSD}string>, <{RDF_LANG_STRING}>), "
+            f"{v} > STRDT({text}, DATATYPE({v})), STR({v}) > {text}))"
+        )
+
+    def _page_query(
+        self,
+        query_string: str,
+        page_size: int,
+        offset: int = 0,
+        order_by: str | None = None,
+        after=None,
+    ) -> str:
+        """One page of a select: `LIMIT`/`OFFSET` appended to the query, or a keyset page when
+        `after` is given (rows whose `order_by` variable sorts after the last row of the previous page).
+        Without `order_by` nor ORDER BY in the query, pages are ordered by the projected variables,
+        SPARQL does not guarantee the same order from one request to the next otherwise.
+        """
+        tail = query_string[query_string.rindex("}") :]
+        if re.search(r"(?i)\b(LIMIT|OFFSET)\b", tail) is not None:
+            raise ValueError("Query already has a LIMIT/OFFSET, it cannot be paged")
+        has_order = re.search(r"(?i)\bORDER\s+BY\b", tail) is not None
+        if order_by is not None and has_order:
+            raise ValueError("Query already has an ORDER BY, do not pass `order_by`")
+
+        page = query_string.rstrip()
+        if after is not None:
+            position = page.index("{", self._where_clause_position(page)) + 1
+            page = page[:position] + "\n" + self._keyset_filter(order_by, after) + "\n" + page[position:]
+        if order_by is not None:
+            page += f"\nORDER BY ?{order_by}"
+        elif not has_order:
+            variables = self._projected_variables(query_string)
+            if len(variables) == 0:
+                raise ValueError("A `SELECT *` query is paged in no stable order, pass `order_by`")
+            page += "\nORDER BY " + " ".join(f"?{var}" for var in variables)
+        page += f"\nLIMIT {page_size}"
+        if after is None and offset > 0:
+            page += f" OFFSET {offset}"
+        return page
+
+    def iter_select_templated(
+        self,
+        query_filename: str,
+        page_size: int = 1000,
+        order_by: str | None = None,
+        keyset: bool = False,
+        override_named_graph_uri: Optional[str | list[str]] = None,
+        **kwargs,
+    ) -> Iterator[dict]:
+        """Yield the rows of a templated select page by page, only one page is ever held in memory.
+        Pages are `LIMIT`/`OFFSET` slices, ordered by `order_by` when given, by the query's ORDER BY
+        or else by its projected variables (stable paging).
+        With `keyset=True`, pages are filtered on the last `order_by` value instead of skipped by
+        offset, which keeps deep pages cheap but requires `order_by` to be unique per row.
+
+        Args:
+            query_filename (str): select template, without LIMIT/OFFSET
+            page_size (int, optional): rows per request. Defaults to 1000.
+            order_by (str | None, optional): sort variable, without `?`. Defaults to None.
+            keyset (bool, optional): keyset pagination on `order_by`. Defaults to False.
+            override_named_graph_uri (Optional[str | list[str]], optional): graph(s) to query. Defaults to None.
+
+        Yields:
+            dict: rows, see `sparql_json_to_rows`
+        """
+        if keyset and order_by is None:
+            raise ValueError("Keyset pagination needs an `order_by` variable")
+        query_string = self._render_select_template(query_filename, kwargs)
+        named_graph_uri = override_named_graph_uri or self.default_named_graph_uri
+
+        offset, after = 0, None
+        while True:
+            _, rows = self.select_rows(
+                self._page_query(query_string, page_size, offset, order_by, after),
+                named_graph_uri,
+            )
+            yield from rows
+            if len(rows) < page_size:
+                return
+            offset += page_size
+            if keyset:
+                after = rows[-1][order_by]
+
+    # Batched selects
+    @GraphStore.raise_exceptions_query
+    def select_many(
+        self,
+        query_filename: str,
+        rows: list[Mapping[str, Any]],
+        format: str = "dict",
+        chunk_size: int = 200,
+        override_named_graph_uri: Optional[str | list[str]] = None,
+        **kwargs,
+    ) -> list:
+        """Run a templated select once for many bindings instead of once per entity.
+        The `<$key>` / `"$key"` slots of the keys of `rows` are bound with a VALUES block,
+        `chunk_size` rows per query, and the results are split back per input row.
+
+        Args:
+            query_filename (str): select template
+            rows (list[Mapping[str, Any]]): bindings of the batched placeholders, same keys for every row
+            format (str, optional): format of each row's result. Defaults to "dict".
+            chunk_size (int, optional): rows bound in one query. Defaults to 200.
+            override_named_graph_uri (Optional[str | list[str]], optional): graph(s) to query. Defaults to None.
+            **kwargs: placeholders shared by every row
+
+        Returns:
+            list: one result per input row, in the order of `rows`
+        """
+        if len(rows) == 0:
+            return []
+        keys = list(rows[0].keys())
+        named_graph_uri = override_named_graph_uri or self.default_named_graph_uri
+        query_string, kinds, empty = self._batch_query(query_filename, keys, kwargs)
+
+        variables, results = [], []
+        for chunk in self._batch_chunks(keys, rows, chunk_size):
+            variables, chunk_results = self.select_rows(
+                self.bind_values(query_string, self._batch_bindings(keys, kinds, chunk)),
+                named_graph_uri,
+            )
+            results += chunk_results
+        logger_t.debug(f"select_many {query_filename}: {len(rows)} rows, {len(results)} results")
+        return self._batch_split(keys, rows, variables, results, format, empty)
 
     # Update
     def update_static(self, query_string: str):
-        self.client.update(query_string, queryGraph=self.default_named_graph_uri)
+        self.replicas.pin(self.default_named_graph_uri)  # read-your-writes: the replicas may lag behind the primary
+        self.client.update(
+            self.versioned_update(
+                insert_named_graph(query_string, self.default_named_graph_uri),
+                self.default_named_graph_uri,
+            )
+        )
+        self.on_graph_changed(self.default_named_graph_uri)
 
     # @GraphStore.raise_exceptions_query
     def update_templated(self, 
                          query_filename: str,
                          query_graph_override: str | None = None,
                          **kwargs) -> pd.DataFrame:
-        try:
-            query_path = Path(self.config["datapip_sparql_update_path"], query_filename)
-        except KeyError as ke1:
+        if "datapip_sparql_update_path" not in self.config:
+            ke1 = KeyError("datapip_sparql_update_path")
             logger_t.error(ke1)
             logger_t.error(
                 f"Incomplete config for select queries, add  'datapip_sparql_update_path' to your config={self.config}"
             )
             return ke1
 
-        uris = {}
-        with open(query_path, "r", encoding="utf-8") as file:
-            s = file.read()
+        supdate, uris = self._render_update_template(query_filename, kwargs)
 
-            uris_match = set(
-                re.findall(pattern="<\\$__uri__(.*?)>", string=s)
-            )  # set(findall(pattern, string)) for distincts matches
-            for u_number in uris_match:
+        # Update
+        if query_graph_override == None:
+            logger_t.warning(f"query_graph_override={query_graph_override} {self.default_named_graph_uri}")
+        else:
+            logger_t.warning(f"query_graph_override={query_graph_override}")
+        graph = query_graph_override or self.default_named_graph_uri
+        self.replicas.pin(graph)  # read-your-writes: the replicas may lag behind the primary
+        self.client.update(
+            self.versioned_update(insert_named_graph(supdate, graph), graph)
+        )
+        self.on_graph_changed(graph)
 
-                def simple_uuid_uri_generator() -> str:
-                    return (
-                        self.config["default_triples_root_uri"] + str(uuid.uuid4())[:8]
-                    )
+        return uris
 
-                urikey = f"__uri__{u_number}"
-                uris[urikey] = simple_uuid_uri_generator()
-            logger_t.debug(f"Created {len(uris_match)} URIs : {uris}")
+    # Async
+    @property
+    @cache
+    def aclient(self) -> AsyncSparqlClient:
+        return AsyncSparqlClient(
+            query_endpoint=self.replicas.primary,
+            update_endpoint=self.config_store.get("update_endpoint"),
+            auth=self.config_store.get("auth"),
+            pool_size=self.config.get("sparql_async_pool_size", 32),
+            limit_per_endpoint=self.config.get("sparql_async_limit_per_endpoint", 8),
+            timeout=self.config.get("sparql_async_timeout", 60.0),
+            connect_timeout=self.config.get("sparql_async_connect_timeout", 5.0),
+        )
 
-            supdate = Template(s).substitute(kwargs | uris)
-            logger_t.debug(f"--- --- SUBSTITUED TEMPLATE CONTENT --- ---\n{supdate}")
+    async def aselect_rows(
+        self, query_string: str, named_graph_uri: str | list[str]
+    ) -> tuple[list[str], list[dict]]:
+        """Async `select_rows`"""
+        if isinstance(named_graph_uri, str):
+            return await self.replicas.acall(
+                lambda endpoint: self.aclient.query(
+                    query_string, default_graph_uri=named_graph_uri, endpoint=endpoint
+                ),
+                named_graph_uri,
+            )
+        query_string = self.inject_dataset_clauses(query_string, named_graph_uri)
+        return await self.replicas.acall(
+            lambda endpoint: self.aclient.query(query_string, endpoint=endpoint), named_graph_uri
+        )
 
-            # Update
-            if query_graph_override == None:
-                logger_t.warning(f"query_graph_override={query_graph_override} {self.default_named_graph_uri}")
-                self.client.update(supdate, queryGraph=self.default_named_graph_uri)
-            else:
-                logger_t.warning(f"query_graph_override={query_graph_override}")
-                self.client.update(supdate, queryGraph=query_graph_override)
+    @GraphStore.raise_exceptions_aquery
+    async def aselect_static(
+        self,
+        query_string: str,
+        override_named_graph_uri: Optional[str | list[str]] = None,
+        format: str = "dataframe",
+    ) -> pd.DataFrame:
+        """Async `select_static`"""
+        variables, rows = await self.aselect_rows(
+            query_string, override_named_graph_uri or self.default_named_graph_uri
+        )
+        return self.sparql_rows_to(variables, rows, format)
 
+    @GraphStore.raise_exceptions_aquery
+    async def aselect_templated(
+        self,
+        query_filename: str,
+        format: str = "dataframe",
+        override_named_graph_uri: Optional[str | list[str]] = None,
+        cached: bool = True,
+        **kwargs,
+    ) -> pd.DataFrame:
+        """Async `select_templated`, the event loop keeps serving other requests during the round trip"""
+        named_graph_uri, thesaurus_fields = self._thesaurus_resolution(
+            query_filename, override_named_graph_uri or self.default_named_graph_uri
+        )
+        key = self._result_cache_key(query_filename, kwargs, named_graph_uri, format)
+        if cached:
+            result = self.result_cache.get(key)
+            if result is not QueryResultCache.MISS:
+                return result
+        generation = self.result_cache.generation
+
+        async def fetch():
+            query_string = self._render_select_template(query_filename, kwargs)
+            logger_t.debug(f"Select Query:\n{query_string}")
+
+            variables, rows = await self.aselect_rows(query_string, named_graph_uri)
+            if thesaurus_fields is not None:
+                variables, rows = self._thesaurus_enrich(variables, rows, thesaurus_fields)
+            result = self.sparql_rows_to(variables, rows, format)
+            if not cached:
+                return result
+            return self.result_cache.put(key, named_graph_uri, result, generation)
+
+        if not cached:  # a flight started before the caller's write would answer pre-write rows
+            return await fetch()
+        return await self.single_flight.ado(key, query_filename, fetch)
+
+    @GraphStore.raise_exceptions_aquery
+    async def aupdate_templated(
+        self,
+        query_filename: str,
+        query_graph_override: str | None = None,
+        **kwargs,
+    ) -> dict:
+        """Async `update_templated`, returns the URIs minted for the `<$__uri__N>` slots"""
+        supdate, uris = self._render_update_template(query_filename, kwargs)
+        graph = query_graph_override or self.default_named_graph_uri
+        supdate = insert_named_graph(supdate, graph)  # what `SPARQLUpdateStore.update(queryGraph=...)` sends
+        self.replicas.pin(graph)  # the caller's task and the next reads of the graph go to the primary
+        await self.aclient.update(self.versioned_update(supdate, graph))
+        self.on_graph_changed(graph)
         return uris
 
+    @GraphStore.raise_exceptions_aquery
+    async def aselect_many(
+        self,
+        query_filename: str,
+        rows: list[Mapping[str, Any]],
+        format: str = "dict",
+        chunk_size: int = 200,
+        override_named_graph_uri: Optional[str | list[str]] = None,
+        **kwargs,
+    ) -> list:
+        """Async `select_many`, the chunks are queried concurrently"""
+        if len(rows) == 0:
+            return []
+        keys = list(rows[0].keys())
+        named_graph_uri = override_named_graph_uri or self.default_named_graph_uri
+        query_string, kinds, empty = self._batch_query(query_filename, keys, kwargs)
+
+        chunks = await asyncio.gather(
+            *(
+                self.aselect_rows(
+                    self.bind_values(query_string, self._batch_bindings(keys, kinds, chunk)),
+                    named_graph_uri,
+                )
+                for chunk in self._batch_chunks(keys, rows, chunk_size)
+            )
+        )
+        variables = chunks[0][0]
+        results = [result for _, chunk_results in chunks for result in chunk_results]
+        return self._batch_split(keys, rows, variables, results, format, empty)
+
+    async def aiter_select_templated(
+        self,
+        query_filename: str,
+        page_size: int = 1000,
+        order_by: str | None = None,
+        keyset: bool = False,
+        override_named_graph_uri: Optional[str | list[str]] = None,
+        **kwargs,
+    ) -> AsyncIterator[dict]:
+        """Async `iter_select_templated`, the next page is requested while the current one is consumed"""
+        if keyset and order_by is None:
+            raise ValueError("Keyset pagination needs an `order_by` variable")
+        query_string = self._render_select_template(query_filename, kwargs)
+        named_graph_uri = override_named_graph_uri or self.default_named_graph_uri
+
+        offset = 0
+        page = asyncio.ensure_future(
+            self.aselect_rows(self._page_query(query_string, page_size, 0, order_by), named_graph_uri)
+        )
+        try:
+            while page is not None:
+                _, rows = await page
+                page = None
+                if len(rows) == page_size:
+                    offset += page_size
+                    after = rows[-1][order_by] if keyset else None
+                    page = asyncio.ensure_future(
+                        self.aselect_rows(
+                            self._page_query(query_string, page_size, offset, order_by, after),
+                            named_graph_uri,
+                        )
+                    )  # prefetch
+                for row in rows:
+                    yield row
+        finally:
+            if page is not None:
+                page.cancel()  # client gone
+
+    # Export
+    EXPORT_PARTS_PROPERTY = "http://astragale.cnrs.fr/sem/acrm/P89_falls_within"
+
+    def export_query(self, root_uri: str, depth: int = 3) -> str:
+        """CONSTRUCT of a builtwork subgraph: the builtwork, its parts at any level, and every resource
+        reaching one of them through up to `depth` incoming links other than `rdf:type`
+        (geometries, annotations, annotation layers, simulations...), with all their outgoing triples.
+        """
+        root = URIRef(root_uri).n3()
+        parts = f"<{self.EXPORT_PARTS_PROPERTY}>*"
+        members = [f"{{ ?s {parts} {root} }}"] + [
+            f"{{ ?s {'/'.join(['!rdf:type'] * n)} ?part . ?part {parts} {root} }}" for n in range(1, depth + 1)
+        ]
+        members = "\n    UNION ".join(members)
+        return f"""PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+CONSTRUCT {{ ?s ?p ?o }} WHERE {{
+    {members}
+    ?s ?p ?o .
+}}"""
+
+    def iter_construct(
+        self,
+        query_string: str,
+        format: str = "nt",
+        named_graph_uri: str | None = None,
+        chunk_size: int = 1 << 16,
+    ) -> Iterator[bytes]:
+        """Run a CONSTRUCT/DESCRIBE query and yield its serialization as it is received,
+        memory stays bounded by `chunk_size` whatever the size of the graph
+
+        Args:
+            query_string (str): CONSTRUCT or DESCRIBE query
+            format (str, optional): 'nt', 'nq' (triples of `named_graph_uri`) or 'ttl'. Defaults to "nt".
+            named_graph_uri (str | None, optional): queried graph, the default named graph if None. Defaults to None.
+            chunk_size (int, optional): bytes read at once. Defaults to 1<<16.
+        """
+        named_graph_uri = named_graph_uri or self.default_named_graph_uri
+        accept = CONSTRUCT_FORMATS["nt" if format == "nq" else format]
+
+        def post(endpoint: str) -> requests.Response:
+            r = self.session.post(
+                endpoint,
+                data={"query": query_string, "default-graph-uri": named_graph_uri},
+                headers={"Accept": accept},
+                stream=True,
+            )
+            if r.status_code >= 400:
+                error = EndpointUnavailable if r.status_code >= 500 else URLError
+                r.close()
+                raise error(f"SPARQL endpoint {endpoint} answered {r.status_code}")
+            return r
+
+        r = self.replicas.call(post, named_graph_uri)
+        rewriter = NQuadsRewriter(named_graph_uri) if format == "nq" else None
+        try:
+            for chunk in r.iter_content(chunk_size):
+                yield chunk if rewriter is None else rewriter.feed(chunk)
+            if rewriter is not None:
+                yield rewriter.close()
+        finally:
+            r.close()
+
+    async def aiter_construct(
+        self,
+        query_string: str,
+        format: str = "nt",
+        named_graph_uri: str | None = None,
+        chunk_size: int = 1 << 16,
+    ) -> AsyncIterator[bytes]:
+        """Async `iter_construct`, the query fails over to another replica until its first bytes arrive"""
+        named_graph_uri = named_graph_uri or self.default_named_graph_uri
+        accept = CONSTRUCT_FORMATS["nt" if format == "nq" else format]
+
+        async def open_stream(endpoint: str):
+            chunks = self.aclient.construct(
+                query_string, accept, default_graph_uri=named_graph_uri, endpoint=endpoint, chunk_size=chunk_size
+            )
+            try:
+                return chunks, await anext(chunks, b"")
+            except BaseException:
+                await chunks.aclose()
+                raise
+
+        chunks, first = await self.replicas.acall(open_stream, named_graph_uri)
+        rewriter = NQuadsRewriter(named_graph_uri) if format == "nq" else None
+        try:
+            yield first if rewriter is None else rewriter.feed(first)
+            async for chunk in chunks:
+                yield chunk if rewriter is None else rewriter.feed(chunk)
+            if rewriter is not None:
+                yield rewriter.close()
+        finally:
+            await chunks.aclose()  # client gone: the connection goes back to the pool
+
+    async def aclose(self):
+        """Close the pooled connections of the async client, e.g. on application shutdown"""
+        await self.aclient.close()
+
 
     # utils
     def rdf4j_graphdb_get_repositories(self, **kwargs) -> pd.DataFrame:
@@ -601,5 +922,5 @@ class TripleStore(GraphStore):
         Returns:
             pd.DataFrame: _description_
         """
-        r = requests.get(url=f"{self.config_store['query_endpoint']}/repositories",**kwargs)
-        return pd.read_csv(io.BytesIO(r.content))
\ No newline at end of file
+        r = requests.get(url=f"{self.replicas.primary}/repositories",**kwargs)
+        return pd.read_csv(io.BytesIO(r.content))
@@ -0,0 +1,219 @@
+# 1.0.dev304.6
+
+import threading
+from urllib.error import HTTPError, URLError
+
+import asyncio
+import aiohttp
+
+from app.loggers import logger_t  # Import
+from fast_clients.fast_sparql import insert_named_graph
+from fast_clients.fast_sparql_async import EndpointUnavailable
+
+# logger_t = logging.getLogger()  # Declare
+# logger_t.setLevel(logging.INFO)  # Declare
+
+
+# Update batching
+def is_transient(error: BaseException) -> bool:
+    """True if an update may succeed when sent again: the endpoint was unreachable, timed out or answered 5xx.
+    A 4xx answer (e.g. a syntax error in one statement) fails again however many times it is sent.
+    """
+    if isinstance(error, HTTPError):  # urllib, raised by the sync client
+        return error.code >= 500
+    if isinstance(error, URLError):
+        return isinstance(error, EndpointUnavailable) or isinstance(error.reason, OSError)
+    return isinstance(error, (OSError, asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+
+class UpdateBatcher:
+    """Accumulates templated updates and sends them as one `;`-separated SPARQL Update request
+    per named graph, once `max_statements` are pending or `window` seconds after the first one.
+    URIs of the `<$__uri__N>` slots are minted when a statement is added, so they are returned right away.
+    Values only fill whole `<$key>` IRI slots and `"$key"` literal slots, rendered as escaped terms.
+
+    Sync use: `add` then `flush` (or a `with` block); async use: `await aadd(...)` returns once its batch is written.
+    A batch failing with a transient error (`is_transient`) is put back in front of the pending statements
+    and sent again by a timer `retry_delay` seconds later (doubled on each failure), at most `max_retries` times.
+    Other failures, and the last one, drop the batch: `flush` raises the error, the timer logs it.
+    In async use the sends are retried the same way, then every caller of the batch gets the error.
+    """
+
+    def __init__(
+        self,
+        store: "TripleStore",
+        max_statements: int = 100,
+        window: float = 0.05,
+        max_retries: int = 3,
+        retry_delay: float = 0.5,
+    ):
+        self.store = store
+        self.max_statements = max_statements
+        self.window = window
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.requests = 0
+        self.statements = 0
+        self.dropped = 0
+        self._pending: dict[str, list[str]] = {}
+        self._failures: dict[str, int] = {}  # consecutive transient failures per graph
+        self._timer: threading.Timer | None = None
+        self._apending: dict[str, list[tuple[str, asyncio.Future]]] = {}
+        self._ahandle: asyncio.TimerHandle | None = None
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def _render(
+        self, query_filename: str, query_graph_override: str | None, kwargs: dict
+    ) -> tuple[str, str, dict]:
+        # values are escaped: a statement breaking the request would fail the other ones joined to it
+        supdate, uris = self.store._render_update_template(query_filename, kwargs, terms=True)
+        graph = query_graph_override or self.store.default_named_graph_uri
+        statement = insert_named_graph(
+            supdate.strip().rstrip(";"), graph
+        )  # each statement carries its GRAPH, the joined request needs no `queryGraph`
+        return graph, statement, uris
+
+    def _sent(self, graph: str, n: int):
+        self.requests += 1
+        self.statements += n
+        self.store.on_graph_changed(graph)
+        logger_t.debug(f"Sent {n} batched statements to named_graph_uri={graph}")
+
+    # Sync
+    def add(self, query_filename: str, query_graph_override: str | None = None, **kwargs) -> dict:
+        graph, statement, uris = self._render(query_filename, query_graph_override, kwargs)
+        self.store.replicas.pin(graph)  # here, in the caller's context, not on the timer thread that sends
+        with self._lock:
+            pending = self._pending.setdefault(graph, [])
+            pending.append(statement)
+            full = len(pending) >= self.max_statements
+            if not full:
+                self._arm_timer(self.window)
+        if full:
+            self.flush(graph)
+        return uris
+
+    def flush(self, graph: str | None = None) -> int:
+        """Send the pending statements of one graph, or of every graph. Returns the number of statements sent"""
+        with self._lock:
+            graphs = list(self._pending) if graph is None else [graph]
+            batches = {g: self._pending.pop(g) for g in graphs if g in self._pending}
+            if len(self._pending) == 0 and self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        items = list(batches.items())
+        for i, (g, statements) in enumerate(items):
+            try:
+                self.store.client.update(self.store.versioned_update(" ;\n".join(statements), g))
+            except Exception as e:
+                kept = dict(items[i + 1 :])  # not tried yet
+                failures = self._failures.get(g, 0) + 1
+                if is_transient(e) and failures <= self.max_retries:
+                    self._failures[g] = failures
+                    kept = {g: statements} | kept
+                    logger_t.warning(
+                        f"Batched update failed ({failures}/{self.max_retries}): {type(e)} {e}, "
+                        f"{len(statements)} statements to named_graph_uri={g} kept"
+                    )
+                else:
+                    self._failures.pop(g, None)
+                    self.dropped += len(statements)
+                    logger_t.error(
+                        f"Batched update failed: {type(e)} {e}, {len(statements)} statements to named_graph_uri={g} dropped"
+                    )
+                self._requeue(kept)
+                raise
+            self._failures.pop(g, None)
+            self._sent(g, len(statements))
+        return sum(len(statements) for statements in batches.values())
+
+    def _requeue(self, batches: dict[str, list[str]]):
+        with self._lock:
+            for g, statements in batches.items():
+                self._pending[g] = statements + self._pending.get(g, [])
+            if self._pending:
+                failures = max([self._failures.get(g, 0) for g in self._pending], default=0)
+                self._arm_timer(max(self.window, self.retry_delay * 2 ** max(failures - 1, 0)))
+
+    def _arm_timer(self, delay: float):
+        """Flush in `delay` seconds, unless a flush is already planned. Called under `_lock`"""
+        if self._timer is None:
+            self._timer = threading.Timer(delay, self._flush_on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_on_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        except Exception:
+            pass  # logged by `flush`, what is kept has re-armed the timer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    # Async
+    async def aadd(
+        self, query_filename: str, query_graph_override: str | None = None, **kwargs
+    ) -> dict:
+        graph, statement, uris = self._render(query_filename, query_graph_override, kwargs)
+        self.store.replicas.pin(graph)  # in the caller's task, not in the task that sends the batch
+        loop = asyncio.get_running_loop()
+        written = loop.create_future()
+        pending = self._apending.setdefault(graph, [])
+        pending.append((statement, written))
+        if len(pending) >= self.max_statements:
+            self._schedule(self._asend(self._atake(graph)))
+        elif self._ahandle is None:
+            self._ahandle = loop.call_later(
+                self.window, lambda: self._schedule(self._asend(self._atake()))
+            )
+        await asyncio.shield(written)
+        return uris
+
+    def _schedule(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _atake(self, graph: str | None = None) -> dict[str, list[tuple[str, asyncio.Future]]]:
+        graphs = list(self._apending) if graph is None else [graph]
+        batches = {g: self._apending.pop(g) for g in graphs if g in self._apending}
+        if len(self._apending) == 0 and self._ahandle is not None:
+            self._ahandle.cancel()
+            self._ahandle = None
+        return batches
+
+    async def aflush(self, graph: str | None = None) -> int:
+        """Send the pending statements of one graph, or of every graph. Returns the number of statements sent"""
+        return await self._asend(self._atake(graph))
+
+    async def _asend(self, batches: dict[str, list[tuple[str, asyncio.Future]]]) -> int:
+        async def send(g: str, items: list[tuple[str, asyncio.Future]]):
+            update = self.store.versioned_update(" ;\n".join(s for s, _ in items), g)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    await self.store.aclient.update(update)
+                    break
+                except Exception as e:
+                    if is_transient(e) and attempt < self.max_retries:
+                        logger_t.warning(f"Batched update failed ({attempt + 1}/{self.max_retries}): {type(e)} {e}")
+                        await asyncio.sleep(self.retry_delay * 2**attempt)
+                        continue
+                    logger_t.error(f"Batched update failed: {type(e)} {e}, {len(items)} statements to named_graph_uri={g}")
+                    for _, written in items:
+                        if not written.done():
+                            written.set_exception(e)
+                    return
+            self._sent(g, len(items))
+            for _, written in items:
+                if not written.done():
+                    written.set_result(None)
+
+        await asyncio.gather(*(send(g, items) for g, items in batches.items()))
+        return sum(len(items) for items in batches.values())
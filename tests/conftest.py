@@ -0,0 +1,21 @@
+import importlib.util
+import sys
+import types
+
+# The routers import the Kafka admin client at module level, it is only instantiated once connected
+# to a broker: a stand-in lets the tests import them where `confluent_kafka` is not installed.
+if importlib.util.find_spec("confluent_kafka") is None:
+    admin = types.ModuleType("confluent_kafka.admin")
+    admin.AdminClient = type("AdminClient", (), {})
+    admin.NewTopic = type("NewTopic", (), {})
+    confluent_kafka = types.ModuleType("confluent_kafka")
+    confluent_kafka.admin = admin
+    sys.modules.update({"confluent_kafka": confluent_kafka, "confluent_kafka.admin": admin})
+
+# The service sessions are built from a deployment's environment (app/sessions.py), tests that
+# import the routers pass their own clients to the handlers.
+import app.sessions
+
+for name in ("triplestore", "s3", "localfiles", "kafkaio"):
+    if not hasattr(app.sessions, name):
+        setattr(app.sessions, name, None)
@@ -0,0 +1,388 @@
+import asyncio
+import gzip
+import hashlib
+import io
+import tarfile
+import time
+import zipfile
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+import zstandard
+from botocore.exceptions import ClientError
+from fastapi import UploadFile
+
+import fast_clients.fast_files as fast_files
+from fast_clients.fast_files import S3, BulkReport, GeometryStatsScanner, _RateLimiter
+
+
+class FakeS3Client:
+    """In-memory stand-in of the few boto3 s3 client methods used by the bulk engine"""
+
+    def __init__(self, objects: dict[tuple[str, str], bytes] | None = None):
+        self.objects = dict(objects or {})
+        self.heads = {}
+        self.calls = []
+        self.signed = 0
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                contents = [
+                    {"Key": key, "Size": len(body), "ETag": f'"{hashlib.md5(body).hexdigest()}"', "LastModified": datetime.now(timezone.utc)}
+                    for (bucket, key), body in sorted(client.objects.items())
+                    if bucket == Bucket and key.startswith(Prefix)
+                ]
+                for i in range(0, len(contents), 2):  # small pages
+                    yield {"Contents": contents[i : i + 2]}
+
+        return Paginator()
+
+    def copy_object(self, CopySource, Bucket, Key):
+        self.calls.append(("copy", CopySource["Key"], Key))
+        self.objects[(Bucket, Key)] = self.objects[(CopySource["Bucket"], CopySource["Key"])]
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append(("put", Key))
+        self.objects[(Bucket, Key)] = Body
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            self.calls.append(("delete", obj["Key"]))
+            del self.objects[(Bucket, obj["Key"])]
+        return {}
+
+    def upload_fileobj(self, fileobj, Bucket, Key, ExtraArgs=None):
+        self.objects[(Bucket, Key)] = fileobj.read()
+        self.heads[(Bucket, Key)] = {k: v for k, v in (ExtraArgs or {}).items() if k in ("ContentEncoding", "Metadata")}
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.objects[(Bucket, Key)])} | self.heads.get((Bucket, Key), {})
+
+    def get_object(self, Bucket, Key):
+        self.calls.append(("get", Key))
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])} | self.heads.get((Bucket, Key), {})
+
+    def generate_presigned_url(self, method, Params, ExpiresIn):
+        self.signed += 1
+        return f"https://s3.test/{Params['Bucket']}/{Params['Key']}?expires={ExpiresIn}&sig={self.signed}"
+
+
+class FakeS3(S3):
+    def __init__(self, objects=None, config=None):
+        super().__init__(config)
+        self.fake_client = FakeS3Client(objects)
+
+    @property
+    def client(self):
+        return self.fake_client
+
+
+def slow_down():
+    return ClientError({"Error": {"Code": "SlowDown"}, "ResponseMetadata": {"HTTPStatusCode": 503}}, "CopyObject")
+
+
+def test_rate_limiter_spaces_requests():
+    limiter = _RateLimiter(200)
+    start = time.monotonic()
+    for _ in range(250):  # the bucket starts full with 200 tokens
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.2
+
+
+def test_rate_limiter_without_rate_never_waits():
+    limiter = _RateLimiter(None)
+    start = time.monotonic()
+    for _ in range(10000):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.5
+
+
+def test_bulk_run_retries_throttled_tasks_and_reports_failures():
+    attempts = {"a": 0, "b": 0}
+
+    def throttled_once():
+        attempts["a"] += 1
+        if attempts["a"] == 1:
+            raise slow_down()
+        return 1, 10
+
+    def denied():
+        attempts["b"] += 1
+        raise ClientError({"Error": {"Code": "AccessDenied"}, "ResponseMetadata": {"HTTPStatusCode": 403}}, "CopyObject")
+
+    tasks = [({"Key": "a"}, throttled_once), ({"Key": "b"}, denied), ({"Key": "c"}, None)]
+    report = FakeS3()._bulk_run(BulkReport(operation="copy"), iter(tasks), workers=2, max_retries=3, rate_limit=None)
+
+    assert attempts == {"a": 2, "b": 1}  # only retryable errors are retried
+    assert (report.listed, report.transferred, report.skipped, report.failed, report.bytes) == (3, 1, 1, 1, 10)
+    assert report.status is False
+    assert report.errors[0].startswith("b: ")
+
+
+def test_bulk_copy_prefix_keeps_relative_keys():
+    objects = {("src", f"layer/{i}.ply"): b"x" * i for i in range(5)}
+    objects[("src", "other/0.ply")] = b"y"
+    s3 = FakeS3(objects)
+
+    report = s3.bulk_copy_prefix("s3://src/layer", "s3://dst/moved/layer", workers=3)
+
+    assert report.status is True and report.transferred == 5 and report.bytes == 10
+    assert sorted(k for b, k in s3.fake_client.objects if b == "dst") == [f"moved/layer/{i}.ply" for i in range(5)]
+
+
+def test_bulk_sync_prefix_copies_changed_objects_only():
+    s3 = FakeS3({
+        ("src", "layer/same.ply"): b"same",
+        ("src", "layer/changed.ply"): b"new",  # same size, other content
+        ("src", "layer/new.ply"): b"n",
+        ("dst", "layer/same.ply"): b"same",
+        ("dst", "layer/changed.ply"): b"old",
+        ("dst", "layer/extra.ply"): b"x",
+    })
+
+    report = s3.bulk_sync_prefix("s3://src/layer", "s3://dst/layer", workers=2)
+
+    assert (report.operation, report.listed, report.transferred, report.skipped) == ("sync", 3, 2, 1)
+    assert sorted(key for op, _, key in (c for c in s3.client.calls if c[0] == "copy")) == ["layer/changed.ply", "layer/new.ply"]
+    assert s3.client.objects[("dst", "layer/changed.ply")] == b"new"
+    assert ("dst", "layer/extra.ply") in s3.client.objects  # kept without `delete`
+
+    report = s3.bulk_sync_prefix("s3://src/layer", "s3://dst/layer", delete=True)
+
+    assert (report.transferred, report.skipped, report.status) == (0, 3, True)
+    assert sorted(k for b, k in s3.client.objects if b == "dst") == ["layer/changed.ply", "layer/new.ply", "layer/same.ply"]
+
+
+def test_bulk_sync_prefix_trusts_the_size_of_multipart_objects(monkeypatch):
+    s3 = FakeS3({("src", "layer/a.ply"): b"aa", ("dst", "layer/a.ply"): b"bb"})
+    iter_objects = s3.iter_s3_objects_at_prefix
+
+    def multipart(s3_url):
+        for obj in iter_objects(s3_url):
+            yield obj | {"ETag": '"abc-2"'} if s3_url.startswith("s3://src") else obj
+
+    monkeypatch.setattr(s3, "iter_s3_objects_at_prefix", multipart)
+    report = s3.bulk_sync_prefix("s3://src/layer", "s3://dst/layer")
+    assert (report.transferred, report.skipped) == (0, 1)
+
+
+def test_bulk_move_prefix_deletes_sources_after_copy():
+    s3 = FakeS3({("b", "campaign/a.jpg"): b"a", ("b", "campaign/b.jpg"): b"b"})
+
+    report = s3.bulk_move_prefix("s3://b/campaign", "s3://b/archive/campaign")
+
+    assert report.operation == "move" and report.status is True
+    assert sorted(k for _, k in s3.fake_client.objects) == ["archive/campaign/a.jpg", "archive/campaign/b.jpg"]
+
+
+def layer_folder() -> FakeS3:
+    s3 = FakeS3({
+        ("b", "layer/"): b"",  # folder placeholder
+        ("b", "layer/a.txt"): b"a",
+        ("b", "layer/sub/b.ply"): gzip.compress(b"ply bb"),
+        ("b", "layer/c.txt"): b"ccc",
+        ("b", "other/d.txt"): b"d",
+    })
+    s3.client.heads[("b", "layer/sub/b.ply")] = {"ContentEncoding": "gzip", "Metadata": {"biglake-codec": "gzip"}}
+    return s3
+
+
+def read_tar(data: bytes) -> dict[str, bytes]:
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar.getmembers()}
+
+
+def read_zip(data: bytes) -> dict[str, bytes]:
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+@pytest.mark.parametrize("archive_format, read", [("tar", read_tar), ("zip", read_zip)])
+def test_stream_archive_of_folder(archive_format, read):
+    s3 = layer_folder()
+
+    data = b"".join(s3.stream_archive_of_folder("s3://b/layer", archive_format=archive_format, read_ahead=2))
+
+    assert read(data) == {"a.txt": b"a", "c.txt": b"ccc", "sub/b.ply": b"ply bb"}  # members decoded
+
+
+def test_stream_archive_of_folder_reads_ahead_a_few_members_only():
+    s3 = layer_folder()
+
+    chunks = s3.stream_archive_of_folder("s3://b/layer", read_ahead=1)
+    first = next(chunks)  # one member written
+    assert len([call for call in s3.client.calls if call[0] == "get"]) <= 3  # of the 4 objects
+    assert read_tar(first + b"".join(chunks)) == {"a.txt": b"a", "c.txt": b"ccc", "sub/b.ply": b"ply bb"}
+
+
+def test_stream_archive_of_folder_rejects_unknown_formats():
+    with pytest.raises(ValueError):
+        next(layer_folder().stream_archive_of_folder("s3://b/layer", archive_format="rar"))
+
+
+def test_bulk_download_prefix_rejects_keys_outside_destination(tmp_path):
+    s3 = FakeS3({
+        ("b", "layer/a.txt"): b"a",
+        ("b", "layer/sub/b.txt"): b"bb",
+        ("b", "layer/../../escaped.txt"): b"evil",
+    })
+    dest = tmp_path / "dest"
+
+    report = s3.bulk_download_prefix("s3://b/layer", dest, workers=2)
+
+    assert (dest / "a.txt").read_bytes() == b"a"
+    assert (dest / "sub" / "b.txt").read_bytes() == b"bb"
+    assert not (tmp_path / "escaped.txt").exists()
+    assert report.transferred == 2 and report.failed == 1
+    assert "escaped.txt" in report.errors[0]
+
+
+def test_extract_archive_uploads_members_with_the_bulk_engine(monkeypatch):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, content in [("layer/a.txt", b"a"), ("layer/sub/b.txt", b"bb")]:
+            member = tarfile.TarInfo(name)
+            member.size = len(content)
+            tar.addfile(member, io.BytesIO(content))
+    s3 = FakeS3()
+    monkeypatch.setattr(fast_files.smart_open, "open", lambda url, mode, **kwargs: io.BytesIO(buf.getvalue()))
+
+    report = s3.extract_archive("s3://b/layer.tar.gz", workers=2)
+
+    assert report.status is True and report.transferred == 2 and report.bytes == 3
+    assert s3.client.objects[("b", "layer/sub/b.txt")] == b"bb"
+
+
+def test_presigned_url_is_reused_per_expiration():
+    s3 = FakeS3(config={"presigned_refresh_margin": 300})
+
+    url = s3.create_presigned_url("s3://b/geom.ply")
+    assert s3.create_presigned_url("s3://b/geom.ply") == url
+    assert s3.create_presigned_url("s3://b/geom.ply", expiration=7200) != url  # longer validity asked, new signature
+    short = s3.create_presigned_url("s3://b/geom.ply", expiration=120)  # below the margin, still cached
+    assert s3.create_presigned_url("s3://b/geom.ply", expiration=120) == short
+    assert s3.client.signed == 3
+
+
+def test_presigned_url_is_renewed_close_to_expiry():
+    s3 = FakeS3(config={"presigned_refresh_margin": 300})
+
+    url = s3.create_presigned_url("s3://b/geom.ply", expiration=2)
+    assert s3.create_presigned_url("s3://b/geom.ply", expiration=2) == url
+    time.sleep(1.1)  # less than half of the validity left
+    assert s3.create_presigned_url("s3://b/geom.ply", expiration=2) != url
+
+
+def upload(s3: S3, content: bytes, url: str):
+    return asyncio.run(s3.upload(file=UploadFile(file=io.BytesIO(content), filename=url.rsplit("/", 1)[-1]), url_s3=url))
+
+
+def test_upload_compresses_text_geometries_and_reports_their_size():
+    s3 = FakeS3(config={"compress_text_geometries": True})
+    content = b"".join(b"%d.0 %d.5 1.25\n" % (i, i) for i in range(1000))
+
+    result = upload(s3, content, "s3://b/survey/cloud.xyz")
+
+    assert result.content_encoding == "gzip"
+    assert result.size == len(content)  # logical size, not the compressed one
+    assert len(s3.client.objects[("b", "survey/cloud.xyz")]) < len(content)
+    assert gzip.decompress(s3.client.objects[("b", "survey/cloud.xyz")]) == content
+    assert result.geometry_stats.count == 1000
+
+
+def test_zstd_is_kept_for_internal_objects():
+    s3 = FakeS3(config={"compress_text_geometries": True, "compression_codec": "zstd", "compression_internal_prefixes": ["cache/"]})
+    content = b"1 2 3\n" * 100
+
+    assert upload(s3, content, "s3://b/survey/cloud.xyz").content_encoding == "gzip"  # may be presigned
+    assert upload(s3, content, "s3://b/cache/cloud.xyz").content_encoding == "zstd"
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(s3.client.objects[("b", "cache/cloud.xyz")]) == content
+    assert s3.create_presigned_url("s3://b/survey/cloud.xyz") is not None
+    assert s3.create_presigned_url("s3://b/cache/cloud.xyz") is None
+
+
+def test_compressed_objects_are_decoded_on_read(tmp_path, monkeypatch):
+    s3 = FakeS3(config={"compress_text_geometries": True, "compression_codec": "zstd", "compression_internal_prefixes": ["cache/"]})
+    content = b"".join(b"%d 0 0\n" % i for i in range(100))
+    upload(s3, content, "s3://b/cache/a.xyz")
+    upload(s3, content, "s3://b/cache/b.pts")
+    monkeypatch.setattr(
+        fast_files.smart_open, "open",
+        lambda url, mode, **kwargs: io.BytesIO(s3.client.objects[tuple(url[5:].split("/", 1))]),
+    )
+
+    with s3.open_geometry("s3://b/cache/a.xyz") as fin:
+        assert fin.read() == content
+
+    report = s3.bulk_download_prefix("s3://b/cache", tmp_path)
+    assert report.transferred == 2
+    assert report.bytes == 2 * len(content)  # decoded bytes written, not the stored ones
+    assert (tmp_path / "a.xyz").read_bytes() == content
+    assert (tmp_path / "b.pts").read_bytes() == content
+
+    gets = len([call for call in s3.client.calls if call[0] == "get"])
+    report = s3.bulk_download_prefix("s3://b/cache", tmp_path)
+    assert (report.skipped, report.transferred) == (2, 0)  # matched against their logical size
+    assert len([call for call in s3.client.calls if call[0] == "get"]) == gets
+
+
+POINTS = np.array([[0.0, 1.0, 2.0], [4.0, -1.0, 0.5], [2.0, 3.0, -2.0]])
+
+
+def binary_ply(points, elements_before_vertex: str = "") -> bytes:
+    header = (
+        "ply\nformat binary_little_endian 1.0\n" + elements_before_vertex
+        + f"element vertex {len(points)}\nproperty float x\nproperty float y\nproperty float z\nproperty uchar red\n"
+        + "element face 1\nproperty list uchar int vertex_indices\nend_header\n"
+    )
+    records = np.zeros(len(points), dtype=[("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("red", "u1")])
+    records["x"], records["y"], records["z"] = points.T
+    return header.encode() + records.tobytes() + bytes([3]) + np.array([0, 1, 2], "<i4").tobytes()
+
+
+def scan(scanner: GeometryStatsScanner, content: bytes, cuts: list[int]):
+    for start, end in zip([0] + cuts, cuts + [len(content)]):
+        scanner.feed(content[start:end])
+    return scanner.result()
+
+
+def test_geometry_stats_of_a_binary_ply_whatever_the_chunk_boundaries():
+    content = binary_ply(POINTS)
+    header_end = content.index(b"end_header") + len(b"end_header")
+    for cuts in ([], [header_end], [header_end + 1], [5, header_end, header_end + 7], list(range(1, len(content)))):
+        stats = scan(GeometryStatsScanner("ply"), content, cuts)
+        assert stats.count == 3, cuts
+        assert stats.dtype == "float32"
+        assert stats.properties == ["x", "y", "z", "red"]
+        assert stats.bbox_min == (0.0, -1.0, -2.0) and stats.bbox_max == (4.0, 3.0, 2.0)
+        assert stats.centroid == pytest.approx((2.0, 1.0, 1 / 6))
+
+
+def test_geometry_stats_skip_plys_whose_vertices_are_not_the_first_element():
+    content = binary_ply(POINTS, elements_before_vertex="element camera 1\nproperty float view_px\n")
+    assert scan(GeometryStatsScanner("ply"), content, [len(content) // 2]) is None
+
+
+def test_geometry_stats_of_text_geometries():
+    ascii_ply = b"ply\nformat ascii 1.0\nelement vertex 3\nproperty float x\nproperty float y\nproperty float z\nend_header\n"
+    ascii_ply += b"".join(b"%g %g %g\n" % tuple(p) for p in POINTS) + b"3 0 1 2\n"
+    pts = b"3\n" + b"".join(b"%g %g %g 255 0 0\n" % tuple(p) for p in POINTS)
+    xyz = b"".join(b"%g,%g,%g\n" % tuple(p) for p in POINTS).rstrip(b"\n")  # no final line break
+
+    for key, content in [("a.ply", ascii_ply), ("a.pts", pts), ("a.xyz", xyz)]:
+        stats = scan(GeometryStatsScanner.for_key(key), content, [7, 40])
+        assert stats.count == 3, key
+        assert stats.dtype == "ascii"
+        assert stats.bbox_min == (0.0, -1.0, -2.0) and stats.bbox_max == (4.0, 3.0, 2.0)
+    assert GeometryStatsScanner.for_key("a.e57") is None
+
+
+def test_geometry_stats_intersects_with_margin():
+    stats = scan(GeometryStatsScanner("ply"), binary_ply(POINTS), [])
+    assert stats.intersects([[1.0, 1.0, 1.0]])
+    assert not stats.intersects([[10.0, 1.0, 1.0]])
+    assert stats.intersects([[10.0, 1.0, 1.0]], margin=6.0)
@@ -58,4 +58,60 @@ def test_api_pointproximity():
         
 #         print(response.json())
 #         assert response.status_code == 200
-#         assert response.json() == {"msg": [[5.0, 5.0, 5.0], [1.0, 2.0, 3.0]]}
\ No newline at end of file
+#         assert response.json() == {"msg": [[5.0, 5.0, 5.0], [1.0, 2.0, 3.0]]}
+
+
+def test_annotation_layer_status_is_memoized_per_request(monkeypatch):
+    pytest.importorskip("open3d")  # imported by the point cloud processors of the router
+    from starlette.requests import Request
+    from app.routers import astrapi
+
+    calls = []
+
+    async def fetch(triplestore, s3, annotationLayer_id):
+        calls.append(annotationLayer_id)
+        return [{"annotationLayer_path": "s3://bucket/layer.zip"}, {"annotationLayer_status": "Archived"}]
+
+    monkeypatch.setattr(astrapi, "fetch_annotationLayer_status", fetch)
+
+    async def main():
+        first, second = Request({"type": "http"}), Request({"type": "http"})
+        status = await astrapi.annotationLayer_details_and_status(first, None, None, "l1")
+        status[1]["annotationLayer_status"] = "Changed by the caller"
+        assert (await astrapi.annotationLayer_details_and_status(first, None, None, "l1"))[1] == {"annotationLayer_status": "Archived"}
+        assert calls == ["l1"]
+
+        await astrapi.annotationLayer_details_and_status(second, None, None, "l1")  # another request looks again
+        astrapi.forget_annotationLayer_status(first, "l1")
+        await astrapi.annotationLayer_details_and_status(first, None, None, "l1")
+        assert calls == ["l1", "l1", "l1"]
+
+    asyncio.run(main())
+
+
+def test_points_proximity_without_cloud_in_reach_returns_a_full_mask():
+    pytest.importorskip("open3d")  # imported by the point cloud processors of the router
+    from app.models import LightPointMatchData
+    from app.routers import astrapi
+    from fast_clients.fast_files import GeometryStats
+
+    class Store:
+        config = {"default_triples_root_uri": "http://example.org/id/"}
+
+        async def aselect_templated(self, query_filename, format, **kwargs):
+            return [{"geom_path": "s3://b/far1.ply"}, {"geom_path": "s3://b/far2.ply"}]
+
+    class Files:
+        def get_geometry_stats(self, s3_url):
+            return GeometryStats(count=1, bbox_min=(100.0, 100.0, 100.0), bbox_max=(101.0, 101.0, 101.0))
+
+        def smart_read_ply(self, s3_url):
+            raise AssertionError("pruned clouds are not read")
+
+    points = [(0.0, 0.0, 0.0), (1.0, 2.0, 3.0), (5.0, 5.0, 5.0)]
+    response = asyncio.run(
+        astrapi.post_annotations_points_proximity(
+            LightPointMatchData(points=points), "bw1", triplestore=Store(), distance_treshold=0.5, s3=Files()
+        )
+    )
+    assert json.loads(json.loads(response.body)) == [False, False, False]
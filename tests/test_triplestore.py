@@ -0,0 +1,1362 @@
+import asyncio
+import contextvars
+import os
+import pickle
+import threading
+import time
+from urllib.error import URLError
+
+import pytest
+import fast_clients.fast_local_triplestore as fast_local_triplestore
+from rdflib import Dataset, Graph, Literal, URIRef
+from contextlib import aclosing
+from rdflib.compare import isomorphic
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
+
+from fast_clients.fast_local_triplestore import LocalTripleStore
+from fast_clients.fast_query_cache import SingleFlight
+from fast_clients.fast_sparql_async import EndpointUnavailable
+from fast_clients.fast_sparql_replicas import ReplicaRouter
+from fast_clients.fast_sparql import NQuadsRewriter, SparqlTemplateRegistry, insert_named_graph, sparql_json_to_rows
+from fast_clients.fast_triplestore import TripleStore
+
+ROOT = "http://example.org/"
+GRAPH = ROOT + "graphs/main"
+
+
+class DatasetClient:
+    """Stand-in of the `SPARQLUpdateStore` client applying updates to an in-memory dataset"""
+
+    def __init__(self, dataset: Dataset):
+        self.dataset = dataset
+        self.updates = []
+        self.failures = 0  # next updates refused by the "endpoint"
+
+    def update(self, query: str, queryGraph=None):
+        if queryGraph is not None:
+            query = insert_named_graph(query, queryGraph)
+        if self.failures > 0:
+            self.failures -= 1
+            raise EndpointUnavailable("SPARQL endpoint unavailable")
+        self.dataset.update(query)
+        self.updates.append(query)  # once applied, tests wait on it
+
+
+class AsyncDatasetClient:
+    """Stand-in of `AsyncSparqlClient` for updates and CONSTRUCT streams"""
+
+    def __init__(self, client: DatasetClient):
+        self.client = client
+        self.closed_streams = 0
+
+    async def update(self, query: str):
+        await asyncio.sleep(0)
+        self.client.update(query)
+
+    async def construct(self, query_string, accept, default_graph_uri=None, endpoint=None, chunk_size=1 << 16):
+        assert accept == "application/n-triples"
+        graph = self.client.dataset.graph(URIRef(default_graph_uri))
+        data = graph.query(query_string).serialize(format="nt", encoding="utf-8")
+        try:
+            for i in range(0, len(data), chunk_size):
+                await asyncio.sleep(0)
+                yield data[i : i + chunk_size]
+        finally:
+            self.closed_streams += 1
+
+
+class InMemoryTripleStore(TripleStore):
+    """TripleStore whose endpoint is an rdflib dataset, answers go through the SPARQL JSON parser"""
+
+    def __init__(self, tmp_path, config: dict | None = None):
+        self.dataset = Dataset(default_union=False)
+        self.queries = []
+        self._client = DatasetClient(self.dataset)
+        self._aclient = AsyncDatasetClient(self._client)
+        for name in ("select", "update"):
+            (tmp_path / name).mkdir(exist_ok=True)
+        super().__init__(
+            config={
+                "default_named_graph_root_uri": ROOT + "graphs/",
+                "default_named_graph_name": "main",
+                "default_triples_root_uri": ROOT + "id/",
+                "datapip_sparql_select_path": str(tmp_path / "select"),
+                "datapip_sparql_update_path": str(tmp_path / "update"),
+                "sparql_templates_check_interval": 0,
+            }
+            | (config or {}),
+            config_store={
+                "query_endpoint": "http://sparql.test/query",
+                "update_endpoint": "http://sparql.test/update",
+            },
+        )
+
+    @property
+    def client(self):
+        return self._client
+
+    @property
+    def aclient(self):
+        return self._aclient
+
+    def select_rows(self, query_string: str, named_graph_uri: str | list[str]):
+        self.queries.append(query_string)
+        if isinstance(named_graph_uri, str):
+            result = self.dataset.graph(URIRef(named_graph_uri)).query(query_string)
+        else:  # FROM clauses are resolved against the dataset, never fetched
+            graph = Dataset(default_union=True)
+            for g in named_graph_uri:
+                for triple in self.dataset.graph(URIRef(g)):
+                    graph.add(triple)
+            result = graph.query(query_string)
+        return sparql_json_to_rows(result.serialize(format="json"))
+
+    async def aselect_rows(self, query_string: str, named_graph_uri: str | list[str]):
+        await asyncio.sleep(0)
+        return self.select_rows(query_string, named_graph_uri)
+
+
+def write_template(directory, name: str, text: str, mtime_ns: int | None = None):
+    path = directory / name
+    path.write_text(text, encoding="utf-8")
+    if mtime_ns is not None:  # the file system may not tick between two quick writes
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return path
+
+
+def load_turtle(store: InMemoryTripleStore, turtle: str, graph: str = GRAPH):
+    store.dataset.graph(URIRef(graph)).parse(data=turtle, format="turtle")
+
+
+@pytest.fixture
+def store(tmp_path):
+    return InMemoryTripleStore(tmp_path)
+
+
+# SparqlTemplateRegistry
+def test_registry_loads_and_compiles_templates(tmp_path):
+    write_template(tmp_path, "a.sparql", "SELECT ?s WHERE { ?s <$p> \"$o\" . <$__uri__1> ?p ?o }")
+    write_template(tmp_path, "notes.txt", "not a template")
+    registry = SparqlTemplateRegistry(tmp_path).load()
+
+    assert len(registry) == 1 and "a.sparql" in registry
+    template = registry.get("a.sparql")
+    assert template.variables == {"p", "o"}
+    assert template.uri_slots == {"__uri__1"}
+    with pytest.raises(KeyError, match=r"\['o', 'p'\]"):
+        template.substitute({})
+
+
+def test_registry_reloads_a_changed_template(tmp_path):
+    write_template(tmp_path, "a.sparql", "SELECT ?s WHERE { ?s ?p \"$x\" }", mtime_ns=1_000_000_000)
+    registry = SparqlTemplateRegistry(tmp_path, check_interval=0).load()
+    assert registry.get("a.sparql").variables == {"x"}
+
+    write_template(tmp_path, "a.sparql", "SELECT ?s WHERE { ?s ?p \"$y\" }", mtime_ns=2_000_000_000)
+    template = registry.get("a.sparql")
+    assert template.variables == {"y"}
+    assert template.substitute({"y": "v"}) == 'SELECT ?s WHERE { ?s ?p "v" }'
+
+
+def test_registry_checks_mtime_at_most_every_interval(tmp_path):
+    write_template(tmp_path, "a.sparql", "SELECT ?s WHERE { ?s ?p \"$x\" }", mtime_ns=1_000_000_000)
+    registry = SparqlTemplateRegistry(tmp_path, check_interval=60).load()
+
+    write_template(tmp_path, "a.sparql", "SELECT ?s WHERE { ?s ?p \"$y\" }", mtime_ns=2_000_000_000)
+    assert registry.get("a.sparql").variables == {"x"}  # not checked yet
+
+    registry.get("a.sparql").checked_at = time.monotonic() - 61
+    assert registry.get("a.sparql").variables == {"y"}
+
+
+def test_registry_compiles_new_and_forgets_removed_templates(tmp_path):
+    registry = SparqlTemplateRegistry(tmp_path, check_interval=0).load()
+    assert len(registry) == 0
+
+    path = write_template(tmp_path, "b.sparql", "ASK { ?s ?p ?o }")
+    assert registry.get("b.sparql").variables == frozenset()
+    assert "b.sparql" in registry
+
+    path.unlink()
+    with pytest.raises(FileNotFoundError):
+        registry.get("b.sparql")
+    assert "b.sparql" not in registry
+
+
+def test_select_templated_serves_the_edited_template(store, tmp_path):
+    load_turtle(store, "<http://example.org/id/a> <http://example.org/p> 1, 2 .")
+    write_template(tmp_path / "select", "q.sparql", "SELECT ?o WHERE { ?s ?p ?o } ORDER BY ?o", mtime_ns=1_000_000_000)
+    assert store.select_templated("q.sparql", format="dict") == [{"o": 1}, {"o": 2}]
+
+    write_template(tmp_path / "select", "q.sparql", "SELECT ?o WHERE { ?s ?p ?o } ORDER BY DESC(?o)", mtime_ns=2_000_000_000)
+    assert store.select_templated("q.sparql", format="dict") == [{"o": 2}, {"o": 1}]
+
+
+# Result cache
+COUNT_QUERY = "SELECT (COUNT(*) AS ?n) WHERE { ?s ?p ?o }"
+
+
+def test_result_cache_is_off_by_default(store, tmp_path):
+    write_template(tmp_path / "select", "count.sparql", COUNT_QUERY)
+    assert store.select_templated("count.sparql", format="dict") == [{"n": 0}]
+    load_turtle(store, "<http://example.org/id/a> <http://example.org/p> 1 .")  # written by another process
+    assert store.select_templated("count.sparql", format="dict") == [{"n": 1}]
+    assert len(store.result_cache) == 0
+
+
+def test_result_cache_opt_in_and_cached_false(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"query_cache_ttl": 60})
+    write_template(tmp_path / "select", "count.sparql", COUNT_QUERY)
+    assert store.select_templated("count.sparql", format="dict") == [{"n": 0}]
+    load_turtle(store, "<http://example.org/id/a> <http://example.org/p> 1 .")
+
+    assert store.select_templated("count.sparql", format="dict") == [{"n": 0}]  # served from memory
+    assert store.select_templated("count.sparql", format="dict", cached=False) == [{"n": 1}]
+    assert asyncio.run(store.aselect_templated("count.sparql", format="dict", cached=False)) == [{"n": 1}]
+    assert len(store.queries) == 3
+
+    store.update_static("INSERT DATA { <http://example.org/id/b> <http://example.org/p> 2 }")
+    assert store.select_templated("count.sparql", format="dict") == [{"n": 2}]  # own writes invalidate
+
+
+# SingleFlight
+def test_single_flight_coalesces_threads():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return [{"n": 1}]
+
+    leader = threading.Thread(target=lambda: results.append(flight.do(("k",), "q", fetch)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do(("k",), "q", fetch))) for _ in range(3)]
+    for t in followers:
+        t.start()
+    while flight.coalesced["q"] < 3:
+        time.sleep(0.001)
+    release.set()
+    for t in [leader, *followers]:
+        t.join(5)
+
+    assert len(calls) == 1
+    assert results == [[{"n": 1}]] * 4
+    assert len({id(r) for r in results}) == 4  # every caller gets its own copy
+    assert flight.stats() == {"q": {"executed": 1, "coalesced": 3}}
+
+    flight.do(("k",), "q", fetch)  # the flight is over, the next call runs again
+    assert len(calls) == 2
+
+
+def test_single_flight_shares_errors_with_followers():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    errors = []
+
+    def fetch():
+        started.set()
+        release.wait(5)
+        raise ValueError("store down")
+
+    def call():
+        try:
+            flight.do(("k",), "q", fetch)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads.append(threading.Thread(target=call))
+    threads[1].start()
+    while flight.coalesced["q"] < 1:
+        time.sleep(0.001)
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert len(errors) == 2 and errors[0] is errors[1]
+
+
+def test_single_flight_coalesces_coroutines_and_survives_cancellation():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return [{"n": 1}]
+
+    async def main():
+        cancelled = asyncio.ensure_future(flight.ado(("k",), "q", fetch))
+        others = [asyncio.ensure_future(flight.ado(("k",), "q", fetch)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        cancelled.cancel()  # a disconnected client
+        return await asyncio.gather(*others)
+
+    assert asyncio.run(main()) == [[{"n": 1}]] * 3
+    assert len(calls) == 1
+    assert flight.stats() == {"q": {"executed": 1, "coalesced": 3}}
+
+
+def test_aselect_templated_coalesces_identical_requests(store, tmp_path):
+    load_turtle(store, "<http://example.org/id/a> <http://example.org/p> 1 .")
+    write_template(tmp_path / "select", "count.sparql", COUNT_QUERY)
+
+    async def main():
+        return await asyncio.gather(*[store.aselect_templated("count.sparql", format="dict") for _ in range(5)])
+
+    assert asyncio.run(main()) == [[{"n": 1}]] * 5
+    assert len(store.queries) == 1
+    assert store.single_flight.stats() == {"count.sparql": {"executed": 1, "coalesced": 4}}
+
+
+def test_uncached_reads_never_join_a_flight(store, tmp_path):
+    load_turtle(store, "<http://example.org/id/a> <http://example.org/p> 1 .")
+    write_template(tmp_path / "select", "count.sparql", COUNT_QUERY)
+
+    async def main():
+        before = asyncio.ensure_future(store.aselect_templated("count.sparql", format="dict"))
+        await asyncio.sleep(0)  # in flight, e.g. started before the caller's write
+        after = await store.aselect_templated("count.sparql", format="dict", cached=False)
+        return await before, after
+
+    assert asyncio.run(main()) == ([{"n": 1}], [{"n": 1}])
+    assert len(store.queries) == 2  # the uncached read sent its own query
+    load_turtle(store, "<http://example.org/id/b> <http://example.org/p> 2 .")
+    assert store.select_templated("count.sparql", format="dict", cached=False) == [{"n": 2}]
+    assert store.single_flight.stats() == {"count.sparql": {"executed": 1, "coalesced": 0}}
+
+
+# Dataset clauses
+@pytest.mark.parametrize(
+    "query, where",
+    [
+        ('PREFIX ex: <http://example.org/WHERE/>\nSELECT ?s # WHERE {\nWHERE { ?s ?p "WHERE {" }', 'WHERE { ?s ?p "WHERE {" }'),
+        ("select ?where where { ?where ?p ?o }", "where { ?where ?p ?o }"),
+        ("SELECT * { ?s ?p ?o }", "{ ?s ?p ?o }"),
+        ('CONSTRUCT { ?s ?p "} WHERE {" } WHERE { ?s ?p ?o }', "WHERE { ?s ?p ?o }"),
+        ("CONSTRUCT { ?s ?p ?o } { ?s ?p ?o }", "{ ?s ?p ?o }"),
+        ("CONSTRUCT WHERE { ?s ?p ?o }", "WHERE { ?s ?p ?o }"),
+        ("DESCRIBE <urn:a> WHERE { <urn:a> ?p ?o }", "WHERE { <urn:a> ?p ?o }"),
+        ("ASK { ?s ?p ?o }", "{ ?s ?p ?o }"),
+    ],
+)
+def test_inject_dataset_clauses_before_the_where_clause(store, query, where):
+    injected = store.inject_dataset_clauses(query, [GRAPH, TH], [ROOT + "graphs/other"])
+    assert injected == query[: len(query) - len(where)] + (
+        f"FROM <{GRAPH}>\nFROM <{TH}>\nFROM NAMED <{ROOT}graphs/other>\n" + where
+    )
+    prepareQuery(injected)  # still valid SPARQL
+
+
+def test_inject_dataset_clauses_merges_the_graphs(store, monkeypatch):
+    monkeypatch.setattr("rdflib.plugins.sparql.SPARQL_LOAD_GRAPHS", False)  # FROM reads the dataset's graphs
+    load_turtle(store, "<http://example.org/id/a> <http://example.org/p> 1 .")
+    load_turtle(store, "<http://example.org/id/b> <http://example.org/p> 2 .", TH)
+    load_turtle(store, "<http://example.org/id/c> <http://example.org/p> 3 .", ROOT + "graphs/other")
+    query = store.inject_dataset_clauses("SELECT ?o WHERE { ?s <http://example.org/p> ?o } ORDER BY ?o", [GRAPH, TH])
+    assert [row.o.toPython() for row in store.dataset.query(query)] == [1, 2]
+
+
+def test_inject_dataset_clauses_needs_a_where_clause(store):
+    with pytest.raises(ValueError):
+        store.inject_dataset_clauses("DESCRIBE <urn:a>", [GRAPH])
+
+
+# Parameter binding
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        ("SELECT ?s WHERE { ?s ?p ?o }", "WHERE"),
+        ("SELECT * { ?s ?p ?o }", "{ ?s ?p"),
+        ("SELECT ?where WHERE { ?s ?p ?where }", "WHERE"),
+        ("# no WHERE here\nSELECT ?s WHERE { ?s ?p ?o }", "WHERE {"),
+        ("SELECT ?s FROM <http://example.org/WHERE{> WHERE { ?s ?p ?o }", "WHERE {"),
+        ("SELECT (\"WHERE {\" AS ?x) WHERE { ?s ?p ?o }", "WHERE { ?s"),
+        ("CONSTRUCT { ?s ?p ?o . ?o ?p2 [ ?p3 ?o3 ] } WHERE { ?s ?p ?o }", "WHERE"),
+        ("CONSTRUCT WHERE { ?s ?p ?o }", "WHERE"),
+        ("ASK { ?s ?p ?o }", "{ ?s"),
+    ],
+)
+def test_where_clause_position(store, query, expected):
+    assert query[store._where_clause_position(query) :].startswith(expected)
+
+
+def test_where_clause_position_without_where(store):
+    with pytest.raises(ValueError, match="No WHERE clause"):
+        store._where_clause_position("DESCRIBE <http://example.org/id/a>")
+
+
+def test_bind_values_terms(store):
+    query = "SELECT ?s WHERE { ?s ?p ?o . ?s ?q ?label }"
+    bound = store.bind_values(
+        query,
+        {
+            "s": "http://example.org/id/a",
+            "o": 'say "hi"',
+            "p": URIRef("http://example.org/p"),
+            "label": Literal("http://example.org/not-an-iri"),
+            "q": None,
+            "unused": 1,
+        },
+    )
+    assert bound.startswith("SELECT ?s WHERE {\nVALUES (?s ?o ?p ?label ?q) {\n")
+    assert (
+        '(<http://example.org/id/a> "say \\"hi\\"" <http://example.org/p> "http://example.org/not-an-iri" UNDEF)'
+        in bound
+    )
+    assert bound.endswith(" ?s ?p ?o . ?s ?q ?label }")
+    assert store.bind_values(query, {"unused": 1}) == query
+
+
+def test_bind_values_many_rows_and_select(store, tmp_path):
+    load_turtle(
+        store,
+        """<http://example.org/id/a> <http://example.org/p> "x" .
+        <http://example.org/id/b> <http://example.org/p> "http://example.org/id/c" .
+        <http://example.org/id/c> <http://example.org/p> <http://example.org/id/a> .""",
+    )
+    write_template(tmp_path / "select", "q.sparql", "SELECT ?s ?o WHERE { ?s <http://example.org/p> ?o } ORDER BY ?s")
+    rows = [{"s": "http://example.org/id/a"}, {"o": "http://example.org/id/a"}, {"o": Literal("http://example.org/id/c")}]
+    assert store.select_templated_parametrized("q.sparql", format="dict", enforce_parameters=rows) == [
+        {"s": "http://example.org/id/a", "o": "x"},
+        {"s": "http://example.org/id/b", "o": "http://example.org/id/c"},
+        {"s": "http://example.org/id/c", "o": "http://example.org/id/a"},
+    ]
+    assert store.select_templated_parametrized(
+        "q.sparql", format="dict", enforce_parameters={"s": "http://example.org/id/c"}
+    ) == [{"s": "http://example.org/id/c", "o": "http://example.org/id/a"}]
+
+
+# Batched selects
+PEOPLE = """<http://example.org/id/a> <http://example.org/knows> <http://example.org/id/b>, <http://example.org/id/c> ;
+    <http://example.org/name> "Ada" .
+<http://example.org/id/b> <http://example.org/knows> <http://example.org/id/c> ;
+    <http://example.org/name> "Bob" ."""
+
+
+def test_batch_query_projects_the_batched_slots(store, tmp_path):
+    write_template(tmp_path / "select", "q.sparql", 'SELECT DISTINCT ?o WHERE { <$s> <$p> ?o . ?o ?n "$name" }')
+    query, kinds, empty = store._batch_query("q.sparql", ["s", "name"], {"p": "http://example.org/knows"})
+    assert query == "SELECT DISTINCT ?_bind_s ?_bind_name ?o WHERE { ?_bind_s <http://example.org/knows> ?o . ?o ?n ?_bind_name }"
+    assert kinds == {"s": "iri", "name": "literal"}
+    assert empty is None
+
+
+def test_batch_query_extends_group_by(store, tmp_path):
+    write_template(tmp_path / "select", "q.sparql", "SELECT ?p (COUNT(?o) AS ?n) WHERE { <$s> ?p ?o } GROUP BY ?p")
+    query, _, empty = store._batch_query("q.sparql", ["s"], {})
+    assert query.endswith("} GROUP BY ?_bind_s ?p")
+    assert empty is None
+
+
+def test_batch_query_groups_an_aggregate_without_group_by(store, tmp_path):
+    write_template(
+        tmp_path / "select",
+        "q.sparql",
+        "SELECT (COUNT(DISTINCT ?o) AS ?n) (MAX(?o) AS ?last) (GROUP_CONCAT(?o; separator=\",\") AS ?all) "
+        "WHERE { SELECT (MIN(?x) AS ?o) { <$s> ?p ?x } } ORDER BY ?n",
+    )
+    query, _, empty = store._batch_query("q.sparql", ["s"], {})
+    assert query.endswith("}\nGROUP BY ?_bind_s ORDER BY ?n")
+    assert empty == {"n": 0, "last": None, "all": ""}  # the subquery aggregate is not projected
+
+
+@pytest.mark.parametrize(
+    "text, message",
+    [
+        ("SELECT ?o WHERE { <$s> ?p ?o } LIMIT 10", "LIMIT/OFFSET"),
+        ("SELECT ?o WHERE { <http://example.org/$s> ?p ?o }", "cannot be batched"),
+    ],
+)
+def test_batch_query_refuses(store, tmp_path, text, message):
+    write_template(tmp_path / "select", "q.sparql", text)
+    with pytest.raises(ValueError, match=message):
+        store._batch_query("q.sparql", ["s"], {})
+
+
+def test_select_many_matches_one_select_per_row(store, tmp_path):
+    load_turtle(store, PEOPLE)
+    write_template(tmp_path / "select", "knows.sparql", "SELECT ?o WHERE { <$s> <http://example.org/knows> ?o } ORDER BY ?o")
+    write_template(tmp_path / "select", "count.sparql", "SELECT (COUNT(?o) AS ?n) WHERE { <$s> <http://example.org/knows> ?o }")
+    write_template(tmp_path / "select", "named.sparql", 'SELECT ?s WHERE { ?s <http://example.org/name> "$name" }')
+    people = [{"s": ROOT + "id/" + x} for x in "abca"]
+
+    for template in ("knows.sparql", "count.sparql"):
+        expected = [store.select_templated(template, format="dict", **row) for row in people]
+        assert store.select_many(template, people, chunk_size=2) == expected
+        assert asyncio.run(store.aselect_many(template, people, chunk_size=2)) == expected
+    assert store.select_many("count.sparql", people) == [[{"n": 2}], [{"n": 1}], [{"n": 0}], [{"n": 2}]]
+    assert store.select_many("named.sparql", [{"name": "Bob"}, {"name": "Eve"}]) == [[{"s": ROOT + "id/b"}], []]
+
+    n = len(store.queries)
+    store.select_many("knows.sparql", people, chunk_size=2)
+    assert len(store.queries) == n + 2  # 3 distinct rows, 2 per query
+
+
+# UpdateBatcher
+NAME_UPDATE = 'INSERT DATA { <$__uri__1> <http://example.org/name> "$name" }'
+NAMES_QUERY = "SELECT ?s ?name WHERE { ?s <http://example.org/name> ?name } ORDER BY ?name"
+
+
+def names(store: InMemoryTripleStore, graph: str = GRAPH) -> list[dict]:
+    return store.select_rows(NAMES_QUERY, graph)[1]
+
+
+def test_update_batcher_joins_statements_per_graph(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"update_batch_max_statements": 3, "update_batch_window": 60})
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+    other = ROOT + "graphs/other"
+
+    with store.update_batcher as batcher:
+        uris = [batcher.add("name.sparql", name=name) for name in "abcd"]
+        batcher.add("name.sparql", query_graph_override=other, name="z")
+        assert len(store.client.updates) == 1  # a, b, c sent once full
+    assert len(store.client.updates) == 3  # d and z flushed on exit, one request per graph
+
+    assert [row["name"] for row in names(store)] == list("abcd")
+    assert [row["s"] for row in names(store)] == [u["__uri__1"] for u in uris]
+    assert all(u["__uri__1"].startswith(ROOT + "id/") for u in uris)
+    assert [row["name"] for row in names(store, other)] == ["z"]
+    assert (batcher.requests, batcher.statements) == (3, 5)
+
+
+def test_update_batcher_flushes_on_timer(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"update_batch_window": 0.01})
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+    store.update_batcher.add("name.sparql", name="a")
+    store.update_batcher.add("name.sparql", name="b")
+    deadline = time.monotonic() + 5
+    while len(store.client.updates) == 0 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert len(store.client.updates) == 1
+    assert [row["name"] for row in names(store)] == ["a", "b"]
+
+
+def test_update_batcher_sends_again_after_a_transient_failure(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"update_batch_window": 0.01, "update_batch_retry_delay": 0.01})
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+    batcher = store.update_batcher
+
+    store.client.failures = 2
+    batcher.add("name.sparql", name="a")
+    deadline = time.monotonic() + 5
+    while len(store.client.updates) == 0 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert [row["name"] for row in names(store)] == ["a"]  # the timer was armed again after each failure
+
+    store.client.failures = 1
+    batcher.add("name.sparql", name="b")
+    with pytest.raises(URLError):
+        batcher.flush()
+    assert batcher.flush() == 1
+    assert [row["name"] for row in names(store)] == ["a", "b"]
+    assert (batcher.flush(), batcher.dropped) == (0, 0)
+
+
+def test_update_batcher_drops_a_batch_after_max_retries(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"update_batch_window": 60, "update_batch_max_retries": 2})
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+    batcher = store.update_batcher
+
+    store.client.failures = 3
+    batcher.add("name.sparql", name="a")
+    for _ in range(3):
+        with pytest.raises(EndpointUnavailable):
+            batcher.flush()
+    assert (batcher.flush(), batcher.dropped) == (0, 1)
+    batcher.add("name.sparql", name="b")
+    assert batcher.flush() == 1
+    assert [row["name"] for row in names(store)] == ["b"]
+
+
+def test_update_batcher_drops_a_poison_batch_at_once(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"update_batch_window": 60})
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+    write_template(tmp_path / "update", "broken.sparql", 'INSERT DATA { <$__uri__1> <http://example.org/name> "$name" ] }')
+    batcher = store.update_batcher
+
+    batcher.add("name.sparql", name="a")
+    batcher.add("broken.sparql", name="b")  # the request is refused whatever the number of tries
+    with pytest.raises(Exception) as raised:
+        batcher.flush()
+    assert not isinstance(raised.value, EndpointUnavailable)
+    assert (batcher.flush(), batcher.dropped) == (0, 2)
+
+    batcher.add("name.sparql", name="b")
+    assert batcher.flush() == 1  # later statements of the graph are written
+    assert [row["name"] for row in names(store)] == ["b"]
+
+
+def test_update_batcher_escapes_values(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"update_batch_window": 60})
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+    write_template(tmp_path / "update", "link.sparql", "INSERT DATA { <$__uri__1> <http://example.org/link> <$target> }")
+    write_template(tmp_path / "update", "raw.sparql", "INSERT DATA { <$__uri__1> <http://example.org/name> $name }")
+    batcher = store.update_batcher
+
+    name = 'a" } ; DROP ALL ; INSERT DATA { <http://example.org/x> <http://example.org/y> "z'
+    batcher.add("name.sparql", name=name)
+    assert batcher.flush() == 1
+    assert [row["name"] for row in names(store)] == [name]
+
+    with pytest.raises(ValueError):
+        batcher.add("link.sparql", target="http://example.org/a> <http://example.org/b")
+    with pytest.raises(ValueError):
+        batcher.add("raw.sparql", name="a")
+    assert batcher.flush() == 0
+
+
+def test_update_batcher_async(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"update_batch_window": 0.01, "update_batch_retry_delay": 0.01})
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+
+    async def main():
+        return await asyncio.gather(*(store.update_batcher.aadd("name.sparql", name=name) for name in "abc"))
+
+    uris = asyncio.run(main())
+    assert len(store.client.updates) == 1
+    assert [row["s"] for row in names(store)] == [u["__uri__1"] for u in uris]
+
+    store.client.failures = 1  # sent again
+    assert len(asyncio.run(main())) == 3
+    assert [row["name"] for row in names(store)] == ["a", "a", "b", "b", "c", "c"]
+
+    store.client.failures = 4
+    with pytest.raises(URLError):  # every caller of the failed batch gets the error
+        asyncio.run(main())
+
+
+# Paging
+ITEMS = "\n".join(
+    f"""<http://example.org/id/{i:02d}> <http://example.org/rank> {(i * 7) % 23} ;
+    <http://example.org/label> "item {chr(97 + (i * 5) % 26)}{i}" ;
+    <http://example.org/date> "2024-{1 + i % 12:02d}-{1 + i:02d}"^^<http://www.w3.org/2001/XMLSchema#date> ."""
+    for i in range(20)
+)
+ITEMS_QUERY = """SELECT ?s ?rank ?label ?date WHERE {
+    ?s <http://example.org/rank> ?rank ; <http://example.org/label> ?label ; <http://example.org/date> ?date
+}"""
+
+
+def test_page_query_orders_by_the_projection(store):
+    page = store._page_query("SELECT DISTINCT ?s (COUNT(?o) AS ?n) WHERE { ?s ?p ?o } GROUP BY ?s", 10, 20)
+    assert page.endswith("GROUP BY ?s\nORDER BY ?s ?n\nLIMIT 10 OFFSET 20")
+    page = store._page_query("SELECT ?s WHERE { ?s ?p ?o } ORDER BY DESC(?s)", 10)
+    assert page.endswith("ORDER BY DESC(?s)\nLIMIT 10")
+    with pytest.raises(ValueError, match="SELECT \\*"):
+        store._page_query("SELECT * WHERE { ?s ?p ?o }", 10)
+    with pytest.raises(ValueError, match="LIMIT/OFFSET"):
+        store._page_query("SELECT ?s WHERE { ?s ?p ?o } LIMIT 5", 10)
+
+
+@pytest.mark.parametrize("order_by", ["s", "rank", "label", "date"])
+def test_keyset_pages_follow_the_typed_order(store, tmp_path, order_by):
+    load_turtle(store, ITEMS)
+    write_template(tmp_path / "select", "items.sparql", ITEMS_QUERY)
+    expected = store.select_rows(ITEMS_QUERY + f" ORDER BY ?{order_by}", GRAPH)[1]
+    assert len(expected) == 20
+
+    n = len(store.queries)
+    rows = list(store.iter_select_templated("items.sparql", page_size=6, order_by=order_by, keyset=True))
+    assert rows == expected
+    assert len(store.queries) - n == 4
+    assert all("OFFSET" not in q for q in store.queries[n:])
+
+    async def collect():
+        return [row async for row in store.aiter_select_templated("items.sparql", page_size=6, order_by=order_by, keyset=True)]
+
+    assert asyncio.run(collect()) == expected
+
+
+def test_offset_pages_without_order_by_cover_every_row(store, tmp_path):
+    load_turtle(store, ITEMS)
+    write_template(tmp_path / "select", "items.sparql", ITEMS_QUERY)
+    rows = list(store.iter_select_templated("items.sparql", page_size=7))
+    assert sorted(row["s"] for row in rows) == [f"{ROOT}id/{i:02d}" for i in range(20)]
+    assert rows == store.select_rows(ITEMS_QUERY + " ORDER BY ?s ?rank ?label ?date", GRAPH)[1]
+
+
+# ThesaurusMirror
+TH = ROOT + "graphs/th"
+THESAURUS = """@prefix skos: <http://www.w3.org/2004/02/skos/core#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix : <http://example.org/th/> .
+:wall skos:prefLabel "Mur"@fr, "Wall"@en ; skos:altLabel "Paroi"@fr ; skos:broader :structure .
+:structure skos:prefLabel "Structure"@en ; rdfs:label "Ossature"@fr, "Frame"@en ; skos:broader :element .
+:element rdfs:label "Élément"@fr ."""
+TYPES = """@prefix th: <http://example.org/th/> .
+<http://example.org/id/pillar> <http://example.org/type> th:wall .
+<http://example.org/id/beam> <http://example.org/type> th:unknown ."""
+TYPES_QUERY = """PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+SELECT ?b ?type ?type_label WHERE {{
+    ?b <http://example.org/type> ?type .
+    {label}
+}} ORDER BY ?b"""
+
+
+def th(name: str) -> str:
+    return "http://example.org/th/" + name
+
+
+def thesaurus_store(tmp_path, label_pattern: str) -> InMemoryTripleStore:
+    store = InMemoryTripleStore(
+        tmp_path,
+        {
+            "thesaurus_named_graph_full_uris": [TH],
+            "thesaurus_local_resolution": {"types.sparql": {"type": "type_label"}},
+        },
+    )
+    load_turtle(store, THESAURUS, TH)
+    load_turtle(store, TYPES)
+    write_template(tmp_path / "select", "types.sparql", TYPES_QUERY.format(label=label_pattern))
+    assert store.thesaurus.refresh() is True
+    return store
+
+
+def queried_graphs(store: InMemoryTripleStore) -> list:
+    graphs, select_rows = [], store.select_rows
+
+    def record(query_string, named_graph_uri):
+        graphs.append(named_graph_uri)
+        return select_rows(query_string, named_graph_uri)
+
+    store.select_rows = record
+    return graphs
+
+
+def test_thesaurus_mirror_lookups(tmp_path):
+    mirror = thesaurus_store(tmp_path, "").thesaurus
+    assert len(mirror) == 3
+    assert mirror.label(th("wall")) == "Mur"  # languages by preference
+    assert mirror.label(th("wall"), "en") == "Wall"
+    assert mirror.labels(th("structure")) == {"en": "Structure", "fr": "Ossature"}  # skos:prefLabel first
+    assert mirror.label(th("element"), "en") == "Élément"
+    assert mirror.label(th("unknown")) is None
+    assert mirror.alt_labels(th("wall")) == ("Paroi",)
+    assert mirror.ancestors(th("wall")) == [th("structure"), th("element")]
+    assert mirror.enrich([{"type": th("wall"), "type_label": "kept"}, {"type": th("wall")}], {"type": "type_label"}) == [
+        {"type": th("wall"), "type_label": "kept"}, {"type": th("wall"), "type_label": "Mur"},
+    ]
+    assert mirror.refresh() is False
+
+
+def test_thesaurus_local_resolution(tmp_path):
+    store = thesaurus_store(
+        tmp_path, 'OPTIONAL { ?type skos:prefLabel ?type_label FILTER(LANG(?type_label) = "fr") }'
+    )
+    graphs = queried_graphs(store)
+    rows = store.select_templated("types.sparql", format="dict", override_named_graph_uri=[GRAPH, TH])
+    assert graphs == [GRAPH]  # the thesaurus graph is left out
+    assert [(row["b"], row["type_label"]) for row in rows] == [(bw("beam"), None), (bw("pillar"), "Mur")]
+
+    store.on_graph_changed(TH)  # written: reloaded on the next check
+    assert store.thesaurus.refresh() is True
+
+
+@pytest.mark.parametrize(
+    "label_pattern",
+    [
+        '?type skos:prefLabel ?type_label FILTER(LANG(?type_label) = "fr")',  # solutions without label dropped
+        f'OPTIONAL {{ GRAPH <{TH}> {{ ?type skos:prefLabel ?type_label FILTER(LANG(?type_label) = "fr") }} }}',
+    ],
+)
+def test_thesaurus_resolved_remotely_when_the_query_needs_it(tmp_path, label_pattern):
+    store = thesaurus_store(tmp_path, label_pattern)
+    graphs = queried_graphs(store)
+    store.select_templated("types.sparql", format="dict", override_named_graph_uri=[GRAPH, TH])
+    assert graphs == [[GRAPH, TH]]
+
+
+# BuiltworkHierarchy
+BUILTWORKS = """@prefix acrm: <http://astragale.cnrs.fr/sem/acrm/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix : <http://example.org/id/> .
+:cathedral a acrm:E22_HumanMadeObject ; rdfs:label "Cathedral" .
+:nave a acrm:E22_HumanMadeObject ; rdfs:label "Nave" ; acrm:P89_falls_within :cathedral .
+:choir a acrm:E22_HumanMadeObject ; rdfs:label "Choir" ; acrm:P89_falls_within :cathedral .
+:pillar a acrm:E22_HumanMadeObject ; rdfs:label "Pillar" ; acrm:P89_falls_within :nave .
+:bridge a acrm:E22_HumanMadeObject ; rdfs:label "Bridge" .
+:scan1 acrm:P138_represents :nave . :scan2 acrm:P138_represents :nave, :pillar ."""
+
+
+def bw(name: str) -> str:
+    return ROOT + "id/" + name
+
+
+def labels(nodes: list[dict]) -> list[str]:
+    return [node["label"] for node in nodes]
+
+
+@pytest.fixture
+def hierarchy(store):
+    load_turtle(store, BUILTWORKS)
+    index = store.builtwork_hierarchy
+    assert index.refresh() is True
+    return index
+
+
+def test_hierarchy_load(hierarchy):
+    assert len(hierarchy) == 5
+    assert labels(hierarchy.roots()) == ["Bridge", "Cathedral"]
+    assert labels(hierarchy.children(bw("cathedral"))) == ["Choir", "Nave"]
+    assert hierarchy.node(bw("nave")) == {
+        "builtwork": bw("nave"), "label": "Nave", "parent": bw("cathedral"), "children": 1, "geometries": 2,
+    }
+    assert hierarchy.ancestors(bw("pillar")) == [bw("nave"), bw("cathedral")]
+    assert hierarchy.is_descendant(bw("pillar"), bw("cathedral"))
+    assert not hierarchy.is_descendant(bw("cathedral"), bw("pillar"))
+    assert [(n["depth"], n["label"]) for n in hierarchy.subtree(bw("cathedral"))] == [(1, "Choir"), (1, "Nave"), (2, "Pillar")]
+    assert labels(hierarchy.subtree(bw("cathedral"), offset=1, limit=1)) == ["Nave"]
+    assert labels(hierarchy.subtree(bw("cathedral"), max_depth=1)) == ["Choir", "Nave"]
+    assert hierarchy.fingerprint == hierarchy.index_fingerprint() == (5, 3, 3)
+    assert hierarchy.refresh() is False
+
+
+def test_hierarchy_update_moves_relabels_and_counts(store, hierarchy):
+    store.update_static(
+        """PREFIX acrm: <http://astragale.cnrs.fr/sem/acrm/>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        DELETE DATA { <http://example.org/id/pillar> acrm:P89_falls_within <http://example.org/id/nave> ; rdfs:label "Pillar" } ;
+        INSERT DATA { <http://example.org/id/pillar> acrm:P89_falls_within <http://example.org/id/choir> ; rdfs:label "Column" .
+            <http://example.org/id/scan3> acrm:P138_represents <http://example.org/id/pillar> }"""
+    )
+    hierarchy.update([bw("pillar")])
+    assert labels(hierarchy.children(bw("choir"))) == ["Column"]
+    assert hierarchy.children(bw("nave")) == []
+    assert hierarchy.node(bw("pillar"))["geometries"] == 2
+    assert hierarchy.refresh() is False  # the index matches the store, no reload
+
+
+def test_hierarchy_reattaches_orphans(store, hierarchy):
+    store.update_static("DELETE WHERE { <http://example.org/id/nave> ?p ?o }")
+    hierarchy.update([bw("nave")])
+    assert bw("nave") not in hierarchy
+    assert labels(hierarchy.roots()) == ["Bridge", "Cathedral", "Pillar"]  # orphan until its parent comes back
+    assert labels(hierarchy.children(bw("cathedral"))) == ["Choir"]
+    assert hierarchy.ancestors(bw("pillar")) == []
+
+    load_turtle(store, BUILTWORKS)
+    hierarchy.update([bw("nave")])
+    assert labels(hierarchy.roots()) == ["Bridge", "Cathedral"]
+    assert [(n["depth"], n["label"]) for n in hierarchy.subtree(bw("cathedral"))] == [(1, "Choir"), (1, "Nave"), (2, "Pillar")]
+    assert hierarchy.refresh() is False
+
+
+def test_hierarchy_walk_reads_the_tree_it_started_with(store, hierarchy):
+    walk = hierarchy.walk(bw("cathedral"))
+    assert next(walk) == (1, bw("choir"))
+    store.update_static(
+        """PREFIX acrm: <http://astragale.cnrs.fr/sem/acrm/>
+        DELETE DATA { <http://example.org/id/pillar> acrm:P89_falls_within <http://example.org/id/nave> } ;
+        INSERT DATA { <http://example.org/id/pillar> acrm:P89_falls_within <http://example.org/id/choir> }"""
+    )
+    hierarchy.update([bw("pillar")])
+
+    assert list(walk) == [(1, bw("nave")), (2, bw("pillar"))]  # the tree before the update
+    assert [n["label"] for n in hierarchy.subtree(bw("cathedral"))] == ["Choir", "Pillar", "Nave"]
+
+
+def test_hierarchy_update_does_not_hide_other_writes(store, hierarchy):
+    load_turtle(store, "<http://example.org/id/tower> a <http://astragale.cnrs.fr/sem/acrm/E22_HumanMadeObject> .")
+    store.update_static('INSERT DATA { <http://example.org/id/bridge> <http://www.w3.org/2000/01/rdf-schema#label> "Old bridge" }')
+    hierarchy.update([bw("bridge")])  # the ingestion named the bridge only
+    assert bw("tower") not in hierarchy
+    assert hierarchy.refresh() is True  # the store's fingerprint still differs: reloaded
+    assert bw("tower") in hierarchy
+
+
+# LabelSearchIndex
+@pytest.fixture
+def search_index(store):
+    load_turtle(store, BUILTWORKS)
+    load_turtle(store, '<http://example.org/id/scan1> <http://www.w3.org/2004/02/skos/core#prefLabel> "Nef, relevé laser"@fr .')
+    index = store.label_search
+    assert index.refresh() is True
+    return index
+
+
+def test_label_search(search_index):
+    assert [r["uri"] for r in search_index.search("nave")] == [bw("nave")]
+    assert [r["label"] for r in search_index.search("c")] == ["Choir", "Cathedral"]  # prefix, shortest first
+    assert search_index.search("releve")[0]["uri"] == bw("scan1")  # accents and case are ignored
+    assert search_index.search("nef laser")[0]["score"] == 2.0
+    assert search_index.search("nef las")[0]["score"] == 1.8  # the last word is a prefix
+    assert search_index.search("ne laser") == []  # the others are whole words
+    assert search_index.search("cathedarl")[0]["uri"] == bw("cathedral")  # fuzzy
+    assert search_index.search("cathedarl", fuzzy=False) == []
+    types = ["http://astragale.cnrs.fr/sem/acrm/E22_HumanMadeObject"]
+    assert [r["label"] for r in search_index.search("n", types=types)] == ["Nave"]
+
+
+def test_label_search_update_swaps_new_maps(store, search_index):
+    index = search_index._index
+    postings, entries = index.postings, index.entries
+    nave = set(postings["nave"])
+    store.update_static(
+        """DELETE DATA { <http://example.org/id/nave> <http://www.w3.org/2000/01/rdf-schema#label> "Nave" } ;
+        INSERT DATA { <http://example.org/id/nave> <http://www.w3.org/2000/01/rdf-schema#label> "Main nave" .
+            <http://example.org/id/tower> <http://www.w3.org/2000/01/rdf-schema#label> "Tower" }"""
+    )
+    search_index.update([bw("nave"), bw("tower")])
+
+    assert search_index._index is not index  # a new version, published in one assignment
+    assert postings["nave"] == nave and "main" not in postings and bw("tower") not in entries  # untouched
+    assert [r["label"] for r in search_index.search("main n")] == ["Main nave"]
+    assert [r["uri"] for r in search_index.search("tow")] == [bw("tower")]
+
+
+def test_label_search_while_updating(store, search_index):
+    load_turtle(store, "\n".join(f'<http://example.org/id/b{i}> <http://www.w3.org/2000/01/rdf-schema#label> "block {i}" .' for i in range(50)))
+    uris = [bw(f"b{i}") for i in range(50)]
+    errors, done = [], threading.Event()
+
+    def search():
+        while not done.is_set():
+            try:
+                search_index.search("block", limit=500)
+            except Exception as e:  # "changed size during iteration" before the maps were swapped
+                errors.append(e)
+                return
+
+    readers = [threading.Thread(target=search) for _ in range(4)]
+    for t in readers:
+        t.start()
+    for _ in range(10):
+        search_index.update(uris)
+    done.set()
+    for t in readers:
+        t.join(5)
+    assert errors == []
+    assert len(search_index.search("block", limit=500)) == 50
+
+
+# QueryProfiler
+def test_profiler_counts_templates_whose_variables_shadow_its_arguments(store, tmp_path):
+    write_template(tmp_path / "select", "named.sparql", 'SELECT ?s WHERE { ?s ?p "$name" . ?s ?q "$func" }')
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+    store.select_templated("named.sparql", format="dict", name="a", func="b")
+    asyncio.run(store.aselect_templated("named.sparql", format="dict", name="a", func="b"))
+    asyncio.run(store.aupdate_templated("name.sparql", name="a"))
+    with pytest.raises(KeyError):
+        store.select_templated("named.sparql", format="dict", name="a")
+    stats = store.profiler.stats()
+    assert (stats["named.sparql"]["calls"], stats["named.sparql"]["errors"]) == (3, 1)
+    assert stats["name.sparql"]["calls"] == 1
+
+
+# Read-your-writes
+def test_writes_pin_the_reads_of_their_own_request(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"update_batch_window": 0.01})
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+
+    def request(write):  # run in a new context, as a request
+        write()
+        return store.replicas.is_pinned()
+
+    assert contextvars.Context().run(request, lambda: store.update_static("INSERT DATA { <urn:a> <urn:p> 1 }"))
+    assert contextvars.Context().run(request, lambda: store.update_templated("name.sparql", name="a"))
+    assert contextvars.Context().run(request, lambda: store.update_batcher.add("name.sparql", name="b"))
+    assert contextvars.Context().run(request, lambda: store.on_ingestion_completed())
+    store.update_batcher.flush()
+    assert not contextvars.Context().run(store.replicas.is_pinned)  # other requests are not pinned
+
+    async def write(fn, *args, **kwargs):
+        await fn(*args, **kwargs)
+        return store.replicas.is_pinned()
+
+    async def main():
+        return await asyncio.gather(
+            write(store.aupdate_templated, "name.sparql", name="c"),
+            write(store.update_batcher.aadd, "name.sparql", name="d"),
+            write(asyncio.sleep, 0.05),  # a concurrent read-only request
+        )
+
+    assert contextvars.Context().run(asyncio.run, main()) == [True, True, False]
+
+
+def test_writes_pin_the_reads_of_their_graph_by_any_request(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {})
+    other = ROOT + "other"
+    contextvars.Context().run(store.update_static, "INSERT DATA { <urn:a> <urn:p> 1 }")
+
+    def request():  # the client's next HTTP request
+        return store.replicas.is_pinned(), store.replicas.is_pinned(GRAPH), store.replicas.is_pinned([other, GRAPH])
+
+    assert contextvars.Context().run(request) == (False, True, True)
+    assert not contextvars.Context().run(store.replicas.is_pinned, other)
+
+
+# Replicas
+def test_replica_router_fails_over_and_cools_down(monkeypatch):
+    router = ReplicaRouter(["http://a", "http://b"], cooldown=10.0)
+    now = [time.monotonic() + 3600]  # pins left by the other tests are over
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    down = {"http://a"}
+
+    def query(endpoint):
+        if endpoint in down:
+            raise EndpointUnavailable(endpoint)
+        return endpoint
+
+    assert router.call(query) == "http://b"  # failed over
+    assert [r["down_for"] for r in router.stats()] == [10.0, 0.0]
+    assert [router.call(query) for _ in range(3)] == ["http://b"] * 3  # put aside, not tried
+
+    down = {"http://a", "http://b"}
+    with pytest.raises(EndpointUnavailable):
+        router.call(query)  # every replica failed
+    assert [r["down_for"] for r in router.stats()] == [20.0, 10.0]  # doubled for a
+
+    now[0] += 10.0
+    down = set()
+    assert router.call(query) == "http://b"  # back first
+    now[0] += 10.0
+    assert router.call(query) == "http://a"  # least served once both are back
+    assert [r["failures"] for r in router.stats()] == [0, 0]
+
+
+def test_replica_router_does_not_fail_over_on_query_errors():
+    router = ReplicaRouter(["http://a", "http://b"])
+
+    def query(endpoint):
+        raise URLError("400 malformed query")
+
+    with pytest.raises(URLError):
+        router.call(query)
+    assert [(r["served"], r["failures"], r["outstanding"]) for r in router.stats()] == [(1, 0, 0), (0, 0, 0)]  # one try
+
+
+def test_replica_router_pins_reads_to_the_primary(monkeypatch):
+    router = ReplicaRouter(["http://a", "http://b"], pin_seconds=5.0)
+    now = [time.monotonic() + 3600]  # pins left by the other tests are over
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    router.replicas[0].outstanding = 10  # the primary is busy: reads go to the replica
+
+    assert router.call(lambda endpoint: endpoint) == "http://b"
+    contextvars.Context().run(router.pin, "urn:g")
+    assert router.call(lambda endpoint: endpoint, "urn:g") == "http://a"
+    assert router.call(lambda endpoint: endpoint, ["urn:h"]) == "http://b"
+    now[0] += 5.0
+    assert router.call(lambda endpoint: endpoint, "urn:g") == "http://b"  # pin expired
+
+
+@pytest.mark.parametrize(
+    "update",
+    [
+        'INSERT DATA { <urn:a> <urn:b> "x { y }" }',
+        'DELETE { ?s <urn:p> ?o } INSERT { ?s <urn:p> """}""" } WHERE { ?s <urn:p> ?o OPTIONAL { ?s <urn:q> ?z } }',
+        "INSERT DATA { <urn:a> <urn:b> 'it\\'s' # a } in a comment\n} ;\nDELETE WHERE { }",
+    ],
+)
+def test_insert_named_graph_matches_rdflib(update):  # what `SPARQLUpdateStore.update(queryGraph=...)` sent
+    rdflib_store = SPARQLUpdateStore(query_endpoint="http://sparql.test/query", update_endpoint="http://sparql.test/update")
+    assert insert_named_graph(update, GRAPH) == rdflib_store._insert_named_graph(update, GRAPH)
+
+
+
+def test_insert_named_graph_wraps_top_level_blocks_only():
+    assert insert_named_graph('INSERT DATA { <urn:a> <urn:b> "{" } ; DELETE WHERE { }', GRAPH) == (
+        f'INSERT DATA {{ GRAPH <{GRAPH}> {{ <urn:a> <urn:b> "{{" }} }} ; DELETE WHERE {{ }}'
+    )
+
+
+# Graph versions
+
+def test_graph_versions_without_markers_count_triples(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"graph_version_check_interval": 60})
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+
+    assert store.graph_versions.version(GRAPH) == ((GRAPH, 0),)
+    store.update_templated("name.sparql", name="a")
+    assert store.graph_versions.version(GRAPH) == ((GRAPH, 1),)  # read again after a write of this process
+    assert "graph_version" not in store.client.updates[0]
+
+
+def test_graph_versions_are_read_from_the_store_markers(tmp_path):
+    config = {"graph_version_marker": True, "graph_version_check_interval": 60, "update_batch_max_statements": 2}
+    store = InMemoryTripleStore(tmp_path, config)
+    replica = InMemoryTripleStore(tmp_path, config)  # another process on the same store
+    replica.dataset, replica._client = store.dataset, store.client
+    write_template(tmp_path / "update", "name.sparql", NAME_UPDATE)
+    other = ROOT + "graphs/other"
+
+    assert store.graph_versions.version(GRAPH) == replica.graph_versions.version(GRAPH) == ((GRAPH, 0),)
+    store.update_templated("name.sparql", name="a")
+    store.update_static('INSERT DATA { <urn:a> <urn:p> "b" }')
+    with store.update_batcher as batcher:
+        batcher.add("name.sparql", name="c")
+        batcher.add("name.sparql", name="d")  # one marker increment for the batch
+        batcher.add("name.sparql", query_graph_override=other, name="e")
+    asyncio.run(store.aupdate_templated("name.sparql", name="f"))
+    store.on_ingestion_completed("other")
+
+    assert len(store.client.updates) == 5 + 1  # the markers went with the writes
+    assert store.graph_versions.version(GRAPH) == ((GRAPH, 4),)
+    assert store.graph_versions.version([GRAPH, other]) == ((GRAPH, 4), (other, 2))
+    assert replica.graph_versions.version(GRAPH) == ((GRAPH, 0),)  # read again after `check_interval`
+    replica.graph_versions.check_interval = 0
+    version = asyncio.run(replica.graph_versions.aversion([other, GRAPH]))
+    assert version == ((GRAPH, 4), (other, 2))
+    assert replica.graph_versions.token(version, "flat") == store.graph_versions.token(version, "flat")
+    assert store.graph_versions.token(((GRAPH, 2), (other, 4)), "flat") != store.graph_versions.token(version, "flat")
+    assert [row["name"] for row in names(store)][-1] == "f"
+
+
+def test_graph_versions_are_read_from_the_primary(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"graph_version_marker": True, "graph_version_check_interval": 0})
+    pinned = []
+    select_rows = store.select_rows
+
+    def record(query_string, named_graph_uri):
+        pinned.append(store.replicas.is_pinned())
+        return select_rows(query_string, named_graph_uri)
+
+    store.select_rows = record
+    contextvars.Context().run(store.graph_versions.version, GRAPH)
+    contextvars.Context().run(asyncio.run, store.graph_versions.aversion([GRAPH, ROOT + "graphs/other"]))
+    assert pinned == [True] * 3
+    assert not contextvars.Context().run(store.replicas.is_pinned)  # only while reading the versions
+
+
+def test_ingestion_completed_async_increments_the_marker(tmp_path):
+    store = InMemoryTripleStore(tmp_path, {"graph_version_marker": True, "graph_version_check_interval": 60})
+    other = ROOT + "graphs/other"
+    assert store.graph_versions.version(other) == ((other, 0),)
+
+    asyncio.run(store.aon_ingestion_completed("other"))
+    assert len(store.client.updates) == 1
+    assert store.graph_versions.version(other) == ((other, 1),)
+
+
+# LocalTripleStore snapshot
+
+def local_store(tmp_path, rdffile):
+    config = {
+        "default_named_graph_root_uri": ROOT + "graphs/",
+        "default_named_graph_name": "main",
+        "default_triples_root_uri": ROOT + "id/",
+        "local_snapshot_path": str(tmp_path / "bootstrap.snapshot"),
+    }
+    return LocalTripleStore(config, bootstrap_rdffiles=[rdffile])
+
+
+def test_local_snapshot_reloads_without_parsing(tmp_path, monkeypatch):
+    rdffile = tmp_path / "data.nt"
+    rdffile.write_text(
+        f'<{ROOT}a> <{ROOT}name> "nef"@fr .\n<{ROOT}a> <{ROOT}rank> "2"^^<http://www.w3.org/2001/XMLSchema#integer> .\n'
+        f"<{ROOT}a> <{ROOT}part> _:b1 .\n"
+    )
+    quads = set(local_store(tmp_path, rdffile).g.quads())
+
+    def load_file(*args):
+        raise AssertionError("parsed again")
+
+    monkeypatch.setattr(LocalTripleStore, "load_file", load_file)
+    reloaded = local_store(tmp_path, rdffile)
+    assert len(quads) == 3
+    assert {(s, p, o) for s, p, o, g in reloaded.g.quads()} == {(s, p, o) for s, p, o, g in quads}
+
+
+def test_local_snapshot_of_another_format_is_ignored(tmp_path):
+    rdffile = tmp_path / "data.nt"
+    rdffile.write_text(f'<{ROOT}a> <{ROOT}name> "nef" .\n')
+    local_store(tmp_path, rdffile)
+    path = tmp_path / "bootstrap.snapshot"
+    snapshot = pickle.loads(path.read_bytes())
+    snapshot["format"] = (LocalTripleStore.SNAPSHOT_FORMAT[0], LocalTripleStore.SNAPSHOT_FORMAT[1] - 1)
+    snapshot["quads"] = []
+    path.write_bytes(pickle.dumps(snapshot))
+
+    assert len(local_store(tmp_path, rdffile).g) == 1
+    assert pickle.loads(path.read_bytes())["format"] == LocalTripleStore.SNAPSHOT_FORMAT  # written again
+
+
+# LocalTripleStore prepared templates
+NAMED_PEOPLE = f"""<{ROOT}id/a> <{ROOT}name> "Ann" ; <{ROOT}knows> <{ROOT}id/b> .
+<{ROOT}id/b> <{ROOT}name> "Bob \\"the\\" builder" ."""
+KNOWN_QUERY = f'SELECT ?name WHERE {{ <$person> <{ROOT}knows> ?o . ?o <{ROOT}name> ?name . FILTER(?name != "$other") }}'
+
+
+@pytest.fixture
+def local_templates(tmp_path, monkeypatch):
+    """LocalTripleStore on the templates of `tmp_path`, `prepared` counts the rdflib parses"""
+    for name in ("select", "update"):
+        (tmp_path / name).mkdir()
+
+    def make(**config):
+        store = LocalTripleStore(
+            {
+                "default_named_graph_root_uri": ROOT + "graphs/",
+                "default_named_graph_name": "main",
+                "default_triples_root_uri": ROOT + "id/",
+                "datapip_sparql_select_path": str(tmp_path / "select"),
+                "datapip_sparql_update_path": str(tmp_path / "update"),
+                "sparql_templates_check_interval": 0,
+            }
+            | config
+        )
+        store.graph().parse(data=NAMED_PEOPLE, format="turtle")
+        return store
+
+    prepared = []
+    for name in ("prepareQuery", "prepareUpdate"):
+        original = getattr(fast_local_triplestore, name)
+        monkeypatch.setattr(
+            fast_local_triplestore, name, lambda *args, original=original, **kwargs: prepared.append(args[0]) or original(*args, **kwargs)
+        )
+    return make, prepared
+
+
+def test_local_select_is_prepared_once_and_bound(tmp_path, local_templates):
+    make, prepared = local_templates
+    store = make()
+    write_template(tmp_path / "select", "known.sparql", KNOWN_QUERY, mtime_ns=1_000_000_000)
+
+    assert store.select_templated("known.sparql", format="dict", person=ROOT + "id/a", other="x") == [{"name": 'Bob "the" builder'}]
+    assert store.select_templated("known.sparql", format="dict", person=ROOT + "id/a", other='Bob "the" builder') == []
+    assert store.select_templated("known.sparql", format="dict", person=ROOT + "id/b", other='x" || true || "') == []
+    assert len(prepared) == 1 and "$" not in prepared[0]  # the slots are variables, the values are never parsed
+
+    write_template(tmp_path / "select", "known.sparql", KNOWN_QUERY.replace("!=", "="), mtime_ns=2_000_000_000)
+    assert store.select_templated("known.sparql", format="dict", person=ROOT + "id/a", other='Bob "the" builder') == [{"name": 'Bob "the" builder'}]
+    assert len(prepared) == 2  # the edited template
+
+
+@pytest.mark.parametrize(
+    "template, config",
+    [
+        (KNOWN_QUERY + " LIMIT $limit", {}),  # raw SPARQL placeholder
+        (KNOWN_QUERY.replace("SELECT ?name", "SELECT *").replace("<$person>", "?s") + " VALUES ?s { <$person> }", {}),
+        (KNOWN_QUERY, {"local_prepare_queries": False}),
+    ],
+)
+def test_local_select_is_substituted_when_it_cannot_be_prepared(tmp_path, local_templates, template, config):
+    make, prepared = local_templates
+    store = make(**config)
+    write_template(tmp_path / "select", "known.sparql", template)
+
+    rows = store.select_templated("known.sparql", format="dict", person=ROOT + "id/a", other="x", limit=1)
+    assert [row["name"] for row in rows] == ['Bob "the" builder']
+    assert prepared == []
+
+
+def test_local_prepared_select_with_enforced_parameters(tmp_path, local_templates):
+    make, _ = local_templates
+    store = make()
+    write_template(tmp_path / "select", "names.sparql", f"SELECT ?s ?name WHERE {{ ?s <{ROOT}name> ?name FILTER(?name != \"$other\") }}")
+
+    rows = store.select_templated_parametrized(
+        "names.sparql", format="dict", enforce_parameters={"s": URIRef(ROOT + "id/a")}, other="x"
+    )
+    assert rows == [{"s": ROOT + "id/a", "name": "Ann"}]
+
+
+def test_local_prepared_updates(tmp_path, local_templates):
+    make, prepared = local_templates
+    store = make(local_prepare_updates=True)
+    write_template(tmp_path / "update", "rename.sparql", f'DELETE {{ <$person> <{ROOT}name> ?n }} INSERT {{ <$person> <{ROOT}name> "$name" }} WHERE {{ <$person> <{ROOT}name> ?n }}')
+    write_template(tmp_path / "update", "add.sparql", f'INSERT DATA {{ <$__uri__1> <{ROOT}name> "$name" }}')
+
+    for name in ["Anna", 'Ann "the" second']:
+        store.update_templated("rename.sparql", person=ROOT + "id/a", name=name)
+    uris = store.update_templated("add.sparql", name="Cy")  # INSERT DATA is substituted
+    assert len(prepared) == 1
+
+    names = {str(s): str(o) for s, o in store.graph().subject_objects(URIRef(ROOT + "name"))}
+    assert names[ROOT + "id/a"] == 'Ann "the" second'
+    assert names[uris["__uri__1"]] == "Cy"
+
+
+# N-Quads export
+
+NTRIPLES = (
+    f"# exported\n<{ROOT}a> <{ROOT}name> \"nef . laser\"@fr .\n\n"
+    f"<{ROOT}a> <{ROOT}part> _:b1 .\r\n"
+    f"<{ROOT}a> <{ROOT}rank> \"2\"^^<http://www.w3.org/2001/XMLSchema#integer>.\n"
+    f"  <{ROOT}a> <{ROOT}note> \"\u00e9\" ."  # no final newline
+).encode("utf-8")
+
+
+def rewrite(chunks) -> bytes:
+    rewriter = NQuadsRewriter(GRAPH)
+    return b"".join(rewriter.feed(chunk) for chunk in chunks) + rewriter.close()
+
+
+def test_nquads_rewriter_puts_every_triple_in_the_graph():
+    dataset = Dataset()
+    dataset.parse(data=rewrite([NTRIPLES]).decode("utf-8"), format="nquads")
+    expected = Graph().parse(data=NTRIPLES.decode("utf-8"), format="nt")
+
+    assert {g for s, p, o, g in dataset.quads()} == {URIRef(GRAPH)}
+    assert isomorphic(dataset.graph(URIRef(GRAPH)), expected)
+    assert rewrite([NTRIPLES]).count(b"\n") == 4  # comments and blank lines are dropped
+
+
+def test_nquads_rewriter_does_not_depend_on_chunk_boundaries():
+    whole = rewrite([NTRIPLES])
+    for cut in range(len(NTRIPLES) + 1):
+        assert rewrite([NTRIPLES[:cut], NTRIPLES[cut:]]) == whole
+    assert rewrite([NTRIPLES[i : i + 1] for i in range(len(NTRIPLES))]) == whole  # cuts inside UTF-8 characters too
+
+
+EXPORTED = """@prefix acrm: <http://astragale.cnrs.fr/sem/acrm/> .
+@prefix : <http://example.org/id/> .
+:annotation1 acrm:P106_is_composed_of :scan1 ; :text "crack" .
+:note1 :about :annotation1 .
+:scan9 acrm:P138_represents :bridge ."""
+
+
+def test_export_query_reaches_parts_and_their_linked_resources(store):
+    load_turtle(store, BUILTWORKS)
+    load_turtle(store, EXPORTED)
+    graph = store.dataset.graph(URIRef(GRAPH))
+
+    subjects = lambda depth: {str(s) for s in graph.query(store.export_query(bw("cathedral"), depth=depth)).graph.subjects()}
+    assert subjects(1) == {bw(n) for n in ["cathedral", "nave", "choir", "pillar", "scan1", "scan2"]}
+    assert subjects(2) == subjects(1) | {bw("annotation1")}
+    assert subjects(3) == subjects(2) | {bw("note1")}  # never the bridge and its geometry
+    exported = graph.query(store.export_query(bw("nave"), depth=2)).graph
+    assert (URIRef(bw("annotation1")), URIRef(bw("text")), Literal("crack")) in exported
+
+
+def test_aiter_construct_streams_nquads_of_the_graph(store):
+    load_turtle(store, BUILTWORKS)
+    query = store.export_query(bw("cathedral"), depth=1)
+
+    async def export(**kwargs):
+        return [chunk async for chunk in store.aiter_construct(query, chunk_size=64, **kwargs)]
+
+    chunks = asyncio.run(export(format="nq"))
+    assert len(chunks) > 2
+    dataset = Dataset()
+    dataset.parse(data=b"".join(chunks).decode("utf-8"), format="nquads")
+    assert {g for _, _, _, g in dataset.quads()} == {URIRef(GRAPH)}
+    expected = store.dataset.graph(URIRef(GRAPH)).query(query).graph
+    assert isomorphic(dataset.graph(URIRef(GRAPH)), expected)
+    assert isomorphic(Graph().parse(data=b"".join(asyncio.run(export())).decode("utf-8"), format="nt"), expected)
+    assert store.aclient.closed_streams == 2
+
+
+def test_aiter_construct_releases_the_stream_of_a_gone_client(store):
+    load_turtle(store, BUILTWORKS)
+
+    async def first_chunk():
+        async with aclosing(store.aiter_construct(store.export_query(bw("cathedral")), chunk_size=16)) as chunks:
+            async for chunk in chunks:
+                return chunk
+
+    assert len(asyncio.run(first_chunk())) == 16
+    assert store.aclient.closed_streams == 1
+
+
+def test_nquads_rewriter_close_flushes_only_once():
+    rewriter = NQuadsRewriter(GRAPH)
+    assert rewriter.feed(f"<{ROOT}a> <{ROOT}b> <{ROOT}c> .".encode()) == b""
+    assert rewriter.close() == f"<{ROOT}a> <{ROOT}b> <{ROOT}c> <{GRAPH}> .\n".encode()
+    assert rewriter.close() == b""